@@ -0,0 +1 @@
+"""Offline benchmarks for the HTTP API; see benchmarks/run.py."""
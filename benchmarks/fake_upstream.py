@@ -0,0 +1,130 @@
+"""
+Local stand-in for the JMComic site: a client with the methods main.py calls, returning
+real jmcomic page/comment entities after a configurable delay, failing at a configurable
+rate, and "downloading" albums of a configurable size. Nothing touches the network.
+"""
+import io
+import random
+import time
+import zipfile
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Iterator, Optional
+from unittest.mock import patch
+
+import jmcomic
+from PIL import Image
+
+
+@dataclass
+class UpstreamProfile:
+    latency_ms: float = 50.0         # mean delay of one metadata call
+    jitter_ms: float = 10.0          # standard deviation of that delay
+    error_rate: float = 0.0          # fraction of calls raising RequestRetryAllFailException
+    photos_per_album: int = 3
+    images_per_photo: int = 10
+    image_bytes: int = 50_000
+    image_latency_ms: float = 5.0    # per image during an album download
+    download_threads: int = 8        # images fetched in parallel by a download
+    results_per_page: int = 80
+    comments_per_page: int = 10
+    seed: Optional[int] = None
+
+
+class FakeUpstream:
+    """Shared state of the fake site; new_client() builds the per-pool-slot client objects."""
+
+    def __init__(self, profile: UpstreamProfile, file_path):
+        self.profile = profile
+        self.file_path = file_path
+        self._random = random.Random(profile.seed)
+        self._image = self._random.randbytes(profile.image_bytes)  # incompressible, like real JPEG data
+        buffer = io.BytesIO()
+        Image.new("RGB", (300, 400), (200, 120, 80)).save(buffer, format="JPEG")
+        self._cover = buffer.getvalue()
+        self.calls = 0
+        self.errors = 0
+
+    def _call(self, latency_ms: Optional[float] = None) -> None:
+        """Sleep like a round trip, then fail at error_rate."""
+        self.calls += 1
+        mean = self.profile.latency_ms if latency_ms is None else latency_ms
+        delay = max(0.0, self._random.gauss(mean, self.profile.jitter_ms if mean else 0.0))
+        if delay:
+            time.sleep(delay / 1000)
+        if self._random.random() < self.profile.error_rate:
+            self.errors += 1
+            raise jmcomic.RequestRetryAllFailException("fake upstream error", {})
+
+    def new_client(self) -> "FakeClient":
+        return FakeClient(self)
+
+    def download_album(self, album_id, option=None, downloader=None, **kwargs):
+        """Stand-in for jmcomic.download_album: wait for the images, then write the album's zip."""
+        p = self.profile
+        images = p.photos_per_album * p.images_per_photo
+        self._call(p.image_latency_ms * images / max(1, p.download_threads))
+        title = f"bench-{album_id}"
+        with zipfile.ZipFile(self.file_path / f"{title}.zip", "w", compression=zipfile.ZIP_STORED) as archive:
+            for photo in range(1, p.photos_per_album + 1):
+                for image in range(1, p.images_per_photo + 1):
+                    archive.writestr(f"{photo:03d}/{image:05d}.jpg", self._image)
+        return [SimpleNamespace(title=title)]
+
+
+class FakeClient:
+    """The subset of JmcomicClient used by main.py."""
+
+    def __init__(self, upstream: FakeUpstream):
+        self._upstream = upstream
+
+    def _page(self, page_class, first_id: int):
+        p = self._upstream.profile
+        content = [(str(first_id + i), {"name": f"album {first_id + i}"}) for i in range(p.results_per_page)]
+        return page_class(content, p.results_per_page * 10)
+
+    def search_site(self, search_query: str = "", page: int = 1, **kwargs):
+        self._upstream._call()
+        return self._page(jmcomic.JmSearchPage, 100000 + page * 1000)
+
+    def _ranking(self, page: int = 1):
+        self._upstream._call()
+        return self._page(jmcomic.JmCategoryPage, 200000 + page * 1000)
+
+    day_ranking = week_ranking = month_ranking = _ranking
+
+    def get_album_detail(self, album_id):
+        self._upstream._call()
+        p = self._upstream.profile
+        return SimpleNamespace(
+            album_id=str(album_id), title=f"bench-{album_id}", tags=["bench"], views="1000", likes="100",
+            page_count=str(p.photos_per_album * p.images_per_photo),
+        )
+
+    def album_pagination(self, album_id, page: int = 1, **kwargs):
+        self._upstream._call()
+        comments = [
+            jmcomic.JmAlbumComment({"CID": f"{page}-{i}", "AID": str(album_id), "content": "bench comment",
+                                    "username": "bench", "addtime": "2024-01-01", "likes": i})
+            for i in range(self._upstream.profile.comments_per_page)
+        ]
+        return jmcomic.JmAlbumCommentPage(comments, total=len(comments) * 5, page_number=page)
+
+    def download_album_cover(self, album_id, save_path: str) -> None:
+        self._upstream._call()
+        with open(save_path, "wb") as f:
+            f.write(self._upstream._cover)
+
+
+@contextmanager
+def installed(app_module, profile: UpstreamProfile) -> Iterator[FakeUpstream]:
+    """Point app_module (main) at a FakeUpstream for the duration of the block."""
+    upstream = FakeUpstream(profile, app_module.FILE_PATH)
+    pool = app_module.ClientPool(upstream.new_client, app_module.CLIENT_POOL_SIZE)
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(app_module, "jm_client_pool", pool))
+        stack.enter_context(patch.object(app_module, "get_cover_client", upstream.new_client))
+        stack.enter_context(patch.object(app_module, "get_download_option", lambda: None))
+        stack.enter_context(patch.object(app_module.jmcomic, "download_album", upstream.download_album))
+        yield upstream
@@ -0,0 +1,245 @@
+"""
+Offline benchmark: drives the FastAPI app in-process (httpx ASGITransport, lifespan
+included) against benchmarks.fake_upstream and reports throughput and latency
+percentiles per endpoint.
+
+    python -m benchmarks.run                                    # defaults, prints a table
+    python -m benchmarks.run -c 32 -n 1000 --latency-ms 100 --out results/head.json
+    python -m benchmarks.run --out results/new.json --compare results/head.json
+
+The server runs in a fresh temporary working directory, so its temp/ and caches
+start empty on every run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+ENDPOINTS = ("search", "info", "rank", "comments", "cover", "download")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("-n", "--requests", type=int, default=300, help="requests per metadata/cover endpoint")
+    parser.add_argument("--downloads", type=int, default=20, help="download+zip flows (each a distinct album)")
+    parser.add_argument("--keys", type=int, default=50, help="distinct tags/albums per endpoint; fewer = more cache hits")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma-separated subset of " + ", ".join(ENDPOINTS))
+    parser.add_argument("--cover-width", type=int, default=None, help="request resized covers (?w=) instead of originals")
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--photos", type=int, default=3, help="chapters per album")
+    parser.add_argument("--images", type=int, default=10, help="images per chapter")
+    parser.add_argument("--image-bytes", type=int, default=50_000)
+    parser.add_argument("--image-latency-ms", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", type=Path, default=None, help="write results JSON here")
+    parser.add_argument("--compare", type=Path, default=None, help="earlier results JSON to diff against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the server's log output")
+    args = parser.parse_args(argv)
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    return args
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: List[float], statuses: Dict[str, int], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    ms = [v * 1000 for v in ordered]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(ms) / len(ms), 2) if ms else 0.0,
+            "p50": round(percentile(ms, 50), 2),
+            "p95": round(percentile(ms, 95), 2),
+            "p99": round(percentile(ms, 99), 2),
+            "max": round(ms[-1], 2) if ms else 0.0,
+        },
+    }
+
+
+async def _download_flow(client: httpx.AsyncClient, album_id: int) -> httpx.Response:
+    """POST the download, poll the job until it finishes, then fetch the zip."""
+    response = await client.post(f"/v1/download/album/{album_id}", json={"client_id": f"bench-{album_id}"})
+    if response.status_code == 200:  # already stored
+        return await client.get(f"/v1/download/{response.json()['file_name']}")
+    if response.status_code != 202:
+        return response
+    job_id = response.json()["job_id"]
+    while True:
+        await asyncio.sleep(0.01)
+        state = await client.get(f"/v1/jobs/{job_id}")
+        if state.status_code != 200:
+            return state
+        job = state.json()
+        if job["status"] == "done":
+            return await client.get(f"/v1/download/{job['file_name']}")
+        if job["status"] == "error":
+            return httpx.Response(502, request=state.request)
+
+
+def _operation(endpoint: str, args: argparse.Namespace):
+    """Return an async (client, i) -> response for one request to endpoint."""
+    windows = ("day", "week", "month")
+    cover_query = f"?w={args.cover_width}" if args.cover_width else ""
+    operations = {
+        "search": lambda c, i: c.get(f"/v1/search/tag{i % args.keys}/1"),
+        "info": lambda c, i: c.get(f"/v1/info/{300000 + i % args.keys}"),
+        "rank": lambda c, i: c.get(f"/v1/rank/{windows[i % 3]}"),
+        "comments": lambda c, i: c.get(f"/v1/comments/{300000 + i % args.keys}?page=1"),
+        "cover": lambda c, i: c.get(f"/v1/get/cover/{400000 + i % args.keys}{cover_query}"),
+        "download": lambda c, i: _download_flow(c, 500000 + i),
+    }
+    return operations[endpoint]
+
+
+async def run_endpoint(client: httpx.AsyncClient, endpoint: str, total: int, args: argparse.Namespace) -> dict:
+    """Issue total requests with args.concurrency workers and summarize them."""
+    operation = _operation(endpoint, args)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    next_index = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in next_index:
+            start = time.perf_counter()
+            try:
+                response = await operation(client, i)
+                status = str(response.status_code)
+                ok = response.status_code < 400
+            except Exception as e:
+                status, ok = type(e).__name__, False
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(args.concurrency, total))))
+    return summarize(latencies, statuses, errors, time.perf_counter() - started)
+
+
+async def run_benchmark(args: argparse.Namespace, app_module=None) -> dict:
+    """Run every selected endpoint against a fake upstream and return the results document."""
+    if app_module is None:
+        import main as app_module
+    from benchmarks.fake_upstream import UpstreamProfile, installed
+
+    profile = UpstreamProfile(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        photos_per_album=args.photos, images_per_photo=args.images, image_bytes=args.image_bytes,
+        image_latency_ms=args.image_latency_ms, seed=args.seed,
+    )
+    results = {}
+    with installed(app_module, profile) as upstream:
+        app = app_module.app
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+                for endpoint in args.endpoints:
+                    if endpoint == "cover":  # covers exist once /v1/info has fetched them
+                        await asyncio.gather(*(app_module.cover_fetcher.fetch(str(400000 + k))
+                                               for k in range(args.keys)))
+                    total = args.downloads if endpoint == "download" else args.requests
+                    results[endpoint] = await run_endpoint(client, endpoint, total, args)
+        upstream_stats = {"calls": upstream.calls, "errors": upstream.errors}
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+            "upstream_profile": asdict(profile),
+            "upstream": upstream_stats,
+        },
+        "results": results,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_table(document: dict, baseline: Optional[dict] = None) -> str:
+    """Plain-text table; with a baseline, throughput and p95 get a relative change column."""
+    header = f"{'endpoint':<10}{'reqs':>7}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'Δrps':>9}{'Δp95':>9}"
+    lines = [header, "-" * len(header)]
+    for endpoint, r in document["results"].items():
+        lat = r["latency_ms"]
+        line = (f"{endpoint:<10}{r['requests']:>7}{r['errors']:>8}{r['throughput_rps']:>10.1f}"
+                f"{lat['p50']:>10.1f}{lat['p95']:>10.1f}{lat['p99']:>10.1f}")
+        old = (baseline or {}).get("results", {}).get(endpoint)
+        if old:
+            line += f"{_change(old['throughput_rps'], r['throughput_rps']):>9}"
+            line += f"{_change(old['latency_ms']['p95'], lat['p95']):>9}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _change(old: float, new: float) -> str:
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    baseline = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+    out = args.out.resolve() if args.out else None
+    # Set before main is imported: no live impl probe, no cross-process L2 cache, empty temp/
+    os.environ.setdefault("JM_IMPL_MODE", "api")
+    os.environ.setdefault("JM_SHARED_CACHE_DB", "")
+    sys.path.insert(0, str(REPO_ROOT))
+    if not args.verbose:
+        # Per-request INFO lines, and "no WebSocket client" errors for every finished download
+        logging.getLogger("main").setLevel(logging.CRITICAL)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix="jm-bench-") as workdir:
+        os.chdir(workdir)
+        document = asyncio.run(run_benchmark(args))
+        os.chdir(REPO_ROOT)
+    print(format_table(document, baseline))
+    if out:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(document, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\nresults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
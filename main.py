@@ -1,20 +1,44 @@
+import io
 import os
+import sys
 import time
 import logging
+import json
+import math
+import random
+import bisect
+import hashlib
+import hmac
+import heapq
 import shutil
+import sqlite3
 import asyncio
-from contextlib import asynccontextmanager
+import contextvars
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
 from enum import Enum
-from functools import wraps
-from typing import Dict, Optional, Tuple, Any, Set
-from fastapi import FastAPI, WebSocket, HTTPException, Request
-from fastapi.responses import JSONResponse, FileResponse
+from functools import partial, wraps
+from itertools import count
+from typing import Dict, Iterator, List, Optional, Tuple, Any, Set
+from fastapi import FastAPI, WebSocket, HTTPException, Request, Query
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.concurrency import run_in_threadpool
 import uvicorn
 import jmcomic
 from pathlib import Path
-from datetime import datetime, timedelta
+from PIL import Image
+
+try:
+    import orjson  # optional: several times faster than json for cached response bodies
+except ImportError:
+    orjson = None
 
 # --- Logging configuration ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
@@ -25,90 +49,1192 @@ current_dir = os.getcwd()
 FILE_PATH = Path(f"{current_dir}/temp")
 os.makedirs(FILE_PATH, exist_ok=True)
 
-# --- Delayed file cleanup tracking (replaces per-request threads) ---
-_pending_deletions: Dict[Path, float] = {}
-_deletions_lock = __import__('threading').Lock()
+# --- Metrics primitives (Prometheus text exposition format, no client library) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def metric_lines(name: str, kind: str, documentation: str, labelnames: Tuple[str, ...],
+                 samples: List[Tuple[Tuple[str, ...], float]]) -> List[str]:
+    """HELP/TYPE header plus one line per (label values, value) sample."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_format_labels(labelnames, labels)} {value:g}" for labels, value in samples)
+    return lines
+
+
+def stats_metric_lines(stats: Dict[str, Any], families: Tuple[Tuple[str, str, str, str], ...]) -> List[str]:
+    """Unlabelled families read from one stats() dict, given as (name, field, kind, documentation)."""
+    lines: List[str] = []
+    for name, field, kind, documentation in families:
+        lines += metric_lines(name, kind, documentation, (), [((), stats[field])])
+    return lines
+
+
+class Counter:
+    """Monotonic counter per label set."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            samples = sorted(self._values.items())
+        return metric_lines(self.name, "counter", self.documentation, self.labelnames, samples)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set; observe() is one bisect and two adds under a lock."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, labels: Tuple[str, ...]) -> int:
+        series = self._series.get(labels)
+        return 0 if series is None else sum(series[:-1])
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = sorted((labels, list(series)) for labels, series in self._series.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, series in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (f'{bound:g}',))} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(names, labels + ('+Inf',))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+http_requests = Counter("jm_http_requests_total", "HTTP requests by route template, method and status.",
+                        ("route", "method", "status"))
+http_latency = Histogram("jm_http_request_duration_seconds", "HTTP request latency by route template.",
+                         ("route", "method"))
+upstream_latency = Histogram("jm_upstream_request_duration_seconds", "Upstream jmcomic call latency by operation.",
+                             ("operation",))
+upstream_errors = Counter("jm_upstream_errors_total", "Failed upstream jmcomic calls by operation and error type.",
+                          ("operation", "error"))
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware timing every HTTP request. The route label is the matched
+    path template (the router stores the route in scope), so ids never create series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_latency.observe((route, method), time.perf_counter() - start)
+            http_requests.inc((route, method, str(status)))
+
+
+# --- Request timing (Server-Timing header) and opt-in sampling profiler ---
+PROFILE_SAMPLE_RATE = float(os.environ.get("JM_PROFILE_SAMPLE_RATE", "0"))  # fraction of requests profiled
+PROFILE_SLOW_MS = float(os.environ.get("JM_PROFILE_SLOW_MS", "500"))         # sampled profiles are kept above this
+PROFILE_INTERVAL = float(os.environ.get("JM_PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_DIR = Path(os.environ.get("JM_PROFILE_DIR", f"{current_dir}/profiles"))
+PROFILE_HEADER = b"x-jm-profile"  # carrying PROFILE_TOKEN profiles this request and always keeps the result
+PROFILE_TOKEN = os.environ.get("JM_PROFILE_TOKEN", "").encode()  # empty: the header is ignored
+PROFILE_MAX_ACTIVE = 4            # concurrently profiled requests; further requests run unprofiled
+PROFILE_MAX_FILES = 200           # oldest profiles beyond this are deleted
+
+
+class RequestTiming:
+    """Seconds per phase for one request, plus when its handler returned (start of serialization)."""
+
+    __slots__ = ("phases", "handler_done", "lock")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.handler_done: Optional[float] = None
+        self.lock = threading.Lock()  # executor threads add phases concurrently
+
+
+# The same RequestTiming is reachable from the context copies executor threads run in,
+# so phases spent there (queue wait, upstream call) are added to the request's total
+request_timing: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar("request_timing", default=None)
+
+
+def record_phase(phase: str, seconds: float, timing: Optional[RequestTiming] = None) -> None:
+    """Add seconds to phase of the current request (no-op outside a request)."""
+    if timing is None:
+        timing = request_timing.get()
+        if timing is None:
+            return
+    with timing.lock:
+        timing.phases[phase] = timing.phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Count the time spent in the block toward phase of the current request."""
+    timing = request_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start, timing)
+
+
+def mark_handler_done() -> None:
+    """Called when an endpoint returns; the time until the response starts is reported as serialize."""
+    timing = request_timing.get()
+    if timing is not None:
+        timing.handler_done = time.perf_counter()
+
+
+def server_timing_header(phases: Dict[str, float]) -> str:
+    return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in phases.items())
+
+
+class RequestProfile:
+    """Folded-stack sample counts for one request's event-loop thread and the executor threads working for it."""
+
+    __slots__ = ("threads", "stacks", "samples")
+
+    def __init__(self, loop_thread: int):
+        self.threads: Set[int] = {loop_thread}
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+
+    def folded(self) -> str:
+        """Brendan Gregg's folded format (one "root;...;leaf count" line per stack), hottest first."""
+        ordered = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {n}\n" for stack, n in ordered)
+
+
+request_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("request_profile", default=None)
+
+
+def _fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    One daemon thread that snapshots sys._current_frames() every interval while any
+    profile is active and adds each profiled thread's stack to its request's counts.
+    Sleeps on a condition while nothing is being profiled.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, max_active: int = PROFILE_MAX_ACTIVE):
+        self.interval = interval
+        self.max_active = max_active
+        self._active: Set[RequestProfile] = set()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.started = 0
+        self.skipped = 0
+        self.saved = 0
+
+    def begin(self) -> Optional[RequestProfile]:
+        """Start profiling the calling (event-loop) thread's request; None when at max_active."""
+        with self._cond:
+            if len(self._active) >= self.max_active:
+                self.skipped += 1
+                return None
+            profile = RequestProfile(threading.get_ident())
+            self._active.add(profile)
+            self.started += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="jm-profiler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return profile
+
+    def end(self, profile: RequestProfile) -> None:
+        with self._cond:
+            self._active.discard(profile)
+
+    def sample_once(self) -> None:
+        with self._cond:
+            profiles = list(self._active)
+        frames = sys._current_frames()
+        for profile in profiles:
+            for ident in list(profile.threads):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = _fold_stack(frame)
+                    profile.stacks[stack] = profile.stacks.get(stack, 0) + 1
+            profile.samples += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+            self.sample_once()
+            time.sleep(self.interval)
+
+    def save(self, profile: RequestProfile, method: str, route: str, elapsed: float) -> Path:
+        """Write the profile to PROFILE_DIR and prune the oldest files beyond PROFILE_MAX_FILES."""
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        slug = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{method}-{slug}-{elapsed * 1000:.0f}ms-{uuid.uuid4().hex[:6]}.folded"
+        path = PROFILE_DIR / name
+        path.write_text(profile.folded(), encoding="utf-8")
+        self.saved += 1
+        existing = sorted(PROFILE_DIR.glob("*.folded"), key=lambda p: p.stat().st_mtime)
+        for old in existing[:-PROFILE_MAX_FILES]:
+            old.unlink(missing_ok=True)
+        return path
+
+
+profiler = StackSampler()
+
+
+def _profile_requested(headers: List[Tuple[bytes, bytes]]) -> bool:
+    """True if the request carries X-JM-Profile with the configured token; never when no token is set."""
+    if not PROFILE_TOKEN:
+        return False
+    value = dict(headers).get(PROFILE_HEADER)
+    return value is not None and hmac.compare_digest(value, PROFILE_TOKEN)
+
+
+class ServerTimingMiddleware:
+    """
+    Pure ASGI middleware adding a Server-Timing header with the phases recorded for the
+    request (cache, queue, upstream, coalesced, cover, resize, serialize, total), and
+    profiling requests that send X-JM-Profile: <JM_PROFILE_TOKEN> or fall in the
+    JM_PROFILE_SAMPLE_RATE sample.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        timing = RequestTiming()
+        timing_token = request_timing.set(timing)
+        forced = _profile_requested(scope["headers"])
+        profile = None
+        if forced or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+            profile = profiler.begin()
+        profile_token = request_profile.set(profile)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                with timing.lock:
+                    if timing.handler_done is not None:
+                        timing.phases["serialize"] = now - timing.handler_done
+                    timing.phases["total"] = now - start
+                    header = server_timing_header(timing.phases)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode("latin-1"))]
+            await send(message)
 
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_profile.reset(profile_token)
+            request_timing.reset(timing_token)
+            if profile is not None:
+                profiler.end(profile)
+                elapsed = time.perf_counter() - start
+                if forced or elapsed * 1000 >= PROFILE_SLOW_MS:
+                    route = getattr(scope.get("route"), "path", "unmatched")
+                    path = await run_in_threadpool(profiler.save, profile, scope["method"], route, elapsed)
+                    logger.info("[Profile] %s %s took %.0f ms, %d samples -> %s",
+                                scope["method"], scope["path"], elapsed * 1000, profile.samples, path)
+
+
+# --- Delayed file cleanup: timer heap with a dedicated deletion thread ---
+MIN_FREE_BYTES = int(os.environ.get("JM_MIN_FREE_BYTES", str(1024 ** 3)))  # emergency pass below 1 GiB free
+DISK_CHECK_INTERVAL = 30  # seconds between free-space checks
+
+
+def _disk_size(path: Path) -> int:
+    try:
+        if path.is_dir():
+            return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+        return path.stat().st_size
+    except OSError:
+        return 0
 
-def schedule_deletion(path: Path, delay_seconds: int = 1800) -> None:
-    """Schedule a file/folder for deletion after delay_seconds. Skips if already scheduled."""
-    with _deletions_lock:
-        if path not in _pending_deletions:
-            _pending_deletions[path] = time.time() + delay_seconds
 
+class DeletionScheduler:
+    """
+    Min-heap of (deadline, seq, path) drained by one daemon thread that sleeps until
+    the earliest deadline. Rescheduling pushes a new entry; superseded ones are skipped
+    when popped. Each pass also checks free space in base_dir and, below min_free_bytes,
+    deletes scheduled files early (earliest deadline first), then the least recently
+    used zips in artifact_store.
+    """
 
-def _process_deletions() -> int:
-    """Delete expired entries. Returns count of deleted items."""
-    now = time.time()
-    deleted = 0
-    with _deletions_lock:
-        expired = [p for p, t in _pending_deletions.items() if t <= now]
-        for p in expired:
-            del _pending_deletions[p]
-    for path in expired:
+    def __init__(self, base_dir: Path, min_free_bytes: int, disk_check_interval: float = DISK_CHECK_INTERVAL):
+        self.base_dir = base_dir
+        self.min_free_bytes = min_free_bytes
+        self.disk_check_interval = disk_check_interval
+        self._heap: List[Tuple[float, int, Path]] = []
+        self._deadlines: Dict[Path, Tuple[float, int]] = {}  # live (deadline, seq) per path
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._next_disk_check = 0.0
+        self.deleted = 0
+        self.emergency_deleted = 0
+
+    def schedule(self, path: Path, delay_seconds: float, extend: bool = False) -> None:
+        """
+        Delete path after delay_seconds. An existing deadline is kept unless extend is set,
+        in which case it moves to now + delay_seconds if that is later.
+        """
+        deadline = time.monotonic() + delay_seconds
+        with self._cond:
+            current = self._deadlines.get(path)
+            if current is not None and (not extend or current[0] >= deadline):
+                return
+            seq = next(self._seq)
+            self._deadlines[path] = (deadline, seq)
+            heapq.heappush(self._heap, (deadline, seq, path))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                # Mostly superseded entries: rebuild from the live deadlines
+                self._heap = [(d, q, p) for p, (d, q) in self._deadlines.items()]
+                heapq.heapify(self._heap)
+            if self._heap[0][1] == seq:
+                self._cond.notify()  # new earliest deadline: wake the thread to re-arm its timer
+
+    def cancel(self, path: Path) -> None:
+        with self._cond:
+            self._deadlines.pop(path, None)
+
+    def deadline(self, path: Path) -> Optional[float]:
+        """Seconds until path is deleted, or None if it isn't scheduled."""
+        with self._cond:
+            current = self._deadlines.get(path)
+        return None if current is None else current[0] - time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def _pop_due(self, now: float) -> List[Path]:
+        """Caller holds the lock."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, path = heapq.heappop(self._heap)
+            if self._deadlines.get(path) == (deadline, seq):
+                del self._deadlines[path]
+                due.append(path)
+        return due
+
+    @staticmethod
+    def _delete(path: Path) -> bool:
         try:
-            if path.exists():
-                if path.is_dir():
-                    shutil.rmtree(path)
-                    logger.info("[Cleanup] Deleted folder: %s", path)
-                elif path.is_file():
-                    path.unlink()
-                    logger.info("[Cleanup] Deleted file: %s", path)
-            deleted += 1
+            if path.is_dir():
+                shutil.rmtree(path)
+                logger.info("[Cleanup] Deleted folder: %s", path)
+            elif path.is_file():
+                path.unlink()
+                logger.info("[Cleanup] Deleted file: %s", path)
+                for variant in cover_variants_of(path):
+                    variant.unlink(missing_ok=True)
+                _cover_digests.pop(path, None)
+            return True
         except Exception as e:
             logger.error("[Cleanup Error] Failed to delete %s: %s", path, e)
-    return deleted
+            return False
+
+    def run_due(self) -> int:
+        """Delete everything whose deadline has passed. Returns count of deleted items."""
+        with self._cond:
+            due = self._pop_due(time.monotonic())
+        deleted = sum(self._delete(path) for path in due)
+        self.deleted += deleted
+        return deleted
+
+    def relieve_disk_pressure(self) -> int:
+        """If free space is below min_free_bytes, delete early until it isn't. Returns bytes freed."""
+        free = shutil.disk_usage(self.base_dir).free
+        if free >= self.min_free_bytes:
+            return 0
+        needed = self.min_free_bytes - free
+        logger.warning("[Cleanup] Low disk space (%d bytes free), deleting early", free)
+        with self._cond:
+            victims = sorted(self._deadlines.items(), key=lambda item: item[1])
+        freed = 0
+        for path, entry in victims:
+            if freed >= needed:
+                break
+            with self._cond:
+                if self._deadlines.get(path) != entry:
+                    continue
+                del self._deadlines[path]  # its heap entry is now stale and will be skipped
+            size = _disk_size(path)
+            if self._delete(path):
+                freed += size
+                self.emergency_deleted += 1
+        if freed < needed:
+            freed += artifact_store.evict_bytes(needed - freed)
+        return freed
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.monotonic()
+                due = self._pop_due(now)
+                check_disk = now >= self._next_disk_check
+                if not due and not check_disk:
+                    wake_at = self._next_disk_check
+                    if self._heap:
+                        wake_at = min(wake_at, self._heap[0][0])
+                    self._cond.wait(wake_at - now)
+                    continue
+            self.deleted += sum(self._delete(path) for path in due)
+            if check_disk:
+                self._next_disk_check = now + self.disk_check_interval
+                try:
+                    self.relieve_disk_pressure()
+                except Exception as e:
+                    logger.error("[Cleanup Error] Disk pressure pass failed: %s", e)
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="jm-deletions", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, int]:
+        return {"scheduled": len(self), "deleted": self.deleted, "emergency_deleted": self.emergency_deleted}
+
+
+deletion_scheduler = DeletionScheduler(FILE_PATH, MIN_FREE_BYTES)
+
+
+def schedule_deletion(path: Path, delay_seconds: int = 1800, extend: bool = False) -> None:
+    """Schedule a file/folder for deletion after delay_seconds (see DeletionScheduler.schedule)."""
+    deletion_scheduler.schedule(path, delay_seconds, extend=extend)
+
+
+def cover_variants_of(path: Path) -> List[Path]:
+    """Resized/re-encoded variants generated from an original cover-{aid}.jpg."""
+    if not (path.name.startswith("cover-") and path.suffix == ".jpg" and path.stem.count(".") == 0):
+        return []
+    return list(path.parent.glob(f"{path.stem}.*.w*.*"))
+
+
+# --- Implementation mode (html or api): probed in the background, re-probed and failed over ---
+IMPL_PROBE_INTERVAL = int(os.environ.get("JM_IMPL_PROBE_INTERVAL", "1800"))   # seconds between re-probes
+IMPL_FAILOVER_ERRORS = int(os.environ.get("JM_IMPL_FAILOVER_ERRORS", "5"))    # consecutive failures before failover
+
+
+def probe_html_mode() -> bool:
+    """Blocking: True if a live HTML-mode search works from this host."""
+    testClient = jmcomic.JmHtmlClient(
+        postman=jmcomic.JmModuleConfig.new_postman(),
+        domain_list=['18comic.vip'],
+        retry_times=1
+    )
+    try:
+        testClient.search_site(search_query="胡桃")
+        return True
+    except jmcomic.JmcomicException as e:
+        error_msg = str(e)
+        if error_msg[:36] == "请求失败，响应状态码为403，原因为: [ip地区禁止访问/爬虫被识别]":
+            logger.warning("Jmcomic Error: %s", e)
+            logger.warning("已为您更换到api方式，页码数可能会不可用")
+        else:
+            logger.warning("HTML模式初始化失败，切换到API模式: %s", e)
+    except Exception as e:
+        logger.warning("警告: HTML模式测试时发生意外错误，使用API模式: %s", e)
+    return False
 
 
-# Configure implementation mode — lazy init to avoid blocking startup
-_impl_mode: Optional[str] = None
-_impl_lock = __import__('threading').Lock()
+def _is_upstream_failure(e: Exception) -> bool:
+    """Errors that say the access mode is broken, as opposed to e.g. a missing album."""
+    return isinstance(e, jmcomic.JmcomicException) and not isinstance(e, jmcomic.MissingAlbumPhotoException)
+
+
+class ImplModeManager:
+    """
+    Holds the active impl mode. Requests read it without blocking ('api' until the
+    first probe finishes); a background thread probes HTML access at startup and
+    every probe_interval. After failover_errors consecutive upstream failures the
+    thread wakes early: from html it falls back to api, from api it re-probes html.
+    A switch rebuilds the shared clients and options before the new mode is visible.
+    """
+
+    def __init__(self, probe_interval: int, failover_errors: int):
+        self.probe_interval = probe_interval
+        self.failover_errors = failover_errors
+        self._mode = 'api'
+        self._probed = False
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._failover = False
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.generation = 0  # bumped on every switch
+        self.switches = 0
+        self.probes = 0
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    def set_mode(self, mode: str, reason: str) -> bool:
+        """Switch to mode, rebuilding clients first. Returns True if the mode changed."""
+        with self._lock:
+            self._probed = True
+            if mode == self._mode:
+                return False
+            try:
+                _rebuild_clients(mode)
+            except Exception as e:
+                logger.error("[Impl] Could not build %s clients, staying on %s: %s", mode, self._mode, e)
+                return False
+            os.environ['impl'] = mode
+            logger.warning("[Impl] Switching %s -> %s (%s)", self._mode, mode, reason)
+            self._mode = mode
+            self._failures = 0
+            self.generation += 1
+            self.switches += 1
+            return True
+
+    def record_success(self) -> None:
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.failover_errors and not self._failover:
+            self._failover = True
+            self._wake.set()
+
+    def reprobe(self) -> None:
+        """One probe/failover step; blocking, runs in the manager thread."""
+        failover, self._failover = self._failover, False
+        self._failures = 0
+        if failover and self._mode == 'html':
+            self.set_mode('api', f"{self.failover_errors} consecutive upstream failures")
+            return
+        self.probes += 1
+        html_ok = probe_html_mode()
+        if failover and not html_ok:
+            logger.warning("[Impl] api mode keeps failing and html is unavailable; staying on api")
+        self.set_mode('html' if html_ok else 'api', "failover" if failover else "probe")
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.reprobe()
+            except Exception as e:
+                logger.error("[Impl] Probe failed: %s", e)
+            self._wake.wait(self.probe_interval)
+            self._wake.clear()
+
+    def start(self) -> None:
+        """Start probing in the background. JM_IMPL_MODE=html|api pins the mode instead."""
+        pinned = os.environ.get("JM_IMPL_MODE")
+        if pinned in ("html", "api"):
+            self.set_mode(pinned, "pinned by JM_IMPL_MODE")
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="jm-impl-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self._mode,
+            "probed": self._probed,
+            "generation": self.generation,
+            "switches": self.switches,
+            "probes": self.probes,
+            "consecutive_failures": self._failures,
+        }
+
+
+impl_manager = ImplModeManager(IMPL_PROBE_INTERVAL, IMPL_FAILOVER_ERRORS)
 
 
 def get_impl_mode() -> str:
-    """Get implementation mode (html or api), lazy-init with thread-safe double-checked locking."""
-    global _impl_mode
-    if _impl_mode is None:
-        with _impl_lock:
-            if _impl_mode is None:
-                os.environ['impl'] = 'html'
-                testClient = jmcomic.JmHtmlClient(
-                    postman=jmcomic.JmModuleConfig.new_postman(),
-                    domain_list=['18comic.vip'],
-                    retry_times=1
-                )
+    """Current implementation mode (html or api). Never blocks; 'api' until the first probe finishes."""
+    return impl_manager.mode
+
+
+# --- Upstream circuit breakers and retry budget ---
+BREAKER_FAILURES = int(os.environ.get("JM_BREAKER_FAILURES", "5"))           # consecutive failures that open it
+BREAKER_RESET_SECONDS = float(os.environ.get("JM_BREAKER_RESET_SECONDS", "30"))  # open -> half-open after this
+RETRY_BUDGET_RATIO = float(os.environ.get("JM_RETRY_BUDGET_RATIO", "0.2"))    # retries per upstream request
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get("JM_RETRY_BUDGET_MIN_PER_SECOND", "1"))
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling upstream while an operation's breaker is open."""
+
+    def __init__(self, operation: str, retry_after: float):
+        super().__init__(f"{operation} upstream unavailable, retry in {retry_after:.0f}s")
+        self.operation = operation
+        self.retry_after = retry_after
+
+
+class RetryBudgetExhausted(jmcomic.RequestRetryAllFailException):
+    """Raised from before_retry when the client's retry budget is spent; maps to 504 like other retry failures."""
+
+
+class CircuitBreaker:
+    """
+    closed -> open after failure_threshold consecutive upstream failures; open fails
+    fast for reset_timeout; then half-open lets one probe call through, which closes
+    the breaker on success or re-opens it on failure.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until a probe is allowed if calls would currently be rejected, else None."""
+        with self._lock:
+            if self.state == "closed":
+                return None
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            return 1.0 if self._probing else None
+
+    def _before_call(self) -> bool:
+        """Admit or reject a call; True if it is the half-open probe."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                self.state = "half_open"
+                self._probing = True
+                return True
+            self.rejected += 1
+            raise CircuitOpen(self.name, max(remaining, 1.0))
+
+    def _after_call(self, probe: bool, failed: bool) -> None:
+        with self._lock:
+            if probe:
+                self._probing = False
+            if not failed:
+                self._failures = 0
+                if self.state != "closed":
+                    logger.info("[Breaker] %s closed", self.name)
+                self.state = "closed"
+                return
+            self._failures += 1
+            if probe or self._failures >= self.failure_threshold:
+                if self.state == "closed":
+                    self.opened += 1
+                    logger.warning("[Breaker] %s opened after %d failures", self.name, self._failures)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs) -> Any:
+        probe = self._before_call()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            failed = _is_upstream_failure(e)
+            if failed:
+                upstream_errors.inc((self.name, type(e).__name__))
+            self._observe(time.perf_counter() - start)
+            self._after_call(probe, failed=failed)
+            raise
+        except BaseException:
+            self._after_call(probe, failed=False)
+            raise
+        self._observe(time.perf_counter() - start)
+        self._after_call(probe, failed=False)
+        return result
+
+    def _observe(self, elapsed: float) -> None:
+        upstream_latency.observe((self.name,), elapsed)
+        record_phase("upstream", elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self._failures, "opened": self.opened, "rejected": self.rejected}
+
+
+class RetryBudget:
+    """
+    Cap on retries: every upstream request deposits `ratio` tokens and
+    min_per_second tokens accrue over time; each retry spends one. During an outage
+    retries stop once the budget is spent instead of multiplying upstream load.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float = 100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.spent = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.spent += 1
+                return True
+            self.exhausted += 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tokens": round(self._tokens, 2), "spent": self.spent, "exhausted": self.exhausted}
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND)
+# Album downloads and streams retry images on their own budget, so a flaky download can't starve metadata calls
+download_retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND)
+breakers: Dict[str, CircuitBreaker] = {
+    name: CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET_SECONDS)
+    for name in ("search", "detail", "ranking", "comments", "download")
+}
+
+
+def guarded(operation: str):
+    """Decorator: run a blocking upstream fetcher through the operation's circuit breaker."""
+    breaker = breakers[operation]
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return breaker.call(func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def install_retry_budget(client: jmcomic.JmcomicClient,
+                         budget: Optional[RetryBudget] = None) -> jmcomic.JmcomicClient:
+    """Hook the client's before_retry so every retry must be paid for from budget (default retry_budget)."""
+    budget = retry_budget if budget is None else budget
+    original = client.before_retry
+
+    def before_retry(e, kwargs, retry_count, url):
+        if not budget.try_spend():
+            raise RetryBudgetExhausted(f"重试预算耗尽: {e}", {})
+        original(e, kwargs, retry_count, url)
+
+    client.before_retry = before_retry
+    return client
+
+
+# --- Latency-aware domain selection ---
+DOMAIN_PROBE_INTERVAL = int(os.environ.get("JM_DOMAIN_PROBE_INTERVAL", "300"))  # seconds between probe rounds
+DOMAIN_EWMA_ALPHA = 0.3
+DOMAIN_UNHEALTHY_ERROR_RATE = 0.5
+
+
+class _DomainStats:
+    __slots__ = ("latency", "error_rate", "samples", "last_seen")
+
+    def __init__(self):
+        self.latency: Optional[float] = None  # EWMA seconds of successful requests
+        self.error_rate = 0.0                 # EWMA of 0/1 outcomes
+        self.samples = 0
+        self.last_seen = 0.0
+
+
+class DomainSelector:
+    """
+    Tracks EWMA latency and error rate per upstream domain, from real traffic
+    (through each client's domain_retry_strategy) and from periodic probes, and
+    tries a client's domains fastest-healthy-first.
+    """
+
+    def __init__(self, alpha: float = DOMAIN_EWMA_ALPHA, unhealthy_error_rate: float = DOMAIN_UNHEALTHY_ERROR_RATE):
+        self.alpha = alpha
+        self.unhealthy_error_rate = unhealthy_error_rate
+        self._stats: Dict[str, _DomainStats] = {}
+        self._lock = threading.Lock()
+
+    def register(self, domains: List[str]) -> None:
+        with self._lock:
+            for domain in domains:
+                self._stats.setdefault(domain, _DomainStats())
+
+    def record(self, domain: str, latency: Optional[float]) -> None:
+        """Record one request outcome; latency None means it failed."""
+        with self._lock:
+            st = self._stats.setdefault(domain, _DomainStats())
+            a = self.alpha
+            st.error_rate = (1 - a) * st.error_rate + a * (latency is None)
+            if latency is not None:
+                st.latency = latency if st.latency is None else (1 - a) * st.latency + a * latency
+            st.samples += 1
+            st.last_seen = time.time()
+
+    def _key(self, domain: str) -> Tuple[bool, float]:
+        st = self._stats.get(domain)
+        if st is None:
+            return False, float("inf")
+        # Unmeasured domains sort after measured healthy ones; probes will measure them
+        latency = st.latency if st.latency is not None else float("inf")
+        return st.error_rate >= self.unhealthy_error_rate, latency
+
+    def rank(self, domains: List[str]) -> List[str]:
+        """domains ordered healthy-before-unhealthy, then by latency (stable for ties)."""
+        with self._lock:
+            return sorted(domains, key=self._key)
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            ordered = sorted(self._stats, key=self._key)
+            return [{
+                "domain": domain,
+                "latency_ms": None if self._stats[domain].latency is None else round(self._stats[domain].latency * 1000, 1),
+                "error_rate": round(self._stats[domain].error_rate, 3),
+                "samples": self._stats[domain].samples,
+                "healthy": not self._key(domain)[0],
+                "last_seen": self._stats[domain].last_seen or None,
+            } for domain in ordered]
+
+    def request(self, client: jmcomic.JmcomicClient, request, url: str, is_image: bool, **kwargs):
+        """
+        domain_retry_strategy replacement for AbstractJmClient.request_with_retry: same
+        retries, before_retry and fallback, but domains in ranked order, each attempt timed.
+        Absolute URLs (images) keep their host and are retried without domain switching.
+        """
+        retry_errors = []
+        domains = self.rank(list(client.domain_list)) if url.startswith('/') else [None]
+        for domain in domains:
+            for retry_count in range(client.retry_times + 1):
+                attempt_kwargs = dict(kwargs)
+                if domain is not None:
+                    full_url = client.of_api_url(url, domain)
+                    client.update_request_with_specify_domain(attempt_kwargs, domain, is_image)
+                else:
+                    full_url = url
+                    if is_image:
+                        client.update_request_with_specify_domain(attempt_kwargs, None, is_image)
+                start = time.perf_counter()
                 try:
-                    testClient.search_site(search_query="胡桃")
-                    _impl_mode = 'html'
-                except jmcomic.JmcomicException as e:
-                    _impl_mode = 'api'
-                    error_msg = str(e)
-                    if error_msg[:36] == "请求失败，响应状态码为403，原因为: [ip地区禁止访问/爬虫被识别]":
-                        logger.warning("Jmcomic Error: %s", e)
-                        logger.warning("已为您更换到api方式，页码数可能会不可用")
-                    else:
-                        logger.warning("HTML模式初始化失败，切换到API模式: %s", e)
+                    resp = client.raise_if_resp_should_retry(request(full_url, **attempt_kwargs), is_image)
                 except Exception as e:
-                    _impl_mode = 'api'
-                    logger.warning("警告: HTML模式测试时发生意外错误，使用API模式: %s", e)
-                os.environ['impl'] = _impl_mode
-    return _impl_mode
+                    if domain is not None:
+                        self.record(domain, None)
+                    if client.retry_times == 0:
+                        raise
+                    client.before_retry(e, attempt_kwargs, retry_count, full_url)
+                    retry_errors.append({"domain": domain, "url": full_url, "retry": retry_count, "error": e})
+                    continue
+                if domain is not None:
+                    self.record(domain, time.perf_counter() - start)
+                return resp
+        return client.fallback(request, url, len(domains), 0, is_image, retry_errors=retry_errors, **kwargs)
+
+    def probe(self, postman, timeout: float = 5.0) -> int:
+        """Blocking: time a plain GET to every known domain. Returns the number probed."""
+        with self._lock:
+            domains = list(self._stats)
+        for domain in domains:
+            start = time.perf_counter()
+            try:
+                resp = postman.get(f"https://{domain}/", timeout=timeout)
+                ok = resp.status_code < 500
+            except Exception:
+                ok = False
+            self.record(domain, time.perf_counter() - start if ok else None)
+        return len(domains)
+
+
+domain_selector = DomainSelector()
+
+
+async def periodic_domain_probe(interval: int = DOMAIN_PROBE_INTERVAL):
+    """Keep idle or failed-over domains measured so they can win back traffic."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(domain_selector.probe, jmcomic.JmModuleConfig.new_postman())
+        except Exception as e:
+            logger.warning("[Domains] Probe round failed: %s", e)
+
+
+def instrument_client(client: jmcomic.JmcomicClient,
+                      budget: Optional[RetryBudget] = None) -> jmcomic.JmcomicClient:
+    """
+    Apply a retry budget (default retry_budget) and latency-aware domain routing to a
+    freshly built client. Each upstream request deposits into the budget once, however
+    many attempts it takes.
+    """
+    budget = retry_budget if budget is None else budget
+    selector = domain_selector
+    install_retry_budget(client, budget)
+    selector.register(list(client.domain_list))
+
+    def domain_retry_strategy(client, request, url, is_image, **kwargs):
+        budget.deposit()
+        return selector.request(client, request, url, is_image, **kwargs)
 
+    client.domain_retry_strategy = domain_retry_strategy  # called as strategy(client, request, url, ...)
+    return client
 
-# Client connection pool — reuse client instead of creating new each time
-_client_cache: Optional[jmcomic.JmcomicClient] = None
-_client_lock = __import__('threading').Lock()
 
+# --- Upstream client pool (checkout/return; each client has its own postman session) ---
+METADATA_WORKERS = int(os.environ.get("JM_METADATA_WORKERS", "16"))  # search / info / rank / comments
+MEDIA_WORKERS = int(os.environ.get("JM_MEDIA_WORKERS", "8"))         # cover downloads and resizing
+DOWNLOAD_WORKERS = int(os.environ.get("JM_DOWNLOAD_WORKERS", "4"))   # album zips and streamed albums
+# Every metadata worker holds one pooled client while it calls upstream, so the pool defaults to one per worker
+CLIENT_POOL_SIZE = int(os.environ.get("JM_CLIENT_POOL_SIZE", str(METADATA_WORKERS)))
+if CLIENT_POOL_SIZE < METADATA_WORKERS:
+    logger.warning("JM_CLIENT_POOL_SIZE=%d is below JM_METADATA_WORKERS=%d: metadata workers will queue for clients",
+                   CLIENT_POOL_SIZE, METADATA_WORKERS)
+CLIENT_MAX_ERRORS = int(os.environ.get("JM_CLIENT_MAX_ERRORS", "3"))       # consecutive failures before recycling
+CLIENT_MAX_AGE = float(os.environ.get("JM_CLIENT_MAX_AGE", "3600"))        # seconds before a client is rebuilt
+CLIENT_CHECKOUT_TIMEOUT = float(os.environ.get("JM_CLIENT_CHECKOUT_TIMEOUT", "30"))
 
-def get_jm_client() -> jmcomic.JmcomicClient:
-    """Get shared JmComic client instance (thread-safe)."""
-    global _client_cache
-    if _client_cache is None:
-        with _client_lock:
-            if _client_cache is None:
-                get_impl_mode()  # ensure impl is set
-                _client_cache = jmcomic.JmOption.default().new_jm_client()
-    return _client_cache
+
+class ClientPoolExhausted(Exception):
+    """No client became free within the checkout timeout."""
+
+
+class _PooledClient:
+    __slots__ = ("client", "generation", "created_at", "errors", "uses")
+
+    def __init__(self, client: jmcomic.JmcomicClient, generation: int):
+        self.client = client
+        self.generation = generation
+        self.created_at = time.monotonic()
+        self.errors = 0
+        self.uses = 0
+
+
+class ClientPool:
+    """
+    Up to `size` clients built lazily by factory and handed out one caller at a time.
+    A client is health-checked on checkout and return and rebuilt when it is from an
+    older generation (reset() after an impl switch), older than max_age, or has failed
+    max_errors times in a row. reset() may also swap the factory, so a new generation
+    is always built by the factory that started it.
+    """
+
+    def __init__(self, factory, size: int, max_errors: int = CLIENT_MAX_ERRORS,
+                 max_age: float = CLIENT_MAX_AGE, checkout_timeout: float = CLIENT_CHECKOUT_TIMEOUT):
+        self._factory = factory
+        self.size = size
+        self.max_errors = max_errors
+        self.max_age = max_age
+        self.checkout_timeout = checkout_timeout
+        self._idle: List[_PooledClient] = []
+        self._created = 0  # clients alive: idle + checked out
+        self._cond = threading.Condition()
+        self.generation = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.recycled = 0
+        self.errors = 0
+
+    def _healthy(self, pooled: _PooledClient) -> bool:
+        return (pooled.generation == self.generation
+                and pooled.errors < self.max_errors
+                and time.monotonic() - pooled.created_at < self.max_age)
+
+    def _discard(self, pooled: _PooledClient) -> None:
+        """Caller holds the lock."""
+        self._created -= 1
+        self.recycled += 1
+        self._cond.notify()
+
+    def _checkout(self) -> _PooledClient:
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            waited = False
+            while True:
+                while self._idle:
+                    pooled = self._idle.pop()  # LIFO keeps the warmest sessions busy
+                    if self._healthy(pooled):
+                        break
+                    self._discard(pooled)
+                else:
+                    pooled = None
+                if pooled is not None or self._created < self.size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ClientPoolExhausted(f"no upstream client free after {self.checkout_timeout:.0f}s")
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                start = time.monotonic()
+                self._cond.wait(remaining)
+                self.wait_seconds += time.monotonic() - start
+            self.checkouts += 1
+            if pooled is not None:
+                pooled.uses += 1
+                return pooled
+            self._created += 1
+            generation, factory = self.generation, self._factory
+        try:
+            pooled = _PooledClient(factory(), generation)  # build outside the lock
+        except BaseException:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+        pooled.uses += 1
+        return pooled
+
+    def _checkin(self, pooled: _PooledClient) -> None:
+        with self._cond:
+            if self._healthy(pooled):
+                self._idle.append(pooled)
+                self._cond.notify()
+            else:
+                self._discard(pooled)
+
+    @contextmanager
+    def client(self) -> Iterator[jmcomic.JmcomicClient]:
+        """Check a client out for the duration of the block; upstream failures count toward recycling it."""
+        pooled = self._checkout()
+        try:
+            yield pooled.client
+        except Exception as e:
+            if _is_upstream_failure(e):
+                pooled.errors += 1
+                self.errors += 1
+            raise
+        else:
+            pooled.errors = 0
+        finally:
+            self._checkin(pooled)
+
+    def reset(self, factory=None) -> None:
+        """
+        Start a new generation, built by factory if given: idle clients are dropped
+        now, checked-out ones when returned.
+        """
+        with self._cond:
+            if factory is not None:
+                self._factory = factory
+            self.generation += 1
+            for pooled in self._idle:
+                self._discard(pooled)
+            self._idle.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "in_use": self._created - len(self._idle),
+                "generation": self.generation,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "recycled": self.recycled,
+                "errors": self.errors,
+            }
+
+
+# Builds from the current impl's info option; _rebuild_clients swaps in a factory pinned to the new impl
+jm_client_pool = ClientPool(lambda: instrument_client(get_info_option().new_jm_client()), CLIENT_POOL_SIZE)
+
+
+def jm_client():
+    """Context manager: borrow a metadata client from jm_client_pool."""
+    return jm_client_pool.client()
 
 
 # --- Option object caching (avoids repeated YAML parsing) ---
@@ -201,16 +1327,52 @@ def get_download_option() -> jmcomic.JmOption:
     return _download_option_cache
 
 
+def new_download_client() -> jmcomic.JmcomicClient:
+    """Build an instrumented client from the download option, owned by one download or stream."""
+    return instrument_client(get_download_option().new_jm_client(), download_retry_budget)
+
+
 def get_info_option() -> jmcomic.JmOption:
     """Get cached info option object for current impl mode (thread-safe)."""
     impl = get_impl_mode()
-    if impl not in _info_option_cache:
+    option = _info_option_cache.get(impl)  # single lookup: the dict may be swapped by _rebuild_clients
+    if option is None:
         with _info_option_lock:
-            if impl not in _info_option_cache:
-                _info_option_cache[impl] = jmcomic.create_option_by_str(
-                    _base_option_yaml(impl, FILE_PATH)
-                )
-    return _info_option_cache[impl]
+            option = _info_option_cache.get(impl)
+            if option is None:
+                option = jmcomic.create_option_by_str(_base_option_yaml(impl, FILE_PATH))
+                _info_option_cache[impl] = option
+    return option
+
+
+_cover_client_cache: Optional[jmcomic.JmcomicClient] = None
+_cover_client_lock = threading.Lock()
+
+
+def get_cover_client() -> jmcomic.JmcomicClient:
+    """Shared client for cover downloads, built once from the info option."""
+    global _cover_client_cache
+    if _cover_client_cache is None:
+        with _cover_client_lock:
+            if _cover_client_cache is None:
+                _cover_client_cache = instrument_client(get_info_option().new_jm_client())
+    return _cover_client_cache
+
+
+def _rebuild_clients(impl: str) -> None:
+    """
+    Build the info option and cover client for impl, then swap them in and start a
+    new client-pool generation together, so no request mixes objects from before and
+    after a switch. Pooled clients are rebuilt lazily from the new option as they are
+    checked out, even while impl_manager.mode still reports the old impl.
+    """
+    global _info_option_cache, _cover_client_cache
+    info_option = jmcomic.create_option_by_str(_base_option_yaml(impl, FILE_PATH))
+    cover_client = instrument_client(info_option.new_jm_client())
+    with _info_option_lock, _cover_client_lock:
+        _info_option_cache = {impl: info_option}
+        _cover_client_cache = cover_client
+        jm_client_pool.reset(lambda: instrument_client(info_option.new_jm_client()))
 
 
 # --- Path safety helper ---
@@ -232,62 +1394,541 @@ def safe_file_path(base_dir: Path, filename: str) -> Optional[Path]:
         return None
 
 
-# --- Simple in-memory cache with TTL, max-size eviction, and cleanup ---
+def _encode_value(value: Any) -> Optional[bytes]:
+    """Compact UTF-8 JSON encoding of a cached value, or None if it isn't JSON-serializable."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:  # e.g. ints beyond 64 bits, which json still handles
+            pass
+    try:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+    except (TypeError, ValueError):
+        return None
+
+
+def _decode_value(payload: bytes) -> Any:
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+def json_response(value: Any, payload: Optional[bytes] = None) -> Response:
+    """
+    Raw JSON response from the bytes cached alongside value, or from value encoded once
+    here. Either way FastAPI's jsonable_encoder pass and json.dumps are skipped.
+    """
+    if payload is None:
+        payload = _encode_value(value)
+        if payload is None:
+            return JSONResponse(content=value)
+    return Response(payload, media_type="application/json")
+
+
+# --- Shared cross-worker cache backend (SQLite in WAL mode) ---
+class SqliteCacheBackend:
+    """
+    L2 cache shared by every worker process on the host.
+    Values are stored as JSON with a wall-clock expiry. Errors are logged and
+    treated as misses so a locked or broken database never fails a request.
+    Every call blocks on SQLite: use it from the thread pool, never on the event loop.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 20000, max_bytes: int = 256 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Per-thread connection; re-opened after fork so workers never share a handle."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.path), timeout=0.05, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " size INTEGER NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache (expires_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[Any, float, int]]:
+        """Return (value, age_seconds, payload_size), or None if missing or expired."""
+        hit = self.get_raw(namespace, key)
+        if hit is None:
+            return None
+        payload, age = hit
+        return _decode_value(payload), age, len(payload)
+
+    def get_raw(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        """Return (encoded JSON payload, age_seconds), or None if missing or expired."""
+        try:
+            row = self._connect().execute(
+                "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (namespace, key, time.time()),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.debug("[SharedCache] get failed: %s", e)
+            return None
+        if row is None:
+            return None
+        payload = row[0].encode() if isinstance(row[0], str) else row[0]
+        return payload, max(0.0, time.time() - row[1])
+
+    def set(self, namespace: str, key: str, value: Any, ttl_seconds: float, payload: Optional[bytes] = None) -> None:
+        """Store value for ttl_seconds. payload is its pre-encoded JSON, if the caller has it. Non-JSON values are skipped."""
+        if payload is None:
+            payload = _encode_value(value)
+            if payload is None:
+                return
+        now = time.time()
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, size, created_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, payload, len(payload), now, now + ttl_seconds),
+            )
+        except sqlite3.Error as e:
+            logger.debug("[SharedCache] set failed: %s", e)
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        """Drop expired rows, then the oldest rows beyond the entry and byte limits."""
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            " SELECT rowid FROM cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        conn.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            " SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY created_at DESC) AS running FROM cache)"
+            " WHERE running > ?)",
+            (self.max_bytes,),
+        )
+
+    def cleanup(self) -> int:
+        """Remove expired rows and enforce the entry/byte limits. Returns count of removed rows."""
+        try:
+            conn = self._connect()
+            before = conn.total_changes
+            self._prune(conn)
+            return conn.total_changes - before
+        except sqlite3.Error as e:
+            logger.debug("[SharedCache] cleanup failed: %s", e)
+            return 0
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        """Clear one namespace, or every namespace if None."""
+        try:
+            if namespace is None:
+                self._connect().execute("DELETE FROM cache")
+            else:
+                self._connect().execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+        except sqlite3.Error as e:
+            logger.debug("[SharedCache] clear failed: %s", e)
+
+
+# Set JM_SHARED_CACHE_DB to an empty string to keep caches process-local
+SHARED_CACHE_DB = os.environ.get("JM_SHARED_CACHE_DB", str(FILE_PATH / "shared_cache.sqlite3"))
+shared_cache_backend: Optional[SqliteCacheBackend] = SqliteCacheBackend(Path(SHARED_CACHE_DB)) if SHARED_CACHE_DB else None
+
+
+# --- In-memory LRU cache with TTL, entry/byte budgets, sharded locks and stats ---
+class _CacheShard:
+    """One independently locked LRU segment of a SimpleCache."""
+
+    __slots__ = ("entries", "lock", "bytes", "hits", "stale_hits", "misses", "evictions", "expirations")
+
+    def __init__(self):
+        # key -> (value, monotonic hard expiry, size in bytes, monotonic soft expiry, encoded JSON or None);
+        # order is recency
+        self.entries: "OrderedDict[str, Tuple[Any, float, int, float, Optional[bytes]]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
 class SimpleCache:
-    """Simple TTL cache with max-size eviction."""
+    """
+    TTL cache with true LRU eviction under an entry limit and an optional byte budget.
+    Keys are spread over `shards` independently locked segments so thread-pool workers
+    don't contend on one lock; limits are split evenly between shards.
+    With soft_ttl_seconds, entries older than the soft TTL are still served until
+    ttl_seconds (the hard TTL) but reported as stale by get_entry() so the caller
+    can refresh them in the background.
+    With a backend and namespace it acts as L1 in front of the shared L2 backend:
+    get()/get_entry() only read L1 and are safe on the event loop; load_shared()
+    and set() touch L2 and belong in the thread pool.
+    """
 
-    def __init__(self, ttl_seconds: int = 300, max_size: int = 1000):
-        self.cache: Dict[str, Tuple[Any, datetime]] = {}
-        self.ttl = timedelta(seconds=ttl_seconds)
+    def __init__(self, ttl_seconds: int = 300, max_size: int = 1000, max_bytes: Optional[int] = None,
+                 shards: int = 1, backend: Optional[SqliteCacheBackend] = None, namespace: Optional[str] = None,
+                 soft_ttl_seconds: Optional[int] = None):
+        self.ttl = float(ttl_seconds)
+        self.soft_ttl = float(soft_ttl_seconds) if soft_ttl_seconds is not None else self.ttl
         self.max_size = max_size
-        self.lock = __import__('threading').Lock()
+        self.max_bytes = max_bytes
+        self._shards = [_CacheShard() for _ in range(max(1, shards))]
+        self._shard_max_size = max(1, -(-max_size // len(self._shards)))
+        self._shard_max_bytes = max_bytes // len(self._shards) if max_bytes else None
+        self.backend = backend if namespace else None
+        self.namespace = namespace
+
+    def _shard(self, key: str) -> _CacheShard:
+        if len(self._shards) == 1:
+            return self._shards[0]
+        return self._shards[hash(key) % len(self._shards)]
 
     def get(self, key: str) -> Optional[Any]:
-        """Get cached value, return None if expired."""
-        with self.lock:
-            if key in self.cache:
-                value, expiry = self.cache[key]
-                if datetime.now() < expiry:
-                    return value
-                else:
-                    del self.cache[key]
-            return None
-
-    def set(self, key: str, value: Any) -> None:
-        """Set cached value with TTL. Evicts oldest entry if over max_size."""
-        with self.lock:
-            self.cache[key] = (value, datetime.now() + self.ttl)
-            if len(self.cache) > self.max_size:
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
+        """Get cached L1 value, return None if missing or expired."""
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key: str) -> Tuple[Optional[Any], bool]:
+        """Return (value, is_stale). value is None on miss; is_stale is True past the soft TTL."""
+        value, _, stale = self.get_encoded_entry(key)
+        return value, stale
+
+    def get_encoded_entry(self, key: str) -> Tuple[Optional[Any], Optional[bytes], bool]:
+        """Like get_entry, plus the value's encoded JSON (None if it wasn't encodable) for raw responses."""
+        with timed("cache"):
+            return self._get_local(key)
+
+    def _get_local(self, key: str) -> Tuple[Optional[Any], Optional[bytes], bool]:
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if now < entry[1]:
+                    shard.entries.move_to_end(key)
+                    if now < entry[3]:
+                        shard.hits += 1
+                        return entry[0], entry[4], False
+                    shard.stale_hits += 1
+                    return entry[0], entry[4], True
+                del shard.entries[key]
+                shard.bytes -= entry[2]
+                shard.expirations += 1
+            shard.misses += 1
+        return None, None, False
+
+    def load_shared(self, key: str, fresh_only: bool = False) -> Optional[Any]:
+        """
+        Look key up in the shared backend and promote a hit into L1. Blocking; run in the thread pool.
+        With fresh_only, entries past the soft TTL count as misses.
+        """
+        return self.load_shared_entry(key, fresh_only)[0]
+
+    def load_shared_entry(self, key: str, fresh_only: bool = False) -> Tuple[Optional[Any], Optional[bytes]]:
+        """load_shared plus the stored encoded JSON; (None, None) on a miss."""
+        if self.backend is None:
+            return None, None
+        with timed("cache"):
+            hit = self.backend.get_raw(self.namespace, key)
+        if hit is None:
+            return None, None
+        payload, age = hit
+        if fresh_only and age >= self.soft_ttl:
+            return None, None
+        value = _decode_value(payload)
+        # Promote to L1 with the remaining lifetime, not a fresh TTL; the stored bytes are reused as-is
+        now = time.monotonic()
+        self._set_local(key, value, now + self.ttl - age, now + self.soft_ttl - age, len(payload), payload)
+        return value, payload
+
+    def set(self, key: str, value: Any) -> Optional[bytes]:
+        """
+        Set cached value with TTL. Evicts least recently used entries while over budget.
+        The value is JSON-encoded once; the encoding sizes the entry, is kept for raw
+        responses on later hits, feeds the shared backend, and is returned so the
+        caller can answer the request that fetched it (None if not JSON-encodable).
+        """
+        payload = _encode_value(value)
+        # Size is the serialized JSON length (held in memory too), an approximation of the footprint
+        size = len(payload) if payload is not None else sys.getsizeof(value)
+        now = time.monotonic()
+        self._set_local(key, value, now + self.ttl, now + self.soft_ttl, size, payload)
+        if self.backend is not None and payload is not None:
+            self.backend.set(self.namespace, key, value, self.ttl, payload=payload)
+        return payload
+
+    def _set_local(self, key: str, value: Any, expiry: float, soft_expiry: float, size: int,
+                   payload: Optional[bytes] = None) -> None:
+        shard = self._shard(key)
+        with shard.lock:
+            old = shard.entries.pop(key, None)
+            if old is not None:
+                shard.bytes -= old[2]
+            if self._shard_max_bytes is not None and size > self._shard_max_bytes:
+                # Larger than the whole shard budget: caching it would flush everything else
+                return
+            shard.entries[key] = (value, expiry, size, soft_expiry, payload)
+            shard.bytes += size
+            while len(shard.entries) > self._shard_max_size or (
+                    self._shard_max_bytes is not None and shard.bytes > self._shard_max_bytes):
+                _, (_, _, evicted_size, _, _) = shard.entries.popitem(last=False)
+                shard.bytes -= evicted_size
+                shard.evictions += 1
+
+    def __contains__(self, key: str) -> bool:
+        """True if key holds an unexpired L1 entry (does not touch recency or stats)."""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            return entry is not None and time.monotonic() < entry[1]
+
+    def fresh_for(self, key: str) -> float:
+        """Seconds until key's L1 entry turns stale; 0 if missing or already stale. No stats/recency."""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                return 0.0
+            return max(0.0, min(entry[1], entry[3]) - time.monotonic())
+
+    def peek(self, key: str) -> Any:
+        """key's L1 value, or None if missing or expired. No stats/recency, no L2."""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self._shards)
 
     def cleanup(self) -> int:
         """Remove all expired entries. Returns count of removed entries."""
-        now = datetime.now()
+        now = time.monotonic()
         removed = 0
-        with self.lock:
-            expired_keys = [k for k, (_, exp) in self.cache.items() if exp <= now]
-            for k in expired_keys:
-                del self.cache[k]
-                removed += 1
+        for shard in self._shards:
+            with shard.lock:
+                expired_keys = [k for k, entry in shard.entries.items() if entry[1] <= now]
+                for k in expired_keys:
+                    shard.bytes -= shard.entries.pop(k)[2]
+                shard.expirations += len(expired_keys)
+            removed += len(expired_keys)
         return removed
 
     def clear(self) -> None:
-        """Clear all cache entries."""
-        with self.lock:
-            self.cache.clear()
+        """Clear all cache entries, including this namespace in the shared backend."""
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+                shard.bytes = 0
+        if self.backend is not None:
+            self.backend.clear(self.namespace)
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss/eviction/expiration counters and current entry/byte usage."""
+        totals = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                  "entries": 0, "bytes": 0}
+        for shard in self._shards:
+            with shard.lock:
+                totals["hits"] += shard.hits
+                totals["stale_hits"] += shard.stale_hits
+                totals["misses"] += shard.misses
+                totals["evictions"] += shard.evictions
+                totals["expirations"] += shard.expirations
+                totals["entries"] += len(shard.entries)
+                totals["bytes"] += shard.bytes
+        return totals
+
+
+# Cache instances (L1 per worker, L2 shared across workers when enabled)
+# search: 5 min
+search_cache = SimpleCache(ttl_seconds=300, max_size=500, max_bytes=16 * 1024 * 1024, shards=8,
+                           backend=shared_cache_backend, namespace="search")
+# ranking: fresh for 10 min, then served stale (with background refresh) for up to 1 h
+rank_cache = SimpleCache(ttl_seconds=3600, soft_ttl_seconds=600, max_size=100, max_bytes=4 * 1024 * 1024,
+                         backend=shared_cache_backend, namespace="rank")
+# album info: fresh for 10 min, then served stale (with background refresh) for up to 1 h
+album_info_cache = SimpleCache(ttl_seconds=3600, soft_ttl_seconds=600, max_size=1000, max_bytes=8 * 1024 * 1024,
+                               shards=8, backend=shared_cache_backend, namespace="album_info")
+# comments: 5 min
+comment_cache = SimpleCache(ttl_seconds=300, max_size=500, max_bytes=32 * 1024 * 1024, shards=8,
+                            backend=shared_cache_backend, namespace="comments")
+
+
+# --- Named executors (separate thread pools so bulk downloads can't starve interactive calls) ---
+# Thread counts are read with the client pool settings above, which are sized from METADATA_WORKERS
+
+
+class NamedExecutor(ThreadPoolExecutor):
+    """
+    Thread pool with queue-depth and wait-time counters. Submitted calls run in a
+    copy of the caller's context, as they would under run_in_threadpool.
+    """
 
+    def __init__(self, name: str, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"jm-{name}")
+        self.name = name
+        self.max_workers = max_workers
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.queue_wait_seconds = 0.0
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        context = contextvars.copy_context()
+        enqueued = time.monotonic()
+
+        def task():
+            waited = time.monotonic() - enqueued
+            with self._stats_lock:
+                self.queued -= 1
+                self.active += 1
+                self.queue_wait_seconds += waited
+            timing = context.get(request_timing)
+            if timing is not None:
+                record_phase("queue", waited, timing)
+            profile = context.get(request_profile)
+            if profile is not None:
+                profile.threads.add(threading.get_ident())
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.threads.discard(threading.get_ident())
+                with self._stats_lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        with self._stats_lock:
+            self.queued += 1
+            self.submitted += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = super().submit(task)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future) -> None:
+        if future.cancelled():  # cancelled while still queued: task() never ran
+            with self._stats_lock:
+                self.queued -= 1
+
+    async def run(self, func, *args, **kwargs) -> Any:
+        """Await func(*args, **kwargs) on this pool (the run_in_threadpool equivalent)."""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "max_workers": self.max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+            }
 
-# Cache instances
-search_cache = SimpleCache(ttl_seconds=300, max_size=500)        # search: 5 min
-rank_cache = SimpleCache(ttl_seconds=600, max_size=100)          # ranking: 10 min
-album_info_cache = SimpleCache(ttl_seconds=600, max_size=1000)   # album info: 10 min
-comment_cache = SimpleCache(ttl_seconds=300, max_size=500)       # comments: 5 min
+
+metadata_executor = NamedExecutor("metadata", METADATA_WORKERS)
+media_executor = NamedExecutor("media", MEDIA_WORKERS)
+download_executor = NamedExecutor("download", DOWNLOAD_WORKERS)
+executors: Dict[str, NamedExecutor] = {
+    e.name: e for e in (metadata_executor, media_executor, download_executor)
+}
+
+
+# --- Single-flight coalescing for upstream calls ---
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing a key into one thread-pool call.
+    Every waiter receives the same result, or the same exception.
+    """
+
+    def __init__(self, executor: Optional[ThreadPoolExecutor] = None):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._executor = executor  # None: Starlette's shared thread pool
+        self.calls = 0
+        self.merged = 0
+        self.errors = 0
+
+    def in_flight(self, key: str) -> bool:
+        """Return True if a call for key is currently running."""
+        return key in self._inflight
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: str, func, *args, **kwargs) -> Any:
+        """Run func(*args, **kwargs) in the thread pool, or join the in-flight call for key."""
+        future = self._inflight.get(key)
+        if future is None:
+            self.calls += 1
+            if self._executor is None:
+                future = asyncio.ensure_future(run_in_threadpool(func, *args, **kwargs))
+            else:
+                future = asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f, k=key: self._finish(k, f))
+            # shield: a cancelled waiter must not cancel the call shared by the others
+            return await asyncio.shield(future)
+        self.merged += 1
+        with timed("coalesced"):  # waiting on another request's call
+            return await asyncio.shield(future)
+
+    def _finish(self, key: str, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # Retrieve the exception so an unawaited failure is not reported as "never retrieved"
+        if not future.cancelled() and future.exception() is not None:
+            self.errors += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Return call/merge counters."""
+        return {
+            "calls": self.calls,
+            "merged": self.merged,
+            "errors": self.errors,
+            "in_flight": len(self._inflight),
+        }
 
 
-# --- Background cache cleanup + file deletion task ---
+# Shared by search, info, rank and comments; keys are the cache keys
+upstream_flight = SingleFlight(executor=metadata_executor)
+
+
+def _cache_through(cache: SimpleCache, key: str, func, *args,
+                   fresh_only: bool = False) -> Tuple[Any, Optional[bytes]]:
+    """
+    Body of an upstream flight, run in the leader's thread: check the shared L2
+    cache, otherwise fetch and store once, however many requests were merged.
+    Returns (value, encoded JSON), so the leader and every merged waiter respond
+    with the bytes encoded once by cache.set.
+    Background refreshes pass fresh_only so a stale L2 copy doesn't satisfy them,
+    while a value another worker already refreshed does.
+    """
+    value, payload = cache.load_shared_entry(key, fresh_only=fresh_only)
+    if value is not None:
+        return value, payload
+    try:
+        value = func(*args)
+    except Exception as e:
+        if _is_upstream_failure(e):
+            impl_manager.record_failure()
+        raise
+    impl_manager.record_success()
+    return value, cache.set(key, value)
+
+
+# --- Background cache cleanup task (file deletions run in deletion_scheduler's thread) ---
 async def periodic_cleanup(interval: int = 300):
-    """Periodically clean up expired cache entries and process scheduled deletions."""
+    """Periodically clean up expired cache entries."""
     while True:
         await asyncio.sleep(interval)
         total = (
@@ -296,9 +1937,10 @@ async def periodic_cleanup(interval: int = 300):
             + album_info_cache.cleanup()
             + comment_cache.cleanup()
         )
-        deleted = await run_in_threadpool(_process_deletions)
-        if total > 0 or deleted > 0:
-            logger.info("Cleanup: removed %d cache entries, deleted %d files", total, deleted)
+        if shared_cache_backend is not None:
+            total += await run_in_threadpool(shared_cache_backend.cleanup)
+        if total > 0:
+            logger.info("Cleanup: removed %d cache entries", total)
 
 
 # --- Pending tasks tracking (prevents GC and enables error tracking) ---
@@ -310,6 +1952,34 @@ def _remove_pending_task(task: asyncio.Task) -> None:
     _pending_tasks.discard(task)
 
 
+# --- Stale-while-revalidate background refresh ---
+_refreshing_keys: Set[str] = set()
+
+
+def refresh_in_background(cache: SimpleCache, key: str, func, *args) -> None:
+    """
+    Refresh a stale cache entry without blocking the caller.
+    At most one refresh per key runs at a time; it goes through upstream_flight,
+    so a concurrent miss for the same key shares the refresh call. A fresh value
+    written to the shared backend by another worker is reused instead of refetching.
+    """
+    if key in _refreshing_keys:
+        return
+    _refreshing_keys.add(key)
+
+    async def refresh():
+        try:
+            await upstream_flight.do(key, _cache_through, cache, key, func, *args, fresh_only=True)
+        except Exception as e:
+            logger.warning("[Cache] Background refresh failed for %s: %s", key, e)
+        finally:
+            _refreshing_keys.discard(key)
+
+    task = asyncio.create_task(refresh())
+    _pending_tasks.add(task)
+    task.add_done_callback(_remove_pending_task)
+
+
 # --- WebSocket connection manager ---
 class ConnectionManager:
     """Manage WebSocket connections with thread-safe send interface."""
@@ -338,11 +2008,59 @@ class ConnectionManager:
         else:
             logger.warning("[WebSocket] No connection for client %s, cannot send.", client_id)
 
+    async def send(self, client_id: str, message: dict) -> None:
+        """Send a JSON message to client and keep the connection open. Silently skips unknown clients."""
+        websocket = self.active_connections.get(client_id)
+        if websocket:
+            await websocket.send_json(message)
+
+    def disconnect(self, client_id: str, websocket: WebSocket) -> None:
+        """Forget a connection once its socket has closed (unless the client already reconnected)."""
+        if self.active_connections.get(client_id) is websocket:
+            del self.active_connections[client_id]
+
+    async def broadcast(self, client_ids: List[str], message: dict) -> None:
+        """Send the same intermediate message to several clients concurrently."""
+        results = await asyncio.gather(
+            *(self.send(client_id, message) for client_id in client_ids),
+            return_exceptions=True,
+        )
+        for client_id, result in zip(client_ids, results):
+            if isinstance(result, Exception):
+                logger.debug("[WebSocket] Failed to send progress to client %s: %s", client_id, result)
+
+    async def broadcast_and_close(self, client_ids: List[str], message: dict):
+        """Send the same final message to several clients concurrently and close their connections."""
+        results = await asyncio.gather(
+            *(self.send_and_close(client_id, message) for client_id in client_ids),
+            return_exceptions=True,
+        )
+        for client_id, result in zip(client_ids, results):
+            if isinstance(result, Exception):
+                logger.warning("[WebSocket] Failed to notify client %s: %s", client_id, result)
+
 
 manager = ConnectionManager()
 
 
 # --- Exception handling decorator for jmcomic errors ---
+def jmcomic_error_status(e: Exception) -> Tuple[int, str]:
+    """Map an exception from a jmcomic call to (HTTP status, detail)."""
+    if isinstance(e, HTTPException):
+        return e.status_code, e.detail
+    if isinstance(e, (CircuitOpen, ClientPoolExhausted)):
+        return 503, "上游服务暂时不可用，请稍后重试"
+    if isinstance(e, jmcomic.MissingAlbumPhotoException):
+        return 404, f"Album not found: id={e.error_jmid}"
+    if isinstance(e, jmcomic.JsonResolveFailException):
+        return 502, "JSON解析错误"
+    if isinstance(e, jmcomic.RequestRetryAllFailException):
+        return 504, "重试次数耗尽"
+    if isinstance(e, jmcomic.JmcomicException):
+        return 500, f"出现其他错误: {e}"
+    return 500, f"服务器内部错误: {type(e).__name__}"
+
+
 def handle_jmcomic_errors(func):
     """
     Decorator that catches jmcomic exceptions and raises appropriate HTTPException.
@@ -351,20 +2069,20 @@ def handle_jmcomic_errors(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         try:
-            return await func(*args, **kwargs)
-        except jmcomic.MissingAlbumPhotoException as e:
-            raise HTTPException(status_code=404, detail=f"Album not found: id={e.error_jmid}")
-        except jmcomic.JsonResolveFailException:
-            raise HTTPException(status_code=502, detail="JSON解析错误")
-        except jmcomic.RequestRetryAllFailException:
-            raise HTTPException(status_code=504, detail="重试次数耗尽")
-        except jmcomic.JmcomicException as e:
-            raise HTTPException(status_code=500, detail=f"出现其他错误: {e}")
+            result = await func(*args, **kwargs)
+            mark_handler_done()
+            return result
         except HTTPException:
             raise
+        except CircuitOpen as e:
+            status_code, detail = jmcomic_error_status(e)
+            raise HTTPException(status_code=status_code, detail=detail,
+                                headers={"Retry-After": str(math.ceil(e.retry_after))})
         except Exception as e:
-            logger.exception("Unexpected error in %s", func.__name__)
-            raise HTTPException(status_code=500, detail=f"服务器内部错误: {type(e).__name__}")
+            if not isinstance(e, jmcomic.JmcomicException):
+                logger.exception("Unexpected error in %s", func.__name__)
+            status_code, detail = jmcomic_error_status(e)
+            raise HTTPException(status_code=status_code, detail=detail)
     return wrapper
 
 
@@ -378,11 +2096,20 @@ class SearchTime(str, Enum):
 # --- Lifespan handler (replaces deprecated on_event) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Startup/shutdown lifecycle: start background cleanup task."""
-    cleanup_task = asyncio.create_task(periodic_cleanup())
-    _pending_tasks.add(cleanup_task)
+    """Startup/shutdown lifecycle: start background cleanup tasks (and the cache warmer if enabled)."""
+    deletion_scheduler.start()
+    impl_manager.start()
+    background = [asyncio.create_task(periodic_cleanup()), asyncio.create_task(periodic_domain_probe())]
+    if CACHE_WARMER_ENABLED:
+        background.append(asyncio.create_task(cache_warmer.run()))
+    if SEARCH_PREFETCH_ENABLED:
+        background.append(asyncio.create_task(search_prefetcher.run()))
+    _pending_tasks.update(background)
     yield
-    cleanup_task.cancel()
+    for task in background:
+        task.cancel()
+    await run_in_threadpool(deletion_scheduler.stop)
+    impl_manager.stop()
 
 
 # --- Create app with lifespan ---
@@ -395,28 +2122,347 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ServerTimingMiddleware)
 
 
 # --- WebSocket route ---
 @app.websocket("/ws/notifications/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocket endpoint for real-time download notifications."""
+    """WebSocket endpoint for real-time download progress and notifications."""
     await manager.connect(client_id, websocket)
     try:
-        await websocket.wait_closed()
+        # Keep the socket open until the client leaves or send_and_close() closes it
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
     except Exception:
         pass
+    finally:
+        manager.disconnect(client_id, websocket)
+
+
+# --- On-disk zip artifact store (album_id index, LRU eviction under a disk quota) ---
+class ArtifactStore:
+    """
+    Index of finished album zips in base_dir, keyed by album_id with title, size and last access.
+    The index is a JSON file replaced atomically and re-read when another worker changed it,
+    so all workers on the host share it (best effort: concurrent writers may drop an access time).
+    """
+
+    def __init__(self, base_dir: Path, index_path: Path, quota_bytes: int):
+        self.base_dir = base_dir
+        self.index_path = index_path
+        self.quota_bytes = quota_bytes
+        self._entries: Dict[str, dict] = {}
+        self._mtime_ns: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _reload(self) -> None:
+        """Re-read the index if the file changed since we last saw it. Caller holds the lock."""
+        try:
+            mtime_ns = self.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._entries, self._mtime_ns = {}, None
+            return
+        if mtime_ns == self._mtime_ns:
+            return
+        try:
+            self._entries = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning("[Artifacts] Unreadable index %s, starting empty: %s", self.index_path, e)
+            self._entries = {}
+        self._mtime_ns = mtime_ns
+
+    def _save(self) -> None:
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.index_path)
+        self._mtime_ns = self.index_path.stat().st_mtime_ns
+
+    def _zip_path(self, entry: dict) -> Path:
+        return self.base_dir / f"{entry['file_name']}.zip"
+
+    def lookup(self, album_id: int) -> Optional[dict]:
+        """Return the stored entry for album_id and mark it used, or None if absent or deleted from disk."""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(str(album_id))
+            if entry is None:
+                return None
+            if not self._zip_path(entry).is_file():
+                del self._entries[str(album_id)]
+                self._save()
+                return None
+            entry["last_access"] = time.time()
+            self._save()
+            return dict(entry)
+
+    def add(self, album_id: int, file_name: str) -> None:
+        """Record a finished zip, then evict least recently used zips while over quota."""
+        with self._lock:
+            self._reload()
+            try:
+                size = (self.base_dir / f"{file_name}.zip").stat().st_size
+            except OSError:
+                return
+            self._entries[str(album_id)] = {
+                "album_id": album_id, "file_name": file_name, "size": size, "last_access": time.time(),
+            }
+            self._evict(keep=str(album_id))
+            self._save()
+
+    def touch_file(self, file_name: str) -> None:
+        """Mark the zip with this title as used (called when it is downloaded)."""
+        with self._lock:
+            self._reload()
+            for entry in self._entries.values():
+                if entry["file_name"] == file_name:
+                    entry["last_access"] = time.time()
+                    self._save()
+                    return
+
+    def evict_bytes(self, nbytes: int) -> int:
+        """Evict least recently used zips until nbytes are freed (disk pressure). Returns bytes freed."""
+        with self._lock:
+            self._reload()
+            total = sum(entry["size"] for entry in self._entries.values())
+            freed = self._evict(target_bytes=max(0, total - nbytes))
+            if freed:
+                self._save()
+            return freed
+
+    def _evict(self, keep: Optional[str] = None, target_bytes: Optional[int] = None) -> int:
+        """Evict LRU zips until the total is within target_bytes (default: the quota). Returns bytes freed."""
+        target = self.quota_bytes if target_bytes is None else target_bytes
+        total = sum(entry["size"] for entry in self._entries.values())
+        freed = 0
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]["last_access"]):
+            if total <= target:
+                break
+            if key == keep:
+                continue
+            try:
+                self._zip_path(entry).unlink(missing_ok=True)
+                logger.info("[Artifacts] Evicted %s (%d bytes)", entry["file_name"], entry["size"])
+            except OSError as e:
+                logger.error("[Artifacts] Failed to evict %s: %s", entry["file_name"], e)
+                continue
+            total -= entry["size"]
+            freed += entry["size"]
+            del self._entries[key]
+        return freed
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            self._reload()
+            return sum(entry["size"] for entry in self._entries.values())
+
+
+ARTIFACT_QUOTA_BYTES = int(os.environ.get("JM_ARTIFACT_QUOTA_BYTES", str(5 * 1024 ** 3)))  # default 5 GiB
+artifact_store = ArtifactStore(FILE_PATH, FILE_PATH / "artifacts.json", ARTIFACT_QUOTA_BYTES)
+
+
+# --- Download job registry (one running job per album, many subscribed clients) ---
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JM_JOB_PROGRESS_INTERVAL", "0.5"))  # seconds between progress events
+JOB_HISTORY_SIZE = 500  # finished jobs kept for GET /v1/jobs/{job_id}
+
+
+class DownloadJob:
+    """An album download, its progress counters, and the clients waiting for its result."""
+
+    def __init__(self, album_id: int):
+        self.job_id = uuid.uuid4().hex
+        self.album_id = album_id
+        self.client_ids: List[str] = []
+        self.status = "queued"  # queued -> running -> zipping -> done | error
+        self.photos_done = 0
+        self.photos_total = 0
+        self.images_done = 0
+        self.images_total = 0
+        self.bytes = 0
+        self.throughput_bps = 0.0
+        self.file_name: Optional[str] = None
+        self.message: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._last_emit = 0.0
+        self._last_emit_bytes = 0
+
+    def update(self, **fields) -> None:
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def add(self, **increments) -> None:
+        """Increment progress counters (called concurrently from download threads)."""
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def should_emit(self, force: bool = False) -> bool:
+        """Throttle progress events to one per JOB_PROGRESS_INTERVAL; also updates throughput."""
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._last_emit
+            if not force and elapsed < JOB_PROGRESS_INTERVAL:
+                return False
+            if self._last_emit:
+                self.throughput_bps = (self.bytes - self._last_emit_bytes) / max(elapsed, 1e-6)
+            self._last_emit = now
+            self._last_emit_bytes = self.bytes
+            return True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "album_id": self.album_id,
+                "status": self.status,
+                "photos_done": self.photos_done,
+                "photos_total": self.photos_total,
+                "images_done": self.images_done,
+                "images_total": self.images_total,
+                "bytes": self.bytes,
+                "throughput_bps": round(self.throughput_bps, 1),
+                "file_name": self.file_name,
+                "message": self.message,
+                "subscribers": len(self.client_ids),
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class DownloadJobRegistry:
+    """Thread-safe registry of running download jobs keyed by album_id, plus recent jobs by job_id."""
+
+    def __init__(self, history_size: int = JOB_HISTORY_SIZE):
+        self._jobs: Dict[int, DownloadJob] = {}
+        self._by_id: "OrderedDict[str, DownloadJob]" = OrderedDict()
+        self._history_size = history_size
+        self._lock = threading.Lock()
+
+    def attach(self, album_id: int, client_id: str) -> Tuple[DownloadJob, bool]:
+        """Subscribe client_id to the job for album_id, creating it if needed. Returns (job, created)."""
+        with self._lock:
+            job = self._jobs.get(album_id)
+            created = job is None
+            if created:
+                job = DownloadJob(album_id)
+                self._jobs[album_id] = job
+                self._by_id[job.job_id] = job
+                while len(self._by_id) > self._history_size:
+                    self._by_id.popitem(last=False)
+            if client_id not in job.client_ids:
+                job.client_ids.append(client_id)
+            return job, created
+
+    def get(self, album_id: int) -> Optional[DownloadJob]:
+        with self._lock:
+            return self._jobs.get(album_id)
+
+    def get_by_id(self, job_id: str) -> Optional[DownloadJob]:
+        """Look up a running or recently finished job."""
+        with self._lock:
+            return self._by_id.get(job_id)
+
+    def finish(self, album_id: int) -> List[str]:
+        """Remove the job and return its subscribers. Later requests start a new job."""
+        with self._lock:
+            job = self._jobs.pop(album_id, None)
+            return list(job.client_ids) if job else []
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+
+download_jobs = DownloadJobRegistry()
+
+
+def _notify_clients(client_ids: List[str], message: dict) -> None:
+    """Send a final WebSocket message to every client from a worker thread."""
+    if not manager.loop:
+        logger.error("[Task] No event loop recorded, cannot send WebSocket notification.")
+        return
+    future = asyncio.run_coroutine_threadsafe(
+        manager.broadcast_and_close(client_ids, message), manager.loop
+    )
+    try:
+        future.result(timeout=10)
+    except Exception as e:
+        logger.error("[Task] Failed to send message via main loop: %s", e)
+
+
+def _emit_progress(job: DownloadJob, force: bool = False) -> None:
+    """Push a throttled progress event to the job's clients without blocking the download thread."""
+    if not job.should_emit(force) or not manager.loop:
+        return
+    message = {**job.snapshot(), "status": "progress", "phase": job.status}
+    try:
+        asyncio.run_coroutine_threadsafe(manager.broadcast(list(job.client_ids), message), manager.loop)
+    except RuntimeError as e:  # loop closed
+        logger.debug("[Task] Could not emit progress for job %s: %s", job.job_id, e)
+
+
+class ProgressDownloader(jmcomic.JmDownloader):
+    """JmDownloader that reports photo/image progress to a DownloadJob."""
+
+    def __init__(self, option: jmcomic.JmOption, job: DownloadJob):
+        super().__init__(option)
+        self.job = job
+        instrument_client(self.client, download_retry_budget)
+
+    def before_album(self, album):
+        super().before_album(album)
+        self.job.update(photos_total=len(album))
+        _emit_progress(self.job, force=True)
+
+    def before_photo(self, photo):
+        super().before_photo(photo)
+        self.job.add(images_total=len(photo))
+
+    def after_image(self, image, img_save_path):
+        super().after_image(image, img_save_path)
+        try:
+            size = os.path.getsize(img_save_path)
+        except OSError:
+            size = 0
+        self.job.add(images_done=1, bytes=size)
+        _emit_progress(self.job)
+
+    def after_photo(self, photo):
+        super().after_photo(photo)
+        self.job.add(photos_done=1)
+        _emit_progress(self.job)
+
+    def after_album(self, album):
+        # The zip plugin runs inside after_album
+        self.job.update(status="zipping")
+        _emit_progress(self.job, force=True)
+        super().after_album(album)
 
 
 # --- Blocking task handler (runs in thread pool) ---
-def sync_download_and_zip_task(album_id: int, client_id: str):
-    """Synchronous download & zip logic. Notifies client via WebSocket on completion."""
+def sync_download_and_zip_task(album_id: int):
+    """
+    Synchronous download & zip logic for the album's registered job.
+    Streams throttled progress events while running and notifies every client
+    subscribed to the job via WebSocket on completion.
+    """
     logger.info("[Task] Starting blocking download for album %s ...", album_id)
+    job = download_jobs.get(album_id) or DownloadJob(album_id)
+    job.update(status="running", started_at=time.time())
 
     try:
         option = get_download_option()
-        jmcomic.JmModuleConfig.CLASS_DOWNLOADER = jmcomic.JmDownloader
-        album_list = jmcomic.download_album(album_id, option)
+        album_list = breakers["download"].call(
+            jmcomic.download_album, album_id, option, downloader=lambda opt: ProgressDownloader(opt, job)
+        )
 
         if not album_list:
             raise Exception("Album download failed or returned no results.")
@@ -426,6 +2472,7 @@ def sync_download_and_zip_task(album_id: int, client_id: str):
         zip_file_path = FILE_PATH / zip_file_name
 
         if zip_file_path.exists():
+            artifact_store.add(album_id, file_title)
             message = {
                 "status": "download_ready",
                 "file_name": file_title,
@@ -437,29 +2484,110 @@ def sync_download_and_zip_task(album_id: int, client_id: str):
                 "file_name": file_title,
                 "message": f"文件 '{file_title}' 未找到或处理失败。"
             }
-        if manager.loop:
-            future = asyncio.run_coroutine_threadsafe(
-                manager.send_and_close(client_id, message), manager.loop
-            )
-            try:
-                future.result(timeout=10)
-            except Exception as e:
-                logger.error("[Task] Failed to send message via main loop: %s", e)
-        else:
-            logger.error("[Task] No event loop recorded, cannot send WebSocket notification.")
     except Exception as e:
-        if manager.loop:
-            fut = asyncio.run_coroutine_threadsafe(
-                manager.send_and_close(
-                    client_id,
-                    {"status": "error", "file_name": "", "message": f"下载任务失败: {str(e)}"}
-                ),
-                manager.loop
-            )
+        message = {"status": "error", "file_name": "", "message": f"下载任务失败: {str(e)}"}
+    job.update(
+        status="done" if message["status"] == "download_ready" else "error",
+        file_name=message["file_name"] or None,
+        message=message["message"],
+        finished_at=time.time(),
+    )
+    _notify_clients(download_jobs.finish(album_id), {**message, "job_id": job.job_id})
+
+
+# --- Download scheduler (bounded concurrency, prioritized FIFO queue) ---
+class DownloadPriority(str, Enum):
+    high = "high"
+    normal = "normal"
+    low = "low"
+
+
+_PRIORITY_RANK = {DownloadPriority.high: 0, DownloadPriority.normal: 1, DownloadPriority.low: 2}
+
+
+class DownloadQueueFull(Exception):
+    """Raised when the download queue cannot admit another job."""
+
+
+class DownloadScheduler:
+    """
+    Run at most max_concurrent album downloads at once; queue the rest FIFO within
+    each priority class. Only used from the event loop thread, so no locking.
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 50):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._queue: List[List[int]] = []  # heap of [priority rank, seq, album_id]
+        self._queued: Dict[int, List[int]] = {}
+        self._running: Set[int] = set()
+        self._seq = count()
+        self.rejected = 0
+
+    def submit(self, album_id: int, priority: DownloadPriority = DownloadPriority.normal) -> int:
+        """Start or enqueue a download. Returns the queue position (0 = running)."""
+        if len(self._running) < self.max_concurrent and not self._queue:
+            self._start(album_id)
+            return 0
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise DownloadQueueFull(f"download queue is full ({self.max_queue} waiting)")
+        entry = [_PRIORITY_RANK[priority], next(self._seq), album_id]
+        heapq.heappush(self._queue, entry)
+        self._queued[album_id] = entry
+        return self.position(album_id)
+
+    def promote(self, album_id: int, priority: DownloadPriority) -> None:
+        """
+        Raise a queued job's priority (e.g. when a high-priority client attaches to it).
+        The job joins the back of its new class, keeping FIFO order within each class.
+        """
+        entry = self._queued.get(album_id)
+        if entry is not None and _PRIORITY_RANK[priority] < entry[0]:
+            entry[0] = _PRIORITY_RANK[priority]
+            entry[1] = next(self._seq)
+            heapq.heapify(self._queue)
+
+    def position(self, album_id: int) -> Optional[int]:
+        """0 if running, 1-based place in line if queued, None if unknown."""
+        if album_id in self._running:
+            return 0
+        entry = self._queued.get(album_id)
+        if entry is None:
+            return None
+        return sum(1 for other in self._queue if other < entry) + 1
+
+    def _start(self, album_id: int) -> None:
+        self._running.add(album_id)
+        task = asyncio.create_task(download_executor.run(sync_download_and_zip_task, album_id))
+        _pending_tasks.add(task)
+        task.add_done_callback(_remove_pending_task)
+        task.add_done_callback(lambda t, aid=album_id: self._on_done(aid, t))
+
+    def _on_done(self, album_id: int, task: asyncio.Task) -> None:
+        self._running.discard(album_id)
+        if task.cancelled():
+            # Event loop teardown: don't spawn new thread-pool jobs that would be orphaned
+            return
+        if task.exception() is not None:
+            logger.error("[Scheduler] Download task for album %s crashed: %s", album_id, task.exception())
+        while self._queue and len(self._running) < self.max_concurrent:
+            _, _, next_album_id = heapq.heappop(self._queue)
+            del self._queued[next_album_id]
             try:
-                fut.result(timeout=10)
-            except Exception as ee:
-                logger.error("[Task] Failed to send error notification: %s", ee)
+                self._start(next_album_id)
+            except RuntimeError as e:  # event loop shutting down
+                logger.warning("[Scheduler] Could not start queued album %s: %s", next_album_id, e)
+                self._running.discard(next_album_id)
+                return
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": len(self._running), "queued": len(self._queue), "rejected": self.rejected}
+
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get("JM_DOWNLOAD_CONCURRENCY", "2"))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get("JM_DOWNLOAD_QUEUE_SIZE", "50"))
+download_scheduler = DownloadScheduler(max_concurrent=DOWNLOAD_CONCURRENCY, max_queue=DOWNLOAD_QUEUE_SIZE)
 
 
 # --- HTTP route: start album download ---
@@ -468,30 +2596,130 @@ async def start_album_download(album_id: int, request: Request):
     try:
         data = await request.json()
         client_id = data.get("client_id")
+        priority = data.get("priority", DownloadPriority.normal.value)
     except Exception:
         raise HTTPException(status_code=400, detail="Request body must be valid JSON containing 'client_id'.")
 
     if not client_id:
         raise HTTPException(status_code=400, detail="client_id is required")
+    try:
+        priority = DownloadPriority(priority)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="priority must be one of: high, normal, low")
+
+    stored = await run_in_threadpool(artifact_store.lookup, album_id)
+    if stored is not None:
+        file_title = stored["file_name"]
+        message = {
+            "status": "download_ready",
+            "file_name": file_title,
+            "message": f"文件 '{file_title}' 已完成处理，可以下载。"
+        }
+        logger.info("[Server] Album %s already stored as '%s', client=%s", album_id, file_title, client_id)
+        if client_id in manager.active_connections:
+            try:
+                await manager.send_and_close(client_id, message)
+            except Exception as e:
+                logger.warning("[WebSocket] Failed to notify client %s: %s", client_id, e)
+        return JSONResponse(status_code=200, content=message)
 
-    logger.info("[Server] Received download request: album=%s, client=%s. Starting in background...", album_id, client_id)
+    retry_after = breakers["download"].retry_after()
+    if retry_after is not None and download_jobs.get(album_id) is None:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(math.ceil(retry_after))},
+            content={"status": "error", "message": "上游服务暂时不可用，请稍后重试。"}
+        )
 
-    task = asyncio.create_task(run_in_threadpool(sync_download_and_zip_task, album_id, client_id))
-    _pending_tasks.add(task)
-    task.add_done_callback(_remove_pending_task)
+    job, created = download_jobs.attach(album_id, client_id)
+    if created:
+        try:
+            position = download_scheduler.submit(album_id, priority)
+        except DownloadQueueFull:
+            download_jobs.finish(album_id)
+            job.update(status="error", message="download queue full", finished_at=time.time())
+            logger.warning("[Server] Download queue full, rejected album=%s, client=%s", album_id, client_id)
+            return JSONResponse(
+                status_code=429,
+                headers={"Retry-After": "30"},
+                content={"status": "error", "message": "下载队列已满，请稍后重试。"}
+            )
+        logger.info("[Server] Received download request: album=%s, client=%s, priority=%s, position=%d",
+                    album_id, client_id, priority.value, position)
+    else:
+        download_scheduler.promote(album_id, priority)
+        position = download_scheduler.position(album_id) or 0
+        logger.info("[Server] Album %s already downloading, attached client %s (%d waiting)",
+                    album_id, client_id, len(job.client_ids))
 
     return JSONResponse(
         status_code=202,
         content={
             "status": "processing",
+            "job_id": job.job_id,
+            "queue_position": position,
             "message": "下载任务已在后台启动，请通过 WebSocket 监听 'download_ready' 通知。"
         }
     )
 
 
+# --- HTTP route: download job status ---
+@app.get("/v1/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Polling alternative to the WebSocket progress events; returns the same job state."""
+    job = download_jobs.get_by_id(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    state = job.snapshot()
+    if state["status"] == "queued":
+        state["queue_position"] = download_scheduler.position(job.album_id)
+    return state
+
+
+# --- Conditional / resumable file responses ---
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison (RFC 9110 13.1.2) of an If-None-Match list against our ETag."""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def _not_modified(request: Request, headers) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence; If-Modified-Since is ignored when it is present
+        return _etag_matches(if_none_match, headers["etag"])
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        return parsedate_to_datetime(headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+async def conditional_file_response(request: Request, path: Path, cache_control: str, **kwargs) -> Response:
+    """
+    FileResponse plus 304 handling. Starlette already serves Range/multi-range (206)
+    and honours If-Range against the ETag/Last-Modified it derives from the file stat;
+    it does not answer If-None-Match / If-Modified-Since, which is done here.
+    """
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:  # expired between the caller's exists() check and now
+        raise HTTPException(status_code=404, detail="File not found or has expired.")
+    response = FileResponse(path, stat_result=stat_result, headers={"Cache-Control": cache_control}, **kwargs)
+    if _not_modified(request, response.headers):
+        return Response(status_code=304, headers={
+            key: response.headers[key] for key in ("etag", "last-modified", "cache-control")
+        })
+    return response
+
+
 # --- HTTP route: download file ---
 @app.get("/v1/download/{file_name}")
-async def download_file(file_name: str):
+async def download_file(file_name: str, request: Request):
     """
     Client receives notification and downloads the zip file through this route.
     Uses safe_file_path helper for path-traversal protection.
@@ -504,7 +2732,10 @@ async def download_file(file_name: str):
         )
 
     if safe_path.exists() and safe_path.is_file():
-        return FileResponse(safe_path, filename=f"{file_name}.zip", media_type="application/zip")
+        await run_in_threadpool(artifact_store.touch_file, file_name)
+        return await conditional_file_response(
+            request, safe_path, "private, no-cache", filename=f"{file_name}.zip", media_type="application/zip"
+        )
 
     return JSONResponse(
         status_code=404,
@@ -512,6 +2743,174 @@ async def download_file(file_name: str):
     )
 
 
+# --- Streaming zip delivery (bytes flow while images are still downloading) ---
+STREAM_CONCURRENCY = int(os.environ.get("JM_STREAM_CONCURRENCY", "2"))     # simultaneous streamed albums
+STREAM_IMAGE_THREADS = int(os.environ.get("JM_STREAM_IMAGE_THREADS", "8"))  # image fetches per stream
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_QUEUE_CHUNKS = 16  # backpressure: chunks buffered ahead of a slow client
+_stream_slots = threading.BoundedSemaphore(STREAM_CONCURRENCY)  # taken with blocking=False, never waited on
+
+
+class StreamCancelled(Exception):
+    """Raised in the producer thread once the HTTP client has gone away."""
+
+
+class _ZipChunkWriter(io.RawIOBase):
+    """
+    Unseekable sink for zipfile.ZipFile: coalesces writes into chunks and hands
+    them to the event loop through a bounded asyncio.Queue, blocking when it is full.
+    """
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, cancelled: threading.Event):
+        super().__init__()
+        self._queue = queue
+        self._loop = loop
+        self._cancelled = cancelled
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self.flush_chunk()
+        return len(data)
+
+    def flush_chunk(self) -> None:
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def put(self, item) -> None:
+        if self._cancelled.is_set():
+            raise StreamCancelled()
+        future = asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop)
+        while True:
+            try:
+                future.result(timeout=1)
+                return
+            except FutureTimeoutError:
+                if self._cancelled.is_set():
+                    future.cancel()
+                    raise StreamCancelled()
+
+
+class _SlotStreamingResponse(StreamingResponse):
+    """StreamingResponse that gives back its stream slot however the response ends, even before body() starts."""
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()  # run body()'s cleanup now rather than at garbage collection
+            _stream_slots.release()
+
+
+def _fetch_image_bytes(client: jmcomic.JmcomicClient, image: jmcomic.JmImageDetail) -> bytes:
+    """Download one image and unscramble it in memory, like JmImageResp.transfer_to but without a file."""
+    resp = client.get_jm_image(image.download_url)
+    resp.require_success()
+    if image.is_gif:
+        return resp.content
+    num = jmcomic.JmImageTool.get_num_by_detail(image)
+    if num == 0:
+        return resp.content
+    buffer = io.BytesIO()
+    buffer.name = image.filename  # PIL picks the output format from the name
+    jmcomic.JmImageTool.decode_and_save(num, jmcomic.JmImageTool.open_image(resp.content), buffer)
+    return buffer.getvalue()
+
+
+def sync_stream_album_zip(album: jmcomic.JmAlbumDetail, writer: _ZipChunkWriter) -> None:
+    """
+    Write the album as a ZIP to writer in page order. Images are fetched by a small
+    pool a photo at a time and written as soon as each one (and all before it) is ready.
+    The stream owns its own download client, so it never holds a metadata pool slot.
+    """
+    breaker = breakers["download"]
+    client = new_download_client()
+    with ThreadPoolExecutor(max_workers=STREAM_IMAGE_THREADS, thread_name_prefix="jm-stream") as pool, \
+            zipfile.ZipFile(writer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for photo_index, photo in enumerate(album, start=1):
+            breaker.call(client.check_photo, photo)
+            futures = [pool.submit(breaker.call, _fetch_image_bytes, client, image) for image in photo]
+            try:
+                for image, future in zip(photo, futures):
+                    archive.writestr(f"{photo_index:03d}/{image.filename}", future.result())
+                    writer.flush_chunk()
+            finally:
+                for future in futures:
+                    future.cancel()
+    writer.flush_chunk()
+
+
+@app.get("/v1/stream/album/{album_id}")
+@handle_jmcomic_errors
+async def stream_album(album_id: int):
+    """
+    Stream the album as a chunked ZIP (stored, no compression) built while images download.
+    Nothing is written to disk; the zip is not kept, so prefer the WebSocket flow for repeat downloads.
+    """
+    if not _stream_slots.acquire(blocking=False):
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "30"},
+            content={"status": "error", "message": "同时进行的流式下载过多，请稍后重试。"}
+        )
+    # Fetch the detail before the response starts so a missing album is still a proper 404
+    try:
+        retry_after = breakers["download"].retry_after()
+        if retry_after is not None:
+            raise CircuitOpen("download", retry_after)
+        album: jmcomic.JmAlbumDetail = await metadata_executor.run(_fetch_album_detail, album_id)
+    except BaseException:
+        _stream_slots.release()
+        raise
+
+    async def body():
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        cancelled = threading.Event()
+        writer = _ZipChunkWriter(queue, loop, cancelled)
+
+        def produce():
+            try:
+                try:
+                    sync_stream_album_zip(album, writer)
+                    writer.put(None)
+                except StreamCancelled:
+                    raise
+                except Exception as e:
+                    logger.error("[Stream] Album %s failed mid-stream: %s", album_id, e)
+                    writer.put(e)
+            except StreamCancelled:
+                logger.info("[Stream] Client left, stopped streaming album %s", album_id)
+
+        producer = asyncio.ensure_future(download_executor.run(produce))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item  # aborts the response; the client sees a truncated zip
+                yield item
+        finally:
+            cancelled.set()
+            # Unblock a producer waiting on a full queue
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.shield(producer)
+
+    filename = quote(f"{album.title}.zip")
+    return _SlotStreamingResponse(
+        body(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"},
+    )
+
+
 def _serialize_comment(comment) -> dict:
     """Serialize a JmAlbumComment to a JSON-safe dict."""
     return {
@@ -536,6 +2935,138 @@ async def health():
     return {"status": "ok", "app": "jmcomic_server_api", "version": "1.0"}
 
 
+# --- HTTP route: upstream domain ranking ---
+@app.get("/v1/domains")
+async def domains():
+    """Known upstream domains in the order requests try them, with their EWMA latency and error rate."""
+    return {"status": "success", "domains": domain_selector.snapshot()}
+
+
+# --- HTTP route: upstream client pool usage ---
+@app.get("/v1/clients")
+async def clients():
+    """Client pool usage: built, idle and checked-out clients, checkout waits and recycles."""
+    return {"status": "success", "pool": jm_client_pool.stats()}
+
+
+# --- HTTP route: executor usage ---
+@app.get("/v1/executors")
+async def executor_stats():
+    """Per-executor worker count, running and queued calls, and time spent waiting in the queue."""
+    return {"status": "success", "executors": {name: e.stats() for name, e in executors.items()}}
+
+
+# --- HTTP route: Prometheus metrics ---
+TEMP_DIR_SCAN_INTERVAL = 30  # seconds; walking the temp dir on every scrape would cost more than the scrape
+_temp_dir_usage: List[float] = [0.0, 0]  # [monotonic time of last scan, bytes]
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def temp_dir_bytes() -> int:
+    """Bytes used under FILE_PATH, rescanned at most every TEMP_DIR_SCAN_INTERVAL seconds."""
+    now = time.monotonic()
+    if _temp_dir_usage[1] == 0 or now - _temp_dir_usage[0] >= TEMP_DIR_SCAN_INTERVAL:
+        _temp_dir_usage[:] = [now, _disk_size(FILE_PATH)]
+    return int(_temp_dir_usage[1])
+
+
+def render_metrics(temp_bytes: int) -> str:
+    """Collect every metric family into one exposition document."""
+    caches = {"search": search_cache, "album_info": album_info_cache, "rank": rank_cache, "comments": comment_cache}
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    pool_stats = {name: e.stats() for name, e in executors.items()}
+    client_stats = jm_client_pool.stats()
+    scheduler_stats = download_scheduler.stats()
+    lines: List[str] = []
+    lines += http_requests.render()
+    lines += http_latency.render()
+    lines += upstream_latency.render()
+    lines += upstream_errors.render()
+    for field, kind in (("hits", "counter"), ("stale_hits", "counter"), ("misses", "counter"),
+                        ("evictions", "counter"), ("expirations", "counter"), ("entries", "gauge"), ("bytes", "gauge")):
+        suffix = "_total" if kind == "counter" else ""
+        lines += metric_lines(f"jm_cache_{field}{suffix}", kind, f"In-memory cache {field.replace('_', ' ')}.",
+                              ("cache",), [((name,), st[field]) for name, st in cache_stats.items()])
+    lines += metric_lines("jm_breaker_state", "gauge", "Circuit breaker state (0 closed, 1 half-open, 2 open).",
+                          ("operation",), [((n,), _BREAKER_STATES.get(b.state, 0)) for n, b in breakers.items()])
+    lines += metric_lines("jm_breaker_rejected_total", "counter", "Calls rejected by an open circuit breaker.",
+                          ("operation",), [((n,), b.rejected) for n, b in breakers.items()])
+    breaker_stats = {name: b.stats() for name, b in breakers.items()}
+    lines += metric_lines("jm_breaker_consecutive_failures", "gauge", "Consecutive upstream failures per breaker.",
+                          ("operation",), [((n,), st["failures"]) for n, st in breaker_stats.items()])
+    lines += metric_lines("jm_breaker_opened_total", "counter", "Times a circuit breaker opened.",
+                          ("operation",), [((n,), st["opened"]) for n, st in breaker_stats.items()])
+    budget_stats = {"metadata": retry_budget.stats(), "download": download_retry_budget.stats()}
+    for name, field, kind, doc in (
+            ("jm_retry_budget_tokens", "tokens", "gauge", "Retries the budget can still pay for."),
+            ("jm_retry_budget_spent_total", "spent", "counter", "Retries paid for from the budget."),
+            ("jm_retry_budget_exhausted_total", "exhausted", "counter", "Retries refused by an empty budget.")):
+        lines += metric_lines(name, kind, doc, ("budget",), [((n,), st[field]) for n, st in budget_stats.items()])
+    impl_stats = impl_manager.stats()
+    lines += metric_lines("jm_impl_mode", "gauge", "Current implementation mode (1 for the active one).", ("mode",),
+                          [((mode,), int(impl_stats["mode"] == mode)) for mode in ("api", "html")])
+    lines += stats_metric_lines(impl_stats, (
+        ("jm_impl_switches_total", "switches", "counter", "Implementation mode switches."),
+        ("jm_impl_probes_total", "probes", "counter", "HTML-mode probes run."),
+        ("jm_impl_consecutive_failures", "consecutive_failures", "gauge", "Upstream failures since the last success.")))
+    for name, field, kind, doc in (
+            ("jm_executor_workers", "max_workers", "gauge", "Executor thread count."),
+            ("jm_executor_active", "active", "gauge", "Calls running on the executor."),
+            ("jm_executor_queued", "queued", "gauge", "Calls waiting for an executor thread."),
+            ("jm_executor_completed_total", "completed", "counter", "Calls finished by the executor."),
+            ("jm_executor_queue_wait_seconds_total", "queue_wait_seconds", "counter", "Time calls spent queued.")):
+        lines += metric_lines(name, kind, doc, ("executor",), [((n,), st[field]) for n, st in pool_stats.items()])
+    lines += metric_lines("jm_client_pool_clients", "gauge", "Upstream clients by state.", ("state",),
+                          [(("idle",), client_stats["idle"]), (("in_use",), client_stats["in_use"])])
+    lines += metric_lines("jm_client_pool_recycled_total", "counter", "Upstream clients rebuilt.", (),
+                          [((), client_stats["recycled"])])
+    lines += metric_lines("jm_websocket_connections", "gauge", "Open WebSocket connections.", (),
+                          [((), len(manager.active_connections))])
+    lines += metric_lines("jm_pending_tasks", "gauge", "Background asyncio tasks being tracked.", (),
+                          [((), len(_pending_tasks))])
+    lines += metric_lines("jm_downloads", "gauge", "Album download jobs by state.", ("state",),
+                          [(("running",), scheduler_stats["running"]), (("queued",), scheduler_stats["queued"])])
+    lines += stats_metric_lines(deletion_scheduler.stats(), (
+        ("jm_deletions_scheduled", "scheduled", "gauge", "Paths waiting for their deletion deadline."),
+        ("jm_deletions_total", "deleted", "counter", "Paths deleted at their deadline."),
+        ("jm_deletions_emergency_total", "emergency_deleted", "counter", "Paths deleted early on low disk space.")))
+    lines += metric_lines("jm_temp_dir_bytes", "gauge", "Bytes used by the temp directory.", (), [((), temp_bytes)])
+    cover_stats = cover_fetcher.stats()  # includes its single-flight counters
+    flight_stats = {"upstream": upstream_flight.stats(), "cover": cover_stats, "cover_variant": cover_variant_flight.stats()}
+    for name, field, kind, doc in (
+            ("jm_singleflight_calls_total", "calls", "counter", "Calls that ran (one per coalesced group)."),
+            ("jm_singleflight_merged_total", "merged", "counter", "Callers that joined an in-flight call."),
+            ("jm_singleflight_errors_total", "errors", "counter", "Calls that raised."),
+            ("jm_singleflight_in_flight", "in_flight", "gauge", "Calls running now.")):
+        lines += metric_lines(name, kind, doc, ("flight",), [((n,), st[field]) for n, st in flight_stats.items()])
+    lines += stats_metric_lines(search_prefetcher.stats(), (
+        ("jm_prefetch_enqueued_total", "enqueued", "counter", "Speculative fetches queued."),
+        ("jm_prefetch_dropped_total", "dropped", "counter", "Speculative fetches dropped on a full queue."),
+        ("jm_prefetch_issued_total", "issued", "counter", "Speculative fetches sent upstream."),
+        ("jm_prefetch_hits_total", "hits", "counter", "Requests served by a speculative fetch."),
+        ("jm_prefetch_errors_total", "errors", "counter", "Speculative fetches that failed."),
+        ("jm_prefetch_hit_ratio", "hit_rate", "gauge", "Hits per issued speculative fetch."),
+        ("jm_prefetch_queued", "queued", "gauge", "Speculative fetches waiting in the queue.")))
+    lines += stats_metric_lines(cover_stats, (
+        ("jm_cover_fetched_total", "fetched", "counter", "Covers downloaded."),
+        ("jm_cover_failed_total", "failed", "counter", "Cover downloads that failed."),
+        ("jm_cover_dropped_total", "dropped", "counter", "Cover prefetches dropped while too many were pending.")))
+    lines += stats_metric_lines(cache_warmer.stats(), (
+        ("jm_warmer_passes_total", "passes", "counter", "Cache warmer passes completed."),
+        ("jm_warmer_refreshed_total", "refreshed", "counter", "Entries refreshed by the warmer."),
+        ("jm_warmer_skipped_total", "skipped", "counter", "Entries the warmer found fresh enough."),
+        ("jm_warmer_errors_total", "errors", "counter", "Warmer refreshes that failed."),
+        ("jm_warmer_busy_waits_total", "busy_waits", "counter", "Times the warmer yielded to interactive calls.")))
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint."""
+    temp_bytes = await run_in_threadpool(temp_dir_bytes)
+    return Response(render_metrics(temp_bytes), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # --- HTTP route: health check (legacy, backward compatible) ---
 @app.get("/v1/{timestamp}")
 async def read_root(timestamp: float):
@@ -550,6 +3081,67 @@ async def read_root(timestamp: float):
     }
 
 
+# --- Blocking upstream fetchers (run in thread pool via upstream_flight) ---
+@guarded("search")
+def _fetch_search(tag: str, num: int) -> list:
+    """Fetch one search result page."""
+    with jm_client() as client:
+        page: jmcomic.JmSearchPage = client.search_site(search_query=f'+{tag}', page=num)
+    return [{'album_id': album_id, 'title': title} for album_id, title in page]
+
+
+@guarded("detail")
+def _fetch_album_detail(aid) -> jmcomic.JmAlbumDetail:
+    """Fetch the full album detail object."""
+    with jm_client() as client:
+        return client.get_album_detail(aid)
+
+
+def _fetch_album_info(aid: str) -> dict:
+    """Fetch album detail. The cover is prefetched separately by cover_fetcher."""
+    impl = get_impl_mode()
+
+    album = _fetch_album_detail(aid)
+
+    return {
+        "status": "success",
+        "tag": album.tags,
+        "view_count": album.views,
+        "like_count": album.likes,
+        "page_count": album.page_count,
+        "method": impl
+    }
+
+
+@guarded("ranking")
+def _fetch_rank(searchTime: SearchTime) -> list:
+    """Fetch the first page of the day/week/month ranking."""
+    with jm_client() as client:
+        if searchTime == SearchTime.month:
+            pages: jmcomic.JmCategoryPage = client.month_ranking(1)
+        elif searchTime == SearchTime.week:
+            pages: jmcomic.JmCategoryPage = client.week_ranking(1)
+        else:
+            pages: jmcomic.JmCategoryPage = client.day_ranking(1)
+    return [{"aid": album_id, "title": title} for album_id, title in pages]
+
+
+@guarded("comments")
+def _fetch_comments(aid: str, page: int) -> dict:
+    """Fetch one page of album comments."""
+    with jm_client() as client:
+        comment_page: jmcomic.JmAlbumCommentPage = client.album_pagination(aid, page=page)
+    return {
+        "aid": aid,
+        "page": page,
+        "page_size": comment_page.page_size,
+        "total": comment_page.total,
+        "page_count": comment_page.page_count,
+        "comment_count": comment_page.comment_count,
+        "comments": [_serialize_comment(c) for c in comment_page.content],
+    }
+
+
 # --- HTTP route: search albums ---
 @app.get("/v1/search/{tag}/{num}")
 @handle_jmcomic_errors
@@ -559,61 +3151,352 @@ async def search_album(tag: str, num: int):
         raise HTTPException(status_code=400, detail="num must be between 1 and 100")
 
     cache_key = f"search:{tag}:{num}"
-    cached_result = search_cache.get(cache_key)
-    if cached_result is not None:
-        return cached_result
+    cached_result, payload, _ = search_cache.get_encoded_entry(cache_key)
+    if cached_result is None:
+        if upstream_flight.in_flight(cache_key):  # possibly the speculative fetch, joined mid-way
+            search_prefetcher.note_hit(cache_key)
+        cached_result, payload = await upstream_flight.do(
+            cache_key, _cache_through, search_cache, cache_key, _fetch_search, tag, num
+        )
+    else:
+        search_prefetcher.note_hit(cache_key)
+    if SEARCH_PREFETCH_ENABLED:
+        search_prefetcher.after_search(tag, num, cached_result)
+    return json_response(cached_result, payload)
 
-    client = get_jm_client()
-    page: jmcomic.JmSearchPage = await run_in_threadpool(
-        client.search_site, search_query=f'+{tag}', page=num
-    )
 
-    aid_list = [{'album_id': album_id, 'title': title} for album_id, title in page]
+# --- Cover prefetch (kept off the /v1/info response path) ---
+COVER_FETCH_MAX_PENDING = 200  # beyond this prefetches are dropped; getcover then 404s as before
+COVER_WAIT_SECONDS = float(os.environ.get("JM_COVER_WAIT_SECONDS", "5"))
+
+
+def sync_fetch_cover(album_id: str) -> Path:
+    """Download cover-{album_id}.jpg to a temp file and rename it into place."""
+    path = FILE_PATH / f"cover-{album_id}.jpg"
+    if path.exists():
+        return path
+    # Same .jpg suffix so jmcomic saves the bytes as-is; the leading dot keeps it out of globs
+    tmp = path.with_name(f".{path.stem}.{uuid.uuid4().hex}.jpg")
+    try:
+        get_cover_client().download_album_cover(album_id, str(tmp))
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    schedule_deletion(path, delay_seconds=1800)
+    return path
 
-    search_cache.set(cache_key, aid_list)
-    return aid_list
+
+class CoverFetcher:
+    """
+    Background cover downloads on the media executor. Concurrent prefetches
+    and getcover waiters for the same album share one fetch.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, max_pending: int = COVER_FETCH_MAX_PENDING):
+        self._flight = SingleFlight(executor=executor)
+        self._max_pending = max_pending
+        self.fetched = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def in_flight(self, album_id: str) -> bool:
+        return self._flight.in_flight(album_id)
+
+    def prefetch(self, album_id: str) -> None:
+        """Fire-and-forget fetch unless the cover is on disk or already being fetched."""
+        if self._flight.in_flight(album_id) or (FILE_PATH / f"cover-{album_id}.jpg").exists():
+            return
+        if len(self._flight) >= self._max_pending:
+            self.dropped += 1
+            return
+        task = asyncio.create_task(self.fetch(album_id))
+        _pending_tasks.add(task)
+        task.add_done_callback(_remove_pending_task)
+
+    async def fetch(self, album_id: str) -> bool:
+        """Fetch (or join the fetch of) one cover and wait for it; False if it failed."""
+        try:
+            await self._flight.do(album_id, sync_fetch_cover, album_id)
+            self.fetched += 1
+            return True
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Cover download failed for album %s: %s", album_id, e)
+            return False
+
+    async def wait(self, album_id: str, timeout: float) -> bool:
+        """Wait up to timeout for an in-flight fetch; True if it finished successfully."""
+        if not self._flight.in_flight(album_id):
+            return False
+        try:
+            await asyncio.wait_for(self._flight.do(album_id, sync_fetch_cover, album_id), timeout)
+            return True
+        except Exception:  # timeout or failed fetch: the caller falls back to 404
+            return False
+
+    def stats(self) -> Dict[str, int]:
+        return {"fetched": self.fetched, "failed": self.failed, "dropped": self.dropped, **self._flight.stats()}
+
+
+cover_fetcher = CoverFetcher(media_executor)
+
+
+def _cover_id(aid: str) -> Optional[str]:
+    """Numeric album id used in cover file names, or None if aid doesn't parse."""
+    try:
+        return str(jmcomic.JmcomicText.parse_to_jm_id(aid))
+    except Exception:
+        return None
+
+
+# --- Speculative prefetch (next search page and the current page's covers) ---
+SEARCH_PREFETCH_ENABLED = os.environ.get("JM_SEARCH_PREFETCH", "0") == "1"
+SEARCH_PREFETCH_QUEUE = 200   # queued items beyond this are dropped
+SEARCH_PREFETCH_BUSY = int(os.environ.get("JM_SEARCH_PREFETCH_BUSY", "2"))  # interactive calls that pause it
+
+
+class SpeculativePrefetcher:
+    """
+    Low-priority background queue, drained by one worker that yields while
+    interactive upstream calls are in flight. Remembers what it fetched so
+    later requests served by a speculative fetch are counted as hits.
+    """
+
+    def __init__(self, busy_threshold: int, max_queue: int = SEARCH_PREFETCH_QUEUE, remember: int = 2000):
+        self.busy_threshold = busy_threshold
+        self.busy_poll = 0.5
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._issued: OrderedDict = OrderedDict()  # key -> None, bounded
+        self._remember = remember
+        self.enqueued = 0
+        self.issued = 0
+        self.dropped = 0
+        self.errors = 0
+        self.hits = 0
+
+    def _remember_key(self, key: str) -> None:
+        self._issued[key] = None
+        self._issued.move_to_end(key)
+        if len(self._issued) > self._remember:
+            self._issued.popitem(last=False)
+
+    def _enqueue(self, item: tuple) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+        else:
+            self.enqueued += 1
+
+    def after_search(self, tag: str, num: int, results: list) -> None:
+        """Queue page num+1 and the covers of this page; called after a search is served."""
+        if not results:
+            return
+        if num < 100 and f"search:{tag}:{num + 1}" not in search_cache:
+            self._enqueue(("search", tag, num + 1))
+        for item in results:
+            if not (FILE_PATH / f"cover-{item['album_id']}.jpg").exists():
+                self._enqueue(("cover", str(item["album_id"])))
+
+    def note_hit(self, key: str) -> None:
+        """Count a request answered by a speculative fetch; each fetch counts once."""
+        if key in self._issued:
+            del self._issued[key]
+            self.hits += 1
+
+    async def run(self) -> None:
+        while True:
+            item = await self._queue.get()
+            while len(upstream_flight) >= self.busy_threshold:
+                await asyncio.sleep(self.busy_poll)
+            try:
+                await self._process(item)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("[Prefetch] %s failed: %s", item, e)
+
+    async def _process(self, item: tuple) -> None:
+        if item[0] == "search":
+            _, tag, num = item
+            key = f"search:{tag}:{num}"
+            if key in search_cache:
+                return
+            self.issued += 1
+            self._remember_key(key)
+            await upstream_flight.do(key, _cache_through, search_cache, key, _fetch_search, tag, num)
+        else:
+            album_id = item[1]
+            if (FILE_PATH / f"cover-{album_id}.jpg").exists():
+                return
+            self.issued += 1
+            self._remember_key(f"cover:{album_id}")
+            if not await cover_fetcher.fetch(album_id):
+                self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": SEARCH_PREFETCH_ENABLED,
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "issued": self.issued,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.issued if self.issued else 0.0,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+search_prefetcher = SpeculativePrefetcher(SEARCH_PREFETCH_BUSY)
+
+
+async def get_album_info(aid: str, slots: Optional[asyncio.Semaphore] = None) -> dict:
+    """
+    Cached album info for one aid, shared by /v1/info and the batch endpoint.
+    Cache hits return without touching slots; misses take one while calling upstream.
+    """
+    return (await get_album_info_entry(aid, slots))[0]
+
+
+async def get_album_info_entry(aid: str, slots: Optional[asyncio.Semaphore] = None) -> Tuple[dict, Optional[bytes]]:
+    """get_album_info plus its encoded JSON (None if the value is not JSON-encodable)."""
+    cache_key = f"album_info:{aid}"
+    cached_result, payload, stale = album_info_cache.get_encoded_entry(cache_key)
+    if cached_result is not None:
+        if stale:
+            refresh_in_background(album_info_cache, cache_key, _fetch_album_info, aid)
+    elif slots is None:
+        cached_result, payload = await upstream_flight.do(
+            cache_key, _cache_through, album_info_cache, cache_key, _fetch_album_info, aid
+        )
+    else:
+        async with slots:
+            cached_result, payload = await upstream_flight.do(
+                cache_key, _cache_through, album_info_cache, cache_key, _fetch_album_info, aid
+            )
+    # Covers expire sooner than info entries, so a cache hit may still need one
+    album_id = _cover_id(aid)
+    if album_id is not None:
+        cover_fetcher.prefetch(album_id)
+    return cached_result, payload
 
 
 # --- HTTP route: album info ---
 @app.get("/v1/info/{aid}")
 @handle_jmcomic_errors
 async def info(aid: str):
-    cache_key = f"album_info:{aid}"
-    cached_result = album_info_cache.get(cache_key)
-    if cached_result is not None:
-        return cached_result
+    return json_response(*await get_album_info_entry(aid))
 
-    client = get_jm_client()
-    impl = get_impl_mode()
 
-    album: jmcomic.JmAlbumDetail = await run_in_threadpool(client.get_album_detail, aid)
+# --- HTTP route: batch album info ---
+INFO_BATCH_MAX = 100
+INFO_BATCH_CONCURRENCY = int(os.environ.get("JM_INFO_BATCH_CONCURRENCY", "8"))
+# Shared by all batches so several large batches can't multiply upstream load
+_info_batch_slots = asyncio.Semaphore(INFO_BATCH_CONCURRENCY)
 
-    file_path = FILE_PATH / f"cover-{album.album_id}.jpg"
 
-    if not file_path.exists():
-        try:
-            option = get_info_option()
-            download_client = option.new_jm_client()
-            await run_in_threadpool(download_client.download_album_cover, album.album_id, str(file_path))
-        except Exception as e:
-            logger.warning("Cover download failed for album %s: %s", aid, e)
+async def _batch_info_item(aid: str) -> dict:
+    """One batch entry: the info result, or the error /v1/info would have returned."""
+    try:
+        return {"aid": aid, **await get_album_info(aid, _info_batch_slots)}
+    except Exception as e:
+        if not isinstance(e, jmcomic.JmcomicException):
+            logger.exception("Unexpected error in batch info for %s", aid)
+        status_code, detail = jmcomic_error_status(e)
+        return {"aid": aid, "status": "error", "code": status_code, "message": detail}
 
-    result = {
-        "status": "success",
-        "tag": album.tags,
-        "view_count": album.views,
-        "like_count": album.likes,
-        "page_count": album.page_count,
-        "method": impl
-    }
 
-    album_info_cache.set(cache_key, result)
-    return result
+@app.post("/v1/info/batch")
+async def info_batch(request: Request, stream: bool = False):
+    """
+    Album info for up to INFO_BATCH_MAX aids. A failing aid yields an error item
+    instead of failing the batch. With ?stream=true items are sent as NDJSON in
+    completion order (cache hits first); otherwise results keep request order.
+    """
+    try:
+        data = await request.json()
+        aids = data.get("aids")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON containing 'aids'.")
+    if not isinstance(aids, list) or not aids or not all(isinstance(a, (str, int)) for a in aids):
+        raise HTTPException(status_code=400, detail="aids must be a non-empty list of album IDs")
+    if len(aids) > INFO_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {INFO_BATCH_MAX} aids per batch")
+    aids = [str(a) for a in aids]
+
+    if not stream:
+        return {"status": "success", "results": await asyncio.gather(*map(_batch_info_item, aids))}
+
+    async def ndjson():
+        tasks = [asyncio.ensure_future(_batch_info_item(aid)) for aid in aids]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                yield json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n"
+        finally:
+            # Client went away: stop waiting. Shared upstream calls are shielded and still fill the cache.
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+# --- Cover variants (resized / re-encoded thumbnails, cached next to the original) ---
+class CoverFormat(str, Enum):
+    jpeg = "jpeg"
+    webp = "webp"
+
+
+_COVER_MEDIA_TYPES = {CoverFormat.jpeg: "image/jpeg", CoverFormat.webp: "image/webp"}
+# Keys are variant file names, so one original is only ever resized once per size/format
+cover_variant_flight = SingleFlight(executor=media_executor)
+_cover_digests: Dict[Path, Tuple[int, int, str]] = {}  # original -> (mtime_ns, size, content digest)
+
+
+def _cover_digest(original: Path) -> str:
+    """Short content hash of the original, memoised on its mtime and size."""
+    st = original.stat()
+    cached = _cover_digests.get(original)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    digest = hashlib.sha1(original.read_bytes(), usedforsecurity=False).hexdigest()[:12]
+    _cover_digests[original] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def cover_variant_path(original: Path, width: Optional[int], fmt: CoverFormat) -> Path:
+    """cover-{aid}.{digest}.w{width|full}.{fmt}: a new original never reuses an old variant."""
+    size = f"w{width}" if width else "wfull"
+    return original.with_name(f"{original.stem}.{_cover_digest(original)}.{size}.{fmt.value}")
+
+
+def sync_render_cover_variant(original: Path, target: Path, width: Optional[int], fmt: CoverFormat) -> Path:
+    """Resize (never upscale) and re-encode the original into target, written atomically."""
+    if target.exists():
+        return target
+    with Image.open(original) as img:
+        img = img.convert("RGB")
+        if width and img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+        tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            if fmt == CoverFormat.webp:
+                img.save(tmp, format="WEBP", quality=80, method=4)
+            else:
+                img.save(tmp, format="JPEG", quality=85, optimize=True, progressive=True)
+            os.replace(tmp, target)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return target
 
 
 # --- HTTP route: get cover image ---
 @app.get("/v1/get/cover/{aid}")
-async def getcover(aid: str):
+async def getcover(
+    aid: str,
+    request: Request,
+    w: Optional[int] = Query(None, ge=16, le=1024, description="Resize to this width (px), keeping aspect ratio"),
+    fmt: Optional[CoverFormat] = Query(None, description="Re-encode as jpeg or webp"),
+):
     """
     Get album cover image. Uses safe_file_path helper for path-traversal protection.
     """
@@ -626,9 +3509,36 @@ async def getcover(aid: str):
     if safe_path is None:
         raise HTTPException(status_code=400, detail="Invalid file path")
 
+    if not safe_path.exists():
+        # /v1/info may have started fetching it moments ago
+        with timed("cover"):
+            await cover_fetcher.wait(safe_aid, COVER_WAIT_SECONDS)
+
     if safe_path.exists() and safe_path.is_file():
-        schedule_deletion(safe_path, delay_seconds=1800)
-        return FileResponse(safe_path, filename="cover.jpg", media_type="image/jpeg")
+        schedule_deletion(safe_path, delay_seconds=1800, extend=True)
+        search_prefetcher.note_hit(f"cover:{safe_aid}")
+        if w is None and fmt is None:
+            return await conditional_file_response(
+                request, safe_path, "public, max-age=1800", filename="cover.jpg", media_type="image/jpeg"
+            )
+        fmt = fmt or CoverFormat.jpeg
+        try:
+            with timed("resize"):
+                target = await media_executor.run(cover_variant_path, safe_path, w, fmt)
+                variant = await cover_variant_flight.do(
+                    target.name, sync_render_cover_variant, safe_path, target, w, fmt
+                )
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Cover not found")
+        except OSError as e:  # PIL.UnidentifiedImageError is an OSError
+            logger.warning("Cover variant failed for %s: %s", safe_aid, e)
+            raise HTTPException(status_code=500, detail="封面处理失败")
+        # Same expiry as the original; deleting the original also removes its variants
+        schedule_deletion(variant, delay_seconds=1800, extend=True)
+        return await conditional_file_response(
+            request, variant, "public, max-age=1800",
+            filename=f"cover.{'jpg' if fmt == CoverFormat.jpeg else fmt.value}", media_type=_COVER_MEDIA_TYPES[fmt]
+        )
 
     raise HTTPException(status_code=404, detail="Cover not found")
 
@@ -638,22 +3548,128 @@ async def getcover(aid: str):
 @handle_jmcomic_errors
 async def rank(searchTime: SearchTime):
     cache_key = f"rank:{searchTime.value}"
-    cached_result = rank_cache.get(cache_key)
+    cached_result, payload, stale = rank_cache.get_encoded_entry(cache_key)
     if cached_result is not None:
-        return cached_result
+        if stale:
+            refresh_in_background(rank_cache, cache_key, _fetch_rank, searchTime)
+        return json_response(cached_result, payload)
 
-    client = get_jm_client()
-    if searchTime == SearchTime.month:
-        pages: jmcomic.JmCategoryPage = await run_in_threadpool(client.month_ranking, 1)
-    elif searchTime == SearchTime.week:
-        pages: jmcomic.JmCategoryPage = await run_in_threadpool(client.week_ranking, 1)
-    else:
-        pages: jmcomic.JmCategoryPage = await run_in_threadpool(client.day_ranking, 1)
+    return json_response(
+        *await upstream_flight.do(cache_key, _cache_through, rank_cache, cache_key, _fetch_rank, searchTime)
+    )
+
+
+# --- Background cache warmer (rankings, then their top albums and covers) ---
+CACHE_WARMER_ENABLED = os.environ.get("JM_CACHE_WARMER", "0") == "1"
+CACHE_WARMER_INTERVAL = int(os.environ.get("JM_CACHE_WARMER_INTERVAL", "300"))   # seconds between passes
+CACHE_WARMER_TOP_N = int(os.environ.get("JM_CACHE_WARMER_TOP_N", "20"))          # albums per ranking
+CACHE_WARMER_RATE = float(os.environ.get("JM_CACHE_WARMER_RATE", "1"))           # upstream calls per second
+CACHE_WARMER_BUSY = int(os.environ.get("JM_CACHE_WARMER_BUSY", "3"))             # interactive calls that pause it
+
+
+class TokenBucket:
+    """Async token bucket: acquire() waits until a token is available."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CacheWarmer:
+    """
+    Keeps rankings and the info/covers of their top albums warm. An entry is
+    refreshed only when it would turn stale before the next pass, each upstream
+    call spends a token, and the warmer yields while interactive upstream calls
+    are in flight.
+    """
+
+    def __init__(self, interval: int, top_n: int, rate: float, busy_threshold: int):
+        self.interval = interval
+        self.top_n = top_n
+        self.busy_threshold = busy_threshold
+        self.busy_poll = 1.0
+        self.bucket = TokenBucket(rate)
+        self.passes = 0
+        self.refreshed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.busy_waits = 0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.warm_once()
+            except Exception as e:
+                logger.warning("[Warmer] Pass failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def _wait_turn(self) -> None:
+        await self.bucket.acquire()
+        while len(upstream_flight) >= self.busy_threshold:
+            self.busy_waits += 1
+            await asyncio.sleep(self.busy_poll)
+
+    async def _warm(self, cache: SimpleCache, key: str, func, *args) -> Any:
+        """Return the cached value, refreshing it first if it would go stale before the next pass."""
+        if cache.fresh_for(key) > self.interval:
+            value = cache.peek(key)  # not cache.get: the warmer's reads must not count as hits
+            if value is not None:
+                self.skipped += 1
+                return value
+        await self._wait_turn()
+        value, _ = await upstream_flight.do(key, _cache_through, cache, key, func, *args, fresh_only=True)
+        self.refreshed += 1
+        return value
+
+    async def warm_once(self) -> None:
+        top_albums: List[str] = []
+        for search_time in SearchTime:
+            try:
+                ranking = await self._warm(rank_cache, f"rank:{search_time.value}", _fetch_rank, search_time)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("[Warmer] Ranking %s failed: %s", search_time.value, e)
+                continue
+            top_albums.extend(str(item["aid"]) for item in (ranking or [])[:self.top_n])
+
+        for aid in dict.fromkeys(top_albums):  # dedupe, keep ranking order
+            try:
+                await self._warm(album_info_cache, f"album_info:{aid}", _fetch_album_info, aid)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("[Warmer] Album %s failed: %s", aid, e)
+                continue
+            if not (FILE_PATH / f"cover-{aid}.jpg").exists():
+                await self._wait_turn()
+                cover_fetcher.prefetch(aid)
+        self.passes += 1
+        logger.info("[Warmer] Pass %d: refreshed %d, skipped %d, errors %d",
+                    self.passes, self.refreshed, self.skipped, self.errors)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enabled": CACHE_WARMER_ENABLED,
+            "passes": self.passes,
+            "refreshed": self.refreshed,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "busy_waits": self.busy_waits,
+        }
 
-    ranklist = [{"aid": album_id, "title": title} for album_id, title in pages]
 
-    rank_cache.set(cache_key, ranklist)
-    return ranklist
+cache_warmer = CacheWarmer(CACHE_WARMER_INTERVAL, CACHE_WARMER_TOP_N, CACHE_WARMER_RATE, CACHE_WARMER_BUSY)
 
 
 # --- HTTP route: album comments ---
@@ -664,28 +3680,14 @@ async def get_comments(aid: str, page: int = 1):
         raise HTTPException(status_code=400, detail="page must be >= 1")
 
     cache_key = f"comments:{aid}:{page}"
-    cached_result = comment_cache.get(cache_key)
+    cached_result, payload, _ = comment_cache.get_encoded_entry(cache_key)
     if cached_result is not None:
-        return cached_result
+        return json_response(cached_result, payload)
 
-    client = get_jm_client()
-    comment_page: jmcomic.JmAlbumCommentPage = await run_in_threadpool(
-        client.album_pagination, aid, page=page
+    return json_response(
+        *await upstream_flight.do(cache_key, _cache_through, comment_cache, cache_key, _fetch_comments, aid, page)
     )
 
-    result = {
-        "aid": aid,
-        "page": page,
-        "page_size": comment_page.page_size,
-        "total": comment_page.total,
-        "page_count": comment_page.page_count,
-        "comment_count": comment_page.comment_count,
-        "comments": [_serialize_comment(c) for c in comment_page.content],
-    }
-
-    comment_cache.set(cache_key, result)
-    return result
-
 
 # --- Entry point ---
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
+import io
 import os
 import time
+import zipfile
 import threading
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -12,13 +14,26 @@ from main import (
     app,
     safe_file_path,
     SimpleCache,
+    SqliteCacheBackend,
     SearchTime,
     ConnectionManager,
+    SingleFlight,
+    DownloadJobRegistry,
+    DownloadScheduler,
+    DownloadPriority,
+    DownloadQueueFull,
+    ClientPool,
     FILE_PATH,
     _serialize_comment,
 )
 
 
+@pytest.fixture(autouse=True)
+def _pin_impl_mode(monkeypatch):
+    """Keep the lifespan from probing the live site; ImplModeManager tests drive probes directly."""
+    monkeypatch.setenv("JM_IMPL_MODE", "api")
+
+
 # ============================================================
 # safe_file_path — path traversal protection
 # ============================================================
@@ -131,6 +146,50 @@ class TestSimpleCache:
         cache.set("key", "new")
         assert cache.get("key") == "new"
 
+    def test_lru_eviction_respects_recency(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=3)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        assert cache.get("a") == 1  # "a" becomes most recently used
+        cache.set("d", 4)           # should evict "b", not "a"
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+
+    def test_byte_budget_eviction(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=1000, max_bytes=250)
+        for i in range(5):
+            cache.set(f"k{i}", "x" * 100)
+        assert cache.get("k0") is None
+        assert cache.get("k4") is not None
+        assert cache.stats()["bytes"] <= 250
+
+    def test_value_larger_than_budget_not_cached(self):
+        cache = SimpleCache(ttl_seconds=60, max_bytes=50)
+        cache.set("small", "x")
+        cache.set("huge", "x" * 1000)
+        assert cache.get("huge") is None
+        assert cache.get("small") == "x"
+
+    def test_stats_counters(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=1)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("missing")
+        cache.set("b", 2)
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["evictions"] == 1
+        assert stats["entries"] == 1
+
+    def test_sharded_cache_bounds_total_size(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=64, shards=8)
+        for i in range(1000):
+            cache.set(f"k{i}", i)
+        assert len(cache) <= 64
+        assert cache.get("k999") == 999
+
     def test_thread_safety(self):
         cache = SimpleCache(ttl_seconds=60, max_size=1000)
         errors = []
@@ -158,6 +217,269 @@ class TestSimpleCache:
 
         assert len(errors) == 0
 
+    def test_thread_safety_sharded(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=100, max_bytes=10_000, shards=4)
+        errors = []
+
+        def worker(start):
+            try:
+                for i in range(200):
+                    cache.set(f"key-{start}-{i}", i)
+                    cache.get(f"key-{start}-{i // 2}")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(errors) == 0
+        assert len(cache) <= 100
+        assert cache.stats()["bytes"] <= 10_000
+
+
+# ============================================================
+# Stale-while-revalidate — soft/hard TTL
+# ============================================================
+
+class TestStaleWhileRevalidate:
+    """Tests for soft-TTL staleness and background refresh of rank/info."""
+
+    def test_fresh_then_stale_then_expired(self):
+        cache = SimpleCache(ttl_seconds=1, soft_ttl_seconds=0)
+        cache.set("k", "v")
+        assert cache.get_entry("k") == ("v", True)
+        assert cache.get("k") == "v"
+        time.sleep(1.1)
+        assert cache.get_entry("k") == (None, False)
+
+    def test_without_soft_ttl_never_stale(self):
+        cache = SimpleCache(ttl_seconds=60)
+        cache.set("k", "v")
+        assert cache.get_entry("k") == ("v", False)
+
+    def test_stale_hit_counted(self):
+        cache = SimpleCache(ttl_seconds=60, soft_ttl_seconds=0)
+        cache.set("k", "v")
+        cache.get("k")
+        assert cache.stats()["stale_hits"] == 1
+
+    def test_stale_rank_served_immediately_and_refreshed(self):
+        stale_cache = SimpleCache(ttl_seconds=60, soft_ttl_seconds=0)
+        stale_cache.set("rank:day", [{"aid": "old", "title": "old"}])
+        fresh = [{"aid": "new", "title": "new"}]
+        with patch("main.rank_cache", stale_cache), \
+                patch("main._fetch_rank", return_value=fresh) as fetch, \
+                TestClient(app) as client:
+            response = client.get("/v1/rank/day")
+            assert response.json() == [{"aid": "old", "title": "old"}]
+            deadline = time.time() + 5
+            while stale_cache.get("rank:day") != fresh and time.time() < deadline:
+                time.sleep(0.02)
+            assert stale_cache.get("rank:day") == fresh
+            assert fetch.call_count == 1
+
+    def test_refresh_reuses_fresh_value_from_other_worker(self, tmp_path):
+        from main import _cache_through
+        path = tmp_path / "c.sqlite3"
+        worker_a = SimpleCache(ttl_seconds=60, soft_ttl_seconds=30, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_b = SimpleCache(ttl_seconds=60, soft_ttl_seconds=30, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_a.set("rank:day", ["fresh"])
+        fetch = MagicMock(return_value=["upstream"])
+        assert _cache_through(worker_b, "rank:day", fetch, fresh_only=True)[0] == ["fresh"]
+        fetch.assert_not_called()
+
+    def test_refresh_ignores_stale_shared_value(self, tmp_path):
+        from main import _cache_through
+        path = tmp_path / "c.sqlite3"
+        worker_a = SimpleCache(ttl_seconds=60, soft_ttl_seconds=0, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_b = SimpleCache(ttl_seconds=60, soft_ttl_seconds=0, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_a.set("rank:day", ["stale"])
+        fetch = MagicMock(return_value=["upstream"])
+        assert _cache_through(worker_b, "rank:day", fetch, fresh_only=True)[0] == ["upstream"]
+        assert _cache_through(worker_b, "rank:day", fetch)[0] == ["upstream"]
+        fetch.assert_called_once()
+
+
+# ============================================================
+# SqliteCacheBackend — shared L2 cache
+# ============================================================
+
+class TestSqliteCacheBackend:
+    """Tests for the SQLite shared cache backend and its use as L2."""
+
+    def test_set_and_get(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3")
+        backend.set("ns", "k", {"a": [1, "二"]}, ttl_seconds=60)
+        value, age, size = backend.get("ns", "k")
+        assert value == {"a": [1, "二"]}
+        assert 0 <= age < 5
+        assert size == len('{"a":[1,"二"]}'.encode())
+
+    def test_simple_cache_encodes_once(self, tmp_path):
+        import main
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3")
+        cache = SimpleCache(ttl_seconds=60, backend=backend, namespace="ns")
+        with patch("main._encode_value", wraps=main._encode_value) as encode:
+            cache.set("k", {"comments": ["x"] * 10})
+        assert encode.call_count == 1
+        assert backend.get("ns", "k")[0] == {"comments": ["x"] * 10}
+
+    def test_namespaces_are_isolated(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3")
+        backend.set("a", "k", 1, ttl_seconds=60)
+        assert backend.get("b", "k") is None
+        backend.clear("a")
+        assert backend.get("a", "k") is None
+
+    def test_expired_entry_is_miss(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3")
+        backend.set("ns", "k", 1, ttl_seconds=-1)
+        assert backend.get("ns", "k") is None
+        assert backend.cleanup() == 1
+
+    def test_prune_enforces_entry_limit(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3", max_entries=3)
+        for i in range(5):
+            backend.set("ns", f"k{i}", i, ttl_seconds=60)
+        assert backend.cleanup() == 2
+        assert backend.get("ns", "k0") is None
+        assert backend.get("ns", "k4")[0] == 4
+
+    def test_prune_enforces_byte_limit(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3", max_bytes=250)
+        for i in range(5):
+            backend.set("ns", f"k{i}", "x" * 100, ttl_seconds=60)
+        backend.cleanup()
+        assert backend.get("ns", "k0") is None
+        assert backend.get("ns", "k4") is not None
+
+    def test_shared_between_instances(self, tmp_path):
+        """Two backends on one file behave like two workers on one host."""
+        path = tmp_path / "c.sqlite3"
+        worker_a = SimpleCache(ttl_seconds=60, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_b = SimpleCache(ttl_seconds=60, backend=SqliteCacheBackend(path), namespace="rank")
+        worker_a.set("rank:day", [{"aid": "1"}])
+        # L1-only lookup never touches SQLite
+        assert worker_b.get("rank:day") is None
+        assert worker_b.load_shared("rank:day") == [{"aid": "1"}]
+        # Promoted into worker_b's L1
+        assert "rank:day" in worker_b
+        assert worker_b.get("rank:day") == [{"aid": "1"}]
+
+    def test_cache_through_prefers_shared_hit(self, tmp_path):
+        from main import _cache_through
+        path = tmp_path / "c.sqlite3"
+        worker_a = SimpleCache(ttl_seconds=60, backend=SqliteCacheBackend(path), namespace="ns")
+        worker_b = SimpleCache(ttl_seconds=60, backend=SqliteCacheBackend(path), namespace="ns")
+        worker_a.set("k", [1])
+        fetch = MagicMock(return_value=[2])
+        assert _cache_through(worker_b, "k", fetch) == ([1], b"[1]")
+        fetch.assert_not_called()
+
+    def test_non_json_value_stays_local(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "c.sqlite3")
+        cache = SimpleCache(ttl_seconds=60, backend=backend, namespace="ns")
+        cache.set("k", object)
+        assert cache.get("k") is object
+        assert backend.get("ns", "k") is None
+        assert cache.load_shared("k") is None
+
+
+# ============================================================
+# SingleFlight — upstream call coalescing
+# ============================================================
+
+class TestSingleFlight:
+    """Tests for the SingleFlight coalescing layer."""
+
+    def test_concurrent_calls_are_merged(self):
+        import asyncio
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def fetch(x):
+            calls.append(x)
+            release.wait(5)
+            return x * 2
+
+        async def run():
+            tasks = [asyncio.create_task(flight.do("k", fetch, 21)) for _ in range(5)]
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        results = asyncio.run(run())
+        assert results == [42] * 5
+        assert calls == [21]
+        assert flight.stats()["calls"] == 1
+        assert flight.stats()["merged"] == 4
+        assert flight.stats()["in_flight"] == 0
+
+    def test_exception_shared_by_all_waiters(self):
+        import asyncio
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise ValueError("upstream down")
+
+        async def run():
+            tasks = [asyncio.create_task(flight.do("k", fetch)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(run())
+        assert all(isinstance(r, ValueError) for r in results)
+        assert flight.stats()["errors"] == 1
+
+    def test_different_keys_not_merged(self):
+        import asyncio
+        flight = SingleFlight()
+
+        async def run():
+            return await asyncio.gather(
+                flight.do("a", lambda: 1),
+                flight.do("b", lambda: 2),
+            )
+
+        assert asyncio.run(run()) == [1, 2]
+        assert flight.stats()["merged"] == 0
+
+    def test_merged_requests_store_cache_once(self):
+        import asyncio
+        from main import upstream_flight, _cache_through
+        cache = MagicMock()
+        cache.load_shared_entry.return_value = (None, None)
+        cache.set.return_value = b"[1]"
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            return [1]
+
+        async def run():
+            tasks = [asyncio.create_task(upstream_flight.do("merge-once", _cache_through, cache, "merge-once", fetch))
+                     for _ in range(4)]
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        assert asyncio.run(run()) == [([1], b"[1]")] * 4
+        cache.set.assert_called_once_with("merge-once", [1])
+
+    def test_sequential_calls_not_merged(self):
+        import asyncio
+        flight = SingleFlight()
+        asyncio.run(flight.do("k", lambda: 1))
+        asyncio.run(flight.do("k", lambda: 1))
+        assert flight.stats()["calls"] == 2
+
 
 # ============================================================
 # SearchTime Enum
@@ -194,6 +516,1299 @@ class TestConnectionManager:
         asyncio.run(mgr.send_and_close("nonexistent", {"status": "test"}))
 
 
+# ============================================================
+# DownloadJobRegistry — download deduplication
+# ============================================================
+
+class TestDownloadJobRegistry:
+    """Tests for per-album download deduplication and notification fan-out."""
+
+    def test_attach_creates_then_joins(self):
+        registry = DownloadJobRegistry()
+        job1, created1 = registry.attach(1, "a")
+        job2, created2 = registry.attach(1, "b")
+        assert created1 is True
+        assert created2 is False
+        assert job1 is job2
+        assert job1.client_ids == ["a", "b"]
+
+    def test_same_client_not_duplicated(self):
+        registry = DownloadJobRegistry()
+        registry.attach(1, "a")
+        job, _ = registry.attach(1, "a")
+        assert job.client_ids == ["a"]
+
+    def test_finish_returns_subscribers_and_removes_job(self):
+        registry = DownloadJobRegistry()
+        registry.attach(1, "a")
+        registry.attach(1, "b")
+        assert registry.finish(1) == ["a", "b"]
+        assert registry.get(1) is None
+        _, created = registry.attach(1, "c")
+        assert created is True
+
+    def test_concurrent_requests_start_one_download(self):
+        import main
+        started = []
+        release = threading.Event()
+
+        def fake_task(album_id):
+            started.append(album_id)
+            release.wait(5)
+            main.download_jobs.finish(album_id)
+
+        with patch("main.sync_download_and_zip_task", side_effect=fake_task), TestClient(app) as client:
+            for cid in ("c1", "c2", "c3"):
+                response = client.post("/v1/download/album/424242", json={"client_id": cid})
+                assert response.status_code == 202
+            assert main.download_jobs.get(424242).client_ids == ["c1", "c2", "c3"]
+            release.set()
+            deadline = time.time() + 5
+            while main.download_jobs.get(424242) is not None and time.time() < deadline:
+                time.sleep(0.02)
+        assert started == [424242]
+
+    def test_all_subscribers_notified(self):
+        import main
+        main.download_jobs.attach(515151, "c1")
+        main.download_jobs.attach(515151, "c2")
+        with patch("main.jmcomic.download_album", side_effect=RuntimeError("boom")), \
+                patch("main._notify_clients") as notify:
+            main.sync_download_and_zip_task(515151)
+        client_ids, message = notify.call_args[0]
+        assert client_ids == ["c1", "c2"]
+        assert message["status"] == "error"
+        assert main.download_jobs.get(515151) is None
+
+
+# ============================================================
+# Download progress events and job status endpoint
+# ============================================================
+
+class TestDownloadProgress:
+    """Tests for throttled progress events and GET /v1/jobs/{job_id}."""
+
+    def test_progress_is_throttled(self):
+        from main import DownloadJob
+        job = DownloadJob(1)
+        assert job.should_emit() is True
+        assert job.should_emit() is False
+        assert job.should_emit(force=True) is True
+
+    def test_throughput_computed_between_emits(self):
+        from main import DownloadJob
+        job = DownloadJob(1)
+        job.should_emit(force=True)
+        job.add(bytes=1000)
+        time.sleep(0.05)
+        job.should_emit(force=True)
+        assert job.snapshot()["throughput_bps"] > 0
+
+    def test_unknown_job_returns_404(self):
+        client = TestClient(app)
+        assert client.get("/v1/jobs/does-not-exist").status_code == 404
+
+    def test_progress_then_terminal_event_over_websocket(self):
+        import main
+
+        def fake_download(album_id, option, downloader=None):
+            job = main.download_jobs.get(album_id)
+            job.update(photos_total=1)
+            job.add(images_total=2, images_done=2, bytes=2048)
+            main._emit_progress(job, force=True)
+            raise RuntimeError("no zip produced")
+
+        with patch("main.get_download_option"), \
+                patch("main.jmcomic.download_album", side_effect=fake_download), \
+                TestClient(app) as client:
+            with client.websocket_connect("/ws/notifications/progress-client") as ws:
+                response = client.post("/v1/download/album/909090", json={"client_id": "progress-client"})
+                assert response.status_code == 202
+                job_id = response.json()["job_id"]
+
+                progress = ws.receive_json()
+                assert progress["status"] == "progress"
+                assert progress["job_id"] == job_id
+                assert progress["images_done"] == 2
+                assert progress["bytes"] == 2048
+
+                final = ws.receive_json()
+                assert final["status"] == "error"
+                assert final["job_id"] == job_id
+
+            state = client.get(f"/v1/jobs/{job_id}").json()
+            assert state["status"] == "error"
+            assert state["images_total"] == 2
+            assert state["finished_at"] is not None
+
+
+# ============================================================
+# ArtifactStore — album_id-indexed zip cache with disk quota
+# ============================================================
+
+class TestArtifactStore:
+    """Tests for the on-disk zip artifact store."""
+
+    def _make_zip(self, base, title, size):
+        (base / f"{title}.zip").write_bytes(b"x" * size)
+
+    def test_add_and_lookup(self, tmp_path):
+        from main import ArtifactStore
+        store = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10_000)
+        self._make_zip(tmp_path, "Title A", 100)
+        store.add(1, "Title A")
+        entry = store.lookup(1)
+        assert entry["file_name"] == "Title A"
+        assert entry["size"] == 100
+        assert store.lookup(2) is None
+
+    def test_lookup_drops_entry_when_file_deleted(self, tmp_path):
+        from main import ArtifactStore
+        store = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10_000)
+        self._make_zip(tmp_path, "Gone", 100)
+        store.add(1, "Gone")
+        (tmp_path / "Gone.zip").unlink()
+        assert store.lookup(1) is None
+        assert store.total_bytes() == 0
+
+    def test_evicts_least_recently_used_over_quota(self, tmp_path):
+        from main import ArtifactStore
+        store = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=250)
+        for aid, title in ((1, "a"), (2, "b")):
+            self._make_zip(tmp_path, title, 100)
+            store.add(aid, title)
+            time.sleep(0.01)
+        store.lookup(1)  # "a" becomes most recently used
+        time.sleep(0.01)
+        self._make_zip(tmp_path, "c", 100)
+        store.add(3, "c")
+        assert not (tmp_path / "b.zip").exists()
+        assert (tmp_path / "a.zip").exists()
+        assert store.lookup(2) is None
+        assert store.total_bytes() == 200
+
+    def test_index_shared_between_instances(self, tmp_path):
+        from main import ArtifactStore
+        worker_a = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10_000)
+        worker_b = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10_000)
+        self._make_zip(tmp_path, "shared", 10)
+        worker_a.add(7, "shared")
+        assert worker_b.lookup(7)["file_name"] == "shared"
+
+    def test_stored_album_returns_ready_without_download(self, tmp_path):
+        from main import ArtifactStore
+        store = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10_000)
+        self._make_zip(tmp_path, "Cached Album", 10)
+        store.add(123123, "Cached Album")
+        with patch("main.artifact_store", store), patch("main.download_scheduler.submit") as submit:
+            client = TestClient(app)
+            response = client.post("/v1/download/album/123123", json={"client_id": "c"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "download_ready"
+        assert response.json()["file_name"] == "Cached Album"
+        submit.assert_not_called()
+
+
+# ============================================================
+# DownloadScheduler — bounded, prioritized download queue
+# ============================================================
+
+class TestDownloadScheduler:
+    """Tests for the bounded download scheduler."""
+
+    def _run(self, scenario):
+        import asyncio
+        release = threading.Event()
+        started = []
+
+        def fake_task(album_id):
+            started.append(album_id)
+            release.wait(5)
+
+        with patch("main.sync_download_and_zip_task", side_effect=fake_task):
+            try:
+                return asyncio.run(scenario(release, started))
+            finally:
+                release.set()
+
+    def test_limits_concurrency_and_reports_positions(self):
+        import asyncio
+
+        async def scenario(release, started):
+            scheduler = DownloadScheduler(max_concurrent=1, max_queue=10)
+            positions = [scheduler.submit(aid) for aid in (1, 2, 3)]
+            await asyncio.sleep(0.05)
+            assert started == [1]
+            release.set()
+            while len(started) < 3:
+                await asyncio.sleep(0.01)
+            return positions, started
+
+        positions, started = self._run(scenario)
+        assert positions == [0, 1, 2]
+        assert started == [1, 2, 3]
+
+    def test_priority_jumps_queue(self):
+        async def scenario(release, started):
+            scheduler = DownloadScheduler(max_concurrent=1, max_queue=10)
+            scheduler.submit(1)
+            scheduler.submit(2, DownloadPriority.low)
+            scheduler.submit(3, DownloadPriority.normal)
+            assert scheduler.submit(4, DownloadPriority.high) == 1
+            assert scheduler.position(2) == 3
+            scheduler.promote(2, DownloadPriority.high)
+            # FIFO within the high class: 4 was high first, so 2 goes behind it
+            assert scheduler.position(4) == 1
+            assert scheduler.position(2) == 2
+            assert scheduler.position(3) == 3
+
+        self._run(scenario)
+
+    def test_rejects_when_queue_full(self):
+        async def scenario(release, started):
+            scheduler = DownloadScheduler(max_concurrent=1, max_queue=1)
+            scheduler.submit(1)
+            scheduler.submit(2)
+            with pytest.raises(DownloadQueueFull):
+                scheduler.submit(3)
+            assert scheduler.stats()["rejected"] == 1
+
+        self._run(scenario)
+
+    def test_endpoint_returns_429_when_full(self):
+        import main
+        with patch("main.download_scheduler.submit", side_effect=DownloadQueueFull("full")):
+            client = TestClient(app)
+            response = client.post("/v1/download/album/777", json={"client_id": "c"})
+        assert response.status_code == 429
+        assert "retry-after" in response.headers
+        assert main.download_jobs.get(777) is None
+
+    def test_endpoint_rejects_bad_priority(self):
+        client = TestClient(app)
+        response = client.post("/v1/download/album/777", json={"client_id": "c", "priority": "urgent"})
+        assert response.status_code == 400
+
+
+# ============================================================
+# Streaming zip delivery
+# ============================================================
+
+class _FakeImage:
+    def __init__(self, filename):
+        self.filename = filename
+        self.download_url = f"https://img.example/{filename}"
+        self.is_gif = False
+
+
+class _FakeAlbum(list):
+    title = "测试本子"
+
+
+class TestStreamAlbum:
+    """Tests for GET /v1/stream/album/{album_id}."""
+
+    @staticmethod
+    def _album(photos=3, pages=5):
+        return _FakeAlbum(
+            [[_FakeImage(f"{page:05d}.jpg") for page in range(1, pages + 1)] for _ in range(photos)]
+        )
+
+    def _fetch(self, client, image):
+        # Later pages finish first so ordering is really exercised
+        time.sleep(0.01 * (10 - int(image.filename[:5])) / 10)
+        return f"data-{image.filename}".encode() * 1000
+
+    def test_streams_complete_zip_in_page_order(self):
+        album = self._album()
+        jm_client = MagicMock()
+        jm_client.get_album_detail.return_value = album
+        download_client = MagicMock()
+        with patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)), \
+                patch("main.new_download_client", return_value=download_client), \
+                patch("main._fetch_image_bytes", side_effect=self._fetch), \
+                patch("main.STREAM_CHUNK_SIZE", 4096):
+            client = TestClient(app)
+            response = client.get("/v1/stream/album/123")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        assert "filename*=UTF-8''" in response.headers["content-disposition"]
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            names = archive.namelist()
+            assert names == [f"{p:03d}/{i:05d}.jpg" for p in range(1, 4) for i in range(1, 6)]
+            assert archive.read("002/00003.jpg") == b"data-00003.jpg" * 1000
+        # Images come from the stream's own download client, not a pooled metadata client
+        assert download_client.check_photo.call_count == 3
+        jm_client.check_photo.assert_not_called()
+
+    def test_stream_runs_real_image_fetch_through_download_breaker(self):
+        import jmcomic
+        from PIL import Image
+        import main
+
+        source = io.BytesIO()
+        Image.new("RGB", (60, 120), (10, 200, 30)).save(source, format="JPEG")
+        album = self._album(photos=1, pages=2)
+        for image in album[0]:
+            image.aid, image.scramble_id, image.img_file_name = "300000", "220980", image.filename[:5]
+        album[0][1].aid = "100"  # below scramble_id: passed through undecoded
+        jm_client = MagicMock()
+        jm_client.get_album_detail.return_value = album
+        download_client = MagicMock()
+        download_client.get_jm_image.return_value = MagicMock(content=source.getvalue())
+        breaker = main.CircuitBreaker("download", failure_threshold=5, reset_timeout=30)
+        with patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)), \
+                patch("main.new_download_client", return_value=download_client), \
+                patch.dict("main.breakers", {"download": breaker}), \
+                patch.object(breaker, "call", wraps=breaker.call) as breaker_call:
+            response = TestClient(app).get("/v1/stream/album/123")
+            stats = breaker.stats()
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            assert jmcomic.JmImageTool.get_num_by_detail(album[0][0]) > 0
+            assert Image.open(io.BytesIO(archive.read("001/00001.jpg"))).size == (60, 120)
+            assert archive.read("001/00002.jpg") == source.getvalue()
+        assert download_client.get_jm_image.call_count == 2
+        assert breaker_call.call_count == 3  # check_photo + two images
+        assert stats["state"] == "closed" and stats["failures"] == 0
+        assert main._stream_slots.acquire(blocking=False)  # slot came back
+        main._stream_slots.release()
+
+    def test_failed_detail_fetch_releases_stream_slot(self):
+        import jmcomic
+        import main
+        jm_client = MagicMock()
+        jm_client.get_album_detail.side_effect = jmcomic.MissingAlbumPhotoException(
+            "not found", {"missing_jm_id": "123"})
+        with patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)), \
+                patch("main._stream_slots", threading.BoundedSemaphore(1)):
+            client = TestClient(app)
+            assert client.get("/v1/stream/album/123").status_code == 404
+            assert client.get("/v1/stream/album/123").status_code == 404  # not 429
+            assert main._stream_slots.acquire(blocking=False)
+
+    def test_missing_album_is_404_before_streaming(self):
+        import jmcomic
+        jm_client = MagicMock()
+        jm_client.get_album_detail.side_effect = jmcomic.MissingAlbumPhotoException(
+            "not found", {"missing_jm_id": "123"})
+        with patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)):
+            response = TestClient(app).get("/v1/stream/album/123")
+        assert response.status_code == 404
+
+    def test_rejects_when_stream_slots_exhausted(self):
+        with patch("main._stream_slots", threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            response = TestClient(app).get("/v1/stream/album/123")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "30"
+
+
+# ============================================================
+# Range / ETag / conditional requests on file endpoints
+# ============================================================
+
+class TestConditionalFileResponses:
+    """Resumable zip downloads and revalidated covers."""
+
+    SIZE = 8 * 1024 * 1024 + 123
+
+    @pytest.fixture
+    def big_zip(self, tmp_path):
+        data = os.urandom(self.SIZE)
+        (tmp_path / "大文件.zip").write_bytes(data)
+        with patch("main.FILE_PATH", tmp_path), patch("main.artifact_store"):
+            yield TestClient(app), data
+
+    def test_full_download_has_validators(self, big_zip):
+        client, data = big_zip
+        response = client.get("/v1/download/大文件")
+        assert response.status_code == 200
+        assert response.content == data
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["etag"].startswith('"')
+        assert "last-modified" in response.headers
+
+    def test_resume_from_offset(self, big_zip):
+        client, data = big_zip
+        response = client.get("/v1/download/大文件", headers={"Range": "bytes=5000000-"})
+        assert response.status_code == 206
+        assert response.headers["content-range"] == f"bytes 5000000-{self.SIZE - 1}/{self.SIZE}"
+        assert response.content == data[5000000:]
+
+    def test_multi_range(self, big_zip):
+        client, data = big_zip
+        response = client.get("/v1/download/大文件", headers={"Range": "bytes=0-99,-100"})
+        assert response.status_code == 206
+        assert response.headers["content-type"].startswith("multipart/byteranges")
+        assert data[:100] in response.content
+        assert data[-100:] in response.content
+
+    def test_if_range_with_stale_etag_sends_whole_file(self, big_zip):
+        client, data = big_zip
+        response = client.get("/v1/download/大文件", headers={"Range": "bytes=100-", "If-Range": '"outdated"'})
+        assert response.status_code == 200
+        assert len(response.content) == self.SIZE
+
+    def test_if_range_with_current_etag_resumes(self, big_zip):
+        client, data = big_zip
+        etag = client.get("/v1/download/大文件", headers={"Range": "bytes=0-0"}).headers["etag"]
+        response = client.get("/v1/download/大文件", headers={"Range": "bytes=100-", "If-Range": etag})
+        assert response.status_code == 206
+        assert response.content == data[100:]
+
+    def test_unsatisfiable_range(self, big_zip):
+        client, _ = big_zip
+        response = client.get("/v1/download/大文件", headers={"Range": f"bytes={self.SIZE + 10}-"})
+        assert response.status_code == 416
+
+    def test_if_none_match_returns_304(self, big_zip):
+        client, _ = big_zip
+        etag = client.get("/v1/download/大文件", headers={"Range": "bytes=0-0"}).headers["etag"]
+        response = client.get("/v1/download/大文件", headers={"If-None-Match": f'"other", W/{etag}'})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+    def test_cover_revalidation(self, tmp_path):
+        (tmp_path / "cover-42.jpg").write_bytes(b"\xff\xd8jpeg")
+        with patch("main.FILE_PATH", tmp_path), patch("main.schedule_deletion"):
+            client = TestClient(app)
+            first = client.get("/v1/get/cover/42")
+            assert first.status_code == 200
+            assert "max-age" in first.headers["cache-control"]
+            again = client.get("/v1/get/cover/42", headers={"If-Modified-Since": first.headers["last-modified"]})
+            assert again.status_code == 304
+            changed = client.get("/v1/get/cover/42", headers={"If-None-Match": '"nope"'})
+            assert changed.status_code == 200
+
+
+# ============================================================
+# Deletion scheduler
+# ============================================================
+
+class TestDeletionScheduler:
+    """Timer-heap deletions, rescheduling and disk-pressure eviction."""
+
+    @staticmethod
+    def _file(tmp_path, name, size=10):
+        path = tmp_path / name
+        path.write_bytes(b"x" * size)
+        return path
+
+    def test_thread_deletes_at_deadline(self, tmp_path):
+        from main import DeletionScheduler
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=0)
+        later = self._file(tmp_path, "later.jpg")
+        soon = self._file(tmp_path, "soon.jpg")
+        scheduler.start()
+        try:
+            scheduler.schedule(later, 60)
+            scheduler.schedule(soon, 0.1)  # earlier than the armed timer: must wake the thread
+            deadline = time.monotonic() + 2
+            while soon.exists() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert not soon.exists()
+            assert later.exists()
+        finally:
+            scheduler.stop()
+
+    def test_existing_deadline_kept_unless_extended(self, tmp_path):
+        from main import DeletionScheduler
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=0)
+        path = self._file(tmp_path, "a.jpg")
+        scheduler.schedule(path, 10)
+        scheduler.schedule(path, 1000)
+        assert scheduler.deadline(path) < 11
+        scheduler.schedule(path, 1000, extend=True)
+        assert scheduler.deadline(path) > 900
+        scheduler.schedule(path, 5, extend=True)  # never shortens
+        assert scheduler.deadline(path) > 900
+
+    def test_extended_entry_survives_its_old_deadline(self, tmp_path):
+        from main import DeletionScheduler
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=0)
+        path = self._file(tmp_path, "a.jpg")
+        scheduler.schedule(path, 0)
+        scheduler.schedule(path, 60, extend=True)
+        assert scheduler.run_due() == 0
+        assert path.exists()
+        assert len(scheduler) == 1
+
+    def test_cancel(self, tmp_path):
+        from main import DeletionScheduler
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=0)
+        path = self._file(tmp_path, "a.jpg")
+        scheduler.schedule(path, 0)
+        scheduler.cancel(path)
+        assert scheduler.run_due() == 0
+        assert path.exists()
+
+    def test_heap_is_compacted_after_many_extends(self, tmp_path):
+        from main import DeletionScheduler
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=0)
+        path = tmp_path / "hot.jpg"
+        for i in range(1000):
+            scheduler.schedule(path, i, extend=True)
+        assert len(scheduler._heap) <= 2 * len(scheduler) + 65
+
+    def test_disk_pressure_deletes_scheduled_then_artifacts(self, tmp_path):
+        from collections import namedtuple
+        from main import DeletionScheduler, ArtifactStore
+        usage = namedtuple("usage", "total used free")
+        store = ArtifactStore(tmp_path, tmp_path / "artifacts.json", quota_bytes=10 ** 9)
+        for album_id, name in ((1, "old"), (2, "new")):
+            self._file(tmp_path, f"{name}.zip", 100)
+            store.add(album_id, name)
+            time.sleep(0.01)
+        first = self._file(tmp_path, "cover-1.jpg", 30)
+        second = self._file(tmp_path, "cover-2.jpg", 30)
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=1000)
+        scheduler.schedule(second, 600)
+        scheduler.schedule(first, 300)
+        with patch("main.shutil.disk_usage", return_value=usage(10 ** 6, 0, 900)), \
+                patch("main.artifact_store", store):
+            freed = scheduler.relieve_disk_pressure()
+        assert freed == 160
+        assert not first.exists() and not second.exists()
+        assert not (tmp_path / "old.zip").exists()
+        assert (tmp_path / "new.zip").exists()
+        assert store.lookup(1) is None and store.lookup(2) is not None
+        assert scheduler.stats()["emergency_deleted"] == 2
+
+    def test_no_pressure_no_deletion(self, tmp_path):
+        from collections import namedtuple
+        from main import DeletionScheduler
+        usage = namedtuple("usage", "total used free")
+        path = self._file(tmp_path, "a.jpg")
+        scheduler = DeletionScheduler(tmp_path, min_free_bytes=1000)
+        scheduler.schedule(path, 300)
+        with patch("main.shutil.disk_usage", return_value=usage(10 ** 6, 0, 5000)):
+            assert scheduler.relieve_disk_pressure() == 0
+        assert path.exists()
+
+
+# ============================================================
+# Cover variants
+# ============================================================
+
+class TestCoverVariants:
+    """Resized / WebP cover variants."""
+
+    @pytest.fixture
+    def cover_dir(self, tmp_path):
+        from PIL import Image
+        Image.new("RGB", (600, 900), (200, 30, 30)).save(tmp_path / "cover-77.jpg", format="JPEG")
+        with patch("main.FILE_PATH", tmp_path), patch("main.schedule_deletion"):
+            yield tmp_path
+
+    def test_resized_webp_variant(self, cover_dir):
+        from PIL import Image
+        response = TestClient(app).get("/v1/get/cover/77?w=160&fmt=webp")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        with Image.open(io.BytesIO(response.content)) as img:
+            assert img.format == "WEBP"
+            assert img.size == (160, 240)
+        variants = [p.name for p in cover_dir.glob("cover-77.*.w160.webp")]
+        assert len(variants) == 1
+
+    def test_variant_generated_once(self, cover_dir):
+        from PIL import Image
+        client = TestClient(app)
+        with patch("main.Image.open", wraps=Image.open) as decode:
+            for _ in range(3):
+                assert client.get("/v1/get/cover/77?w=80").status_code == 200
+        assert decode.call_count == 1
+        assert len(list(cover_dir.glob("cover-77.*.w80.jpeg"))) == 1
+
+    def test_never_upscales(self, cover_dir):
+        from PIL import Image
+        response = TestClient(app).get("/v1/get/cover/77?w=1024&fmt=jpeg")
+        with Image.open(io.BytesIO(response.content)) as img:
+            assert img.size == (600, 900)
+
+    def test_new_original_gets_new_variant(self, cover_dir):
+        from PIL import Image
+        client = TestClient(app)
+        client.get("/v1/get/cover/77?w=100")
+        Image.new("RGB", (300, 300), (0, 0, 0)).save(cover_dir / "cover-77.jpg", format="JPEG")
+        os.utime(cover_dir / "cover-77.jpg", ns=(1, 1))
+        with Image.open(io.BytesIO(client.get("/v1/get/cover/77?w=100").content)) as img:
+            assert img.size == (100, 100)
+        assert len(list(cover_dir.glob("cover-77.*.w100.jpeg"))) == 2
+
+    def test_invalid_parameters(self, cover_dir):
+        client = TestClient(app)
+        assert client.get("/v1/get/cover/77?w=5").status_code == 422
+        assert client.get("/v1/get/cover/77?fmt=gif").status_code == 422
+
+    def test_deleting_original_removes_variants(self, tmp_path):
+        import main
+        from PIL import Image
+        original = tmp_path / "cover-5.jpg"
+        Image.new("RGB", (50, 50)).save(original, format="JPEG")
+        variant = main.sync_render_cover_variant(
+            original, main.cover_variant_path(original, 20, main.CoverFormat.webp), 20, main.CoverFormat.webp)
+        other = tmp_path / "cover-55.jpg"
+        other.write_bytes(b"x")
+        assert original in main._cover_digests
+        scheduler = main.DeletionScheduler(tmp_path, min_free_bytes=0)
+        scheduler.schedule(original, 0)
+        assert scheduler.run_due() == 1
+        assert not original.exists()
+        assert not variant.exists()
+        assert original not in main._cover_digests
+        assert other.exists()
+
+
+# ============================================================
+# Cover prefetch off the /v1/info path
+# ============================================================
+
+class TestCoverFetcher:
+    """Background cover prefetch, dedupe and getcover waiting."""
+
+    @pytest.fixture
+    def env(self, tmp_path):
+        release = threading.Event()
+        cover_client = MagicMock()
+
+        def download(album_id, save_path):
+            release.wait(5)
+            with open(save_path, "wb") as f:
+                f.write(b"\xff\xd8cover-" + album_id.encode())
+
+        cover_client.download_album_cover.side_effect = download
+        jm_client = MagicMock()
+        jm_client.get_album_detail.return_value = MagicMock(tags=["t"], views="1", likes="2", page_count="3")
+        with patch("main.FILE_PATH", tmp_path), \
+                patch("main.get_cover_client", return_value=cover_client), \
+                patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)), \
+                patch("main.get_impl_mode", return_value="api"), \
+                patch("main.schedule_deletion"), \
+                patch("main.album_info_cache", SimpleCache(ttl_seconds=60, max_size=10)):
+            yield tmp_path, cover_client, release
+        release.set()
+
+    def test_info_returns_before_cover_is_fetched(self, env):
+        tmp_path, cover_client, release = env
+        with TestClient(app) as client:
+            response = client.get("/v1/info/4321")
+            assert response.status_code == 200
+            assert not (tmp_path / "cover-4321.jpg").exists()
+            release.set()
+            cover = client.get("/v1/get/cover/4321")
+            assert cover.status_code == 200
+            assert cover.content == b"\xff\xd8cover-4321"
+        assert cover_client.download_album_cover.call_count == 1
+
+    def test_concurrent_requests_share_one_fetch(self, env):
+        tmp_path, cover_client, release = env
+        with TestClient(app) as client:
+            for _ in range(3):
+                assert client.get("/v1/info/JM4321").status_code == 200
+            release.set()
+            assert client.get("/v1/get/cover/4321").status_code == 200
+        assert cover_client.download_album_cover.call_count == 1
+
+    def test_getcover_without_fetch_is_404_immediately(self, env):
+        tmp_path, cover_client, release = env
+        start = time.monotonic()
+        response = TestClient(app).get("/v1/get/cover/999")
+        assert response.status_code == 404
+        assert time.monotonic() - start < 1
+        cover_client.download_album_cover.assert_not_called()
+
+    def test_failed_download_leaves_no_partial_file(self, tmp_path):
+        from main import sync_fetch_cover
+        cover_client = MagicMock()
+
+        def broken(album_id, save_path):
+            with open(save_path, "wb") as f:
+                f.write(b"half")
+            raise RuntimeError("connection reset")
+
+        cover_client.download_album_cover.side_effect = broken
+        with patch("main.FILE_PATH", tmp_path), patch("main.get_cover_client", return_value=cover_client):
+            with pytest.raises(RuntimeError):
+                sync_fetch_cover("8")
+        assert list(tmp_path.iterdir()) == []
+
+
+# ============================================================
+# Batch album info
+# ============================================================
+
+class TestInfoBatch:
+    """Tests for POST /v1/info/batch."""
+
+    @pytest.fixture
+    def upstream(self):
+        import jmcomic
+        calls = []
+        active = [0, 0]  # current, peak
+        lock = threading.Lock()
+
+        def detail(aid):
+            with lock:
+                calls.append(aid)
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            if aid == "404":
+                raise jmcomic.MissingAlbumPhotoException("missing", {"missing_jm_id": aid})
+            return MagicMock(tags=[aid], views="1", likes="2", page_count="3")
+
+        jm_client = MagicMock()
+        jm_client.get_album_detail.side_effect = detail
+        cache = SimpleCache(ttl_seconds=60, max_size=200)
+        with patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=8)), \
+                patch("main.get_impl_mode", return_value="api"), \
+                patch("main.cover_fetcher"), \
+                patch("main.album_info_cache", cache):
+            yield cache, calls, active
+
+    def test_mixed_hits_misses_and_errors(self, upstream):
+        cache, calls, _ = upstream
+        cache.set("album_info:1", {"status": "success", "tag": ["cached"]})
+        response = TestClient(app).post("/v1/info/batch", json={"aids": ["1", 2, "404"]})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["aid"] for r in results] == ["1", "2", "404"]
+        assert results[0]["tag"] == ["cached"]
+        assert results[1]["status"] == "success" and results[1]["tag"] == ["2"]
+        assert results[2]["status"] == "error" and results[2]["code"] == 404
+        assert sorted(calls) == ["2", "404"]
+
+    def test_upstream_concurrency_is_bounded(self, upstream):
+        import asyncio
+        _, calls, active = upstream
+        with patch("main._info_batch_slots", asyncio.Semaphore(3)):
+            response = TestClient(app).post("/v1/info/batch", json={"aids": [str(i) for i in range(12)]})
+        assert response.status_code == 200
+        assert len(calls) == 12
+        assert active[1] <= 3
+
+    def test_ndjson_stream_sends_hits_first(self, upstream):
+        import json
+        cache, _, _ = upstream
+        cache.set("album_info:9", {"status": "success", "tag": ["cached"]})
+        response = TestClient(app).post("/v1/info/batch?stream=true", json={"aids": ["5", "6", "9"]})
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        items = [json.loads(line) for line in response.text.splitlines()]
+        assert items[0]["aid"] == "9"
+        assert sorted(i["aid"] for i in items) == ["5", "6", "9"]
+
+    def test_rejects_bad_bodies(self, upstream):
+        client = TestClient(app)
+        assert client.post("/v1/info/batch", json={"aids": []}).status_code == 400
+        assert client.post("/v1/info/batch", json={"aids": "1,2"}).status_code == 400
+        assert client.post("/v1/info/batch", json={"aids": [str(i) for i in range(101)]}).status_code == 400
+        assert client.post("/v1/info/batch", content=b"not json").status_code == 400
+
+
+# ============================================================
+# Cache warmer
+# ============================================================
+
+class TestCacheWarmer:
+    """Tests for the background ranking/info/cover warmer."""
+
+    @pytest.fixture
+    def warm_env(self, tmp_path):
+        from main import CacheWarmer
+        rank = SimpleCache(ttl_seconds=3600, max_size=10, soft_ttl_seconds=600)
+        info = SimpleCache(ttl_seconds=3600, max_size=100, soft_ttl_seconds=600)
+        fetch_rank = MagicMock(side_effect=lambda t: [{"aid": f"{t.value}{i}", "title": "x"} for i in range(5)])
+        fetch_info = MagicMock(side_effect=lambda aid: {"status": "success", "aid": aid})
+        fetcher = MagicMock()
+        with patch("main.rank_cache", rank), patch("main.album_info_cache", info), \
+                patch("main._fetch_rank", fetch_rank), patch("main._fetch_album_info", fetch_info), \
+                patch("main.cover_fetcher", fetcher), patch("main.FILE_PATH", tmp_path):
+            yield CacheWarmer(interval=300, top_n=3, rate=1000, busy_threshold=3), rank, info, fetch_info, fetcher
+
+    def test_first_pass_fills_rankings_info_and_covers(self, warm_env):
+        import asyncio
+        warmer, rank, info, fetch_info, fetcher = warm_env
+        asyncio.run(warmer.warm_once())
+        assert rank.get("rank:week")[0]["aid"] == "week0"
+        assert info.get("album_info:day2") == {"status": "success", "aid": "day2"}
+        assert fetch_info.call_count == 9  # top 3 of each ranking
+        assert fetcher.prefetch.call_count == 9
+        assert warmer.stats()["refreshed"] == 12
+
+    def test_fresh_entries_are_skipped(self, warm_env):
+        import asyncio
+        warmer, rank, info, fetch_info, fetcher = warm_env
+        asyncio.run(warmer.warm_once())
+        hits = rank.stats()["hits"], info.stats()["hits"]
+        asyncio.run(warmer.warm_once())
+        assert fetch_info.call_count == 9
+        assert warmer.stats()["skipped"] == 12
+        assert (rank.stats()["hits"], info.stats()["hits"]) == hits  # skips don't read through get()
+
+    def test_refreshes_entries_that_would_go_stale(self, warm_env):
+        import asyncio
+        warmer, rank, info, fetch_info, fetcher = warm_env
+        asyncio.run(warmer.warm_once())
+        warmer.interval = 700  # everything now expires before the next pass
+        asyncio.run(warmer.warm_once())
+        assert fetch_info.call_count == 18
+
+    def test_backs_off_while_interactive_calls_are_in_flight(self, warm_env):
+        import asyncio
+        warmer = warm_env[0]
+        busy = MagicMock()
+        busy.__len__.side_effect = [5, 5, 0] + [0] * 100
+        busy.do.side_effect = lambda key, func, *args, **kw: asyncio.sleep(0, func(*args, **kw))
+        warmer.busy_poll = 0.01
+        with patch("main.upstream_flight", busy):
+            asyncio.run(warmer.warm_once())
+        assert warmer.busy_waits == 2
+        assert warmer.stats()["refreshed"] == 12
+
+    def test_token_bucket_limits_rate(self):
+        import asyncio
+        from main import TokenBucket
+        bucket = TokenBucket(rate=50)
+
+        async def take(n):
+            for _ in range(n):
+                await bucket.acquire()
+
+        start = time.monotonic()
+        asyncio.run(take(6))
+        assert time.monotonic() - start >= 0.09
+
+
+# ============================================================
+# Speculative prefetch
+# ============================================================
+
+class TestSpeculativePrefetch:
+    """Next-page and cover prefetch after a search."""
+
+    @pytest.fixture
+    def prefetch_env(self, tmp_path):
+        from unittest.mock import AsyncMock
+        from main import SpeculativePrefetcher
+        prefetcher = SpeculativePrefetcher(busy_threshold=5)
+        fetch_search = MagicMock(side_effect=lambda tag, num: [{"album_id": f"{num}0{i}", "title": tag} for i in range(3)])
+        fetcher = MagicMock()
+
+        async def fetch_cover(album_id):
+            (tmp_path / f"cover-{album_id}.jpg").write_bytes(b"\xff\xd8")
+            return True
+
+        fetcher.fetch = AsyncMock(side_effect=fetch_cover)
+        with patch("main.SEARCH_PREFETCH_ENABLED", True), \
+                patch("main.search_prefetcher", prefetcher), \
+                patch("main.search_cache", SimpleCache(ttl_seconds=60, max_size=100)), \
+                patch("main._fetch_search", fetch_search), \
+                patch("main.cover_fetcher", fetcher), \
+                patch("main.schedule_deletion"), \
+                patch("main.FILE_PATH", tmp_path):
+            yield prefetcher, fetch_search, fetcher
+
+    @staticmethod
+    def _drain(prefetcher, timeout=3):
+        deadline = time.monotonic() + timeout
+        while prefetcher.stats()["queued"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_next_page_and_covers_are_prefetched(self, prefetch_env):
+        prefetcher, fetch_search, fetcher = prefetch_env
+        with TestClient(app) as client:
+            assert client.get("/v1/search/tag/1").status_code == 200
+            self._drain(prefetcher)
+            assert [c.args for c in fetch_search.call_args_list] == [("tag", 1), ("tag", 2)]
+            assert sorted(c.args[0] for c in fetcher.fetch.call_args_list) == ["100", "101", "102"]
+
+            assert client.get("/v1/search/tag/2").status_code == 200
+            assert client.get("/v1/get/cover/101").status_code == 200
+            assert client.get("/v1/get/cover/101").status_code == 200
+        assert fetch_search.call_count == 3  # page 2 from cache; page 3 prefetched in turn
+        stats = prefetcher.stats()
+        assert stats["issued"] == 8  # pages 2 and 3, plus the covers of pages 1 and 2
+        assert stats["hits"] == 2  # page 2 once, cover 101 counted once
+
+    def test_disabled_by_default(self, prefetch_env):
+        prefetcher, fetch_search, _ = prefetch_env
+        with patch("main.SEARCH_PREFETCH_ENABLED", False):
+            TestClient(app).get("/v1/search/tag/1")
+        assert prefetcher.stats()["queued"] == 0
+
+    def test_full_queue_drops_items(self):
+        from main import SpeculativePrefetcher
+        prefetcher = SpeculativePrefetcher(busy_threshold=5, max_queue=2)
+        with patch("main.search_cache", SimpleCache(ttl_seconds=60, max_size=10)):
+            prefetcher.after_search("t", 1, [{"album_id": 1}, {"album_id": 2}, {"album_id": 3}])
+        assert prefetcher.stats()["queued"] == 2
+        assert prefetcher.stats()["dropped"] == 2
+
+
+# ============================================================
+# Impl mode probing and failover
+# ============================================================
+
+class TestImplModeManager:
+    """Background probe, re-probe and html/api failover."""
+
+    @pytest.fixture
+    def rebuild(self):
+        with patch("main._rebuild_clients") as rebuild:
+            yield rebuild
+
+    def test_api_until_background_probe_finishes(self, rebuild, monkeypatch):
+        from main import ImplModeManager
+        monkeypatch.delenv("JM_IMPL_MODE")
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        release = threading.Event()
+
+        def slow_probe():
+            release.wait(5)
+            return True
+
+        with patch("main.probe_html_mode", side_effect=slow_probe):
+            start = time.monotonic()
+            manager.start()
+            assert manager.mode == "api"
+            assert time.monotonic() - start < 0.5
+            release.set()
+            deadline = time.monotonic() + 2
+            while manager.mode != "html" and time.monotonic() < deadline:
+                time.sleep(0.01)
+            manager.stop()
+        assert manager.mode == "html"
+        rebuild.assert_called_once_with("html")
+        assert manager.generation == 1
+
+    def test_html_failures_fail_over_to_api(self, rebuild):
+        from main import ImplModeManager
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        manager.set_mode("html", "test")
+        for _ in range(3):
+            manager.record_failure()
+        with patch("main.probe_html_mode") as probe:
+            manager.reprobe()
+        probe.assert_not_called()
+        assert manager.mode == "api"
+        assert manager.switches == 2
+
+    def test_success_resets_failure_count(self, rebuild):
+        from main import ImplModeManager
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        manager.record_failure()
+        manager.record_failure()
+        manager.record_success()
+        manager.record_failure()
+        assert not manager._wake.is_set()
+
+    def test_api_failures_reprobe_html(self, rebuild):
+        from main import ImplModeManager
+        manager = ImplModeManager(probe_interval=3600, failover_errors=2)
+        manager.record_failure()
+        manager.record_failure()
+        assert manager._wake.is_set()
+        with patch("main.probe_html_mode", return_value=True):
+            manager.reprobe()
+        assert manager.mode == "html"
+
+    def test_periodic_reprobe_drops_broken_html(self, rebuild):
+        from main import ImplModeManager
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        manager.set_mode("html", "test")
+        with patch("main.probe_html_mode", return_value=False):
+            manager.reprobe()
+        assert manager.mode == "api"
+
+    def test_failed_rebuild_keeps_current_mode(self, rebuild):
+        from main import ImplModeManager
+        rebuild.side_effect = RuntimeError("no network")
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        assert manager.set_mode("html", "test") is False
+        assert manager.mode == "api"
+        assert manager.generation == 0
+
+    def test_pinned_mode_skips_probing(self, rebuild, monkeypatch):
+        from main import ImplModeManager
+        monkeypatch.setenv("JM_IMPL_MODE", "html")
+        manager = ImplModeManager(probe_interval=3600, failover_errors=3)
+        with patch("main.probe_html_mode") as probe:
+            manager.start()
+        probe.assert_not_called()
+        assert manager.mode == "html"
+        assert manager._thread is None
+
+    def test_cache_through_feeds_failure_counter(self):
+        import jmcomic
+        from main import _cache_through
+        cache = SimpleCache(ttl_seconds=60, max_size=10)
+        with patch("main.impl_manager") as manager:
+            with pytest.raises(jmcomic.MissingAlbumPhotoException):
+                _cache_through(cache, "k", MagicMock(side_effect=jmcomic.MissingAlbumPhotoException(
+                    "missing", {"missing_jm_id": "1"})))
+            manager.record_failure.assert_not_called()
+            with pytest.raises(jmcomic.RequestRetryAllFailException):
+                _cache_through(cache, "k", MagicMock(side_effect=jmcomic.RequestRetryAllFailException("down", {})))
+            manager.record_failure.assert_called_once()
+            _cache_through(cache, "k", lambda: 1)
+            manager.record_success.assert_called_once()
+
+
+# ============================================================
+# Circuit breakers and retry budget
+# ============================================================
+
+class TestCircuitBreaker:
+    """Per-operation breakers and the global retry budget."""
+
+    @staticmethod
+    def _down():
+        import jmcomic
+        raise jmcomic.RequestRetryAllFailException("down", {})
+
+    def _trip(self, breaker, times=3):
+        import jmcomic
+        for _ in range(times):
+            with pytest.raises(jmcomic.RequestRetryAllFailException):
+                breaker.call(self._down)
+
+    @pytest.fixture
+    def search_breaker(self):
+        import main
+        breaker = main.breakers["search"]
+        yield breaker
+        breaker.state, breaker._failures, breaker._probing = "closed", 0, False
+
+    def test_opens_after_consecutive_failures(self):
+        from main import CircuitBreaker, CircuitOpen
+        breaker = CircuitBreaker("t", failure_threshold=3, reset_timeout=60)
+        self._trip(breaker, 2)
+        assert breaker.state == "closed"
+        self._trip(breaker, 1)
+        assert breaker.state == "open"
+        fn = MagicMock()
+        with pytest.raises(CircuitOpen) as exc:
+            breaker.call(fn)
+        fn.assert_not_called()
+        assert 55 < exc.value.retry_after <= 60
+        assert breaker.stats()["rejected"] == 1
+
+    def test_missing_album_is_not_a_failure(self):
+        import jmcomic
+        from main import CircuitBreaker
+
+        def missing():
+            raise jmcomic.MissingAlbumPhotoException("missing", {"missing_jm_id": "1"})
+
+        breaker = CircuitBreaker("t", failure_threshold=1, reset_timeout=60)
+        with pytest.raises(jmcomic.MissingAlbumPhotoException):
+            breaker.call(missing)
+        assert breaker.state == "closed"
+
+    def test_half_open_probe_closes_on_success(self):
+        from main import CircuitBreaker, CircuitOpen
+        breaker = CircuitBreaker("t", failure_threshold=1, reset_timeout=0.05)
+        self._trip(breaker, 1)
+        time.sleep(0.06)
+        probe_started, release = threading.Event(), threading.Event()
+
+        def probe():
+            probe_started.set()
+            release.wait(5)
+            return "ok"
+
+        result = []
+        worker = threading.Thread(target=lambda: result.append(breaker.call(probe)))
+        worker.start()
+        probe_started.wait(5)
+        assert breaker.state == "half_open"
+        with pytest.raises(CircuitOpen):  # only one probe at a time
+            breaker.call(lambda: "other")
+        release.set()
+        worker.join(5)
+        assert result == ["ok"]
+        assert breaker.state == "closed"
+
+    def test_half_open_probe_failure_reopens(self):
+        from main import CircuitBreaker
+        breaker = CircuitBreaker("t", failure_threshold=3, reset_timeout=0.05)
+        self._trip(breaker, 3)
+        time.sleep(0.06)
+        self._trip(breaker, 1)
+        assert breaker.state == "open"
+        assert breaker.retry_after() > 0
+
+    def test_open_breaker_returns_503_with_retry_after(self, search_breaker):
+        self._trip(search_breaker, search_breaker.failure_threshold)
+        with patch("main.search_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.jm_client_pool") as pool:
+            response = TestClient(app).get("/v1/search/tag/1")
+        assert response.status_code == 503
+        assert int(response.headers["retry-after"]) >= 1
+        pool.client.assert_not_called()
+
+    def test_retry_budget_limits_retries(self):
+        from main import RetryBudget
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        assert budget.try_spend() and budget.try_spend()
+        assert not budget.try_spend()
+        budget.deposit()
+        budget.deposit()
+        assert budget.try_spend()
+        assert budget.stats()["exhausted"] == 1
+
+    def test_client_stops_retrying_when_budget_is_spent(self):
+        import jmcomic
+        from main import RetryBudget, RetryBudgetExhausted, install_retry_budget
+        client = jmcomic.JmHtmlClient(
+            postman=jmcomic.JmModuleConfig.new_postman(), domain_list=["127.0.0.1:9"], retry_times=5)
+        attempts = []
+        client.before_retry = lambda e, kwargs, retry_count, url: attempts.append(retry_count)
+        with patch("main.retry_budget", RetryBudget(ratio=0, min_per_second=0, max_tokens=2)):
+            install_retry_budget(client)
+            with pytest.raises(RetryBudgetExhausted):
+                client.search_site(search_query="x")
+        assert attempts == [0, 1]
+
+    def test_each_upstream_request_deposits_once(self):
+        import jmcomic
+        from main import RetryBudget, instrument_client
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=10)
+        budget._tokens = 0
+        client = jmcomic.JmHtmlClient(
+            postman=jmcomic.JmModuleConfig.new_postman(), domain_list=["fast.test"], retry_times=2)
+        client.postman = _FakeDomains({"fast.test": (0.0, False)})
+        instrument_client(client, budget)
+        for _ in range(4):
+            client.get("/ping")
+        assert budget.stats()["tokens"] == 2
+
+    def test_download_retries_do_not_starve_metadata_retries(self):
+        import jmcomic
+        import main
+        from main import RetryBudget, RetryBudgetExhausted
+
+        def failing_client():
+            client = jmcomic.JmHtmlClient(
+                postman=jmcomic.JmModuleConfig.new_postman(), domain_list=["down.test"], retry_times=3)
+            client.postman = _FakeDomains({"down.test": (0.0, True), "img.test": (0.0, True)})
+            return client
+
+        option = MagicMock(new_jm_client=failing_client)
+        with patch("main.retry_budget", RetryBudget(ratio=0, min_per_second=0, max_tokens=10)), \
+                patch("main.download_retry_budget", RetryBudget(ratio=0, min_per_second=0, max_tokens=10)), \
+                patch("main.get_download_option", return_value=option):
+            download = main.new_download_client()
+            for page in range(20):  # every image of a flaky album retried until the budget runs out
+                with pytest.raises(jmcomic.JmcomicException):
+                    download.get(f"https://img.test/{page}.jpg", is_image=True)
+            assert main.download_retry_budget.stats()["exhausted"] > 0
+            metadata = main.instrument_client(failing_client())
+            with pytest.raises(jmcomic.JmcomicException) as excinfo:
+                metadata.get("/album")
+            assert not isinstance(excinfo.value, RetryBudgetExhausted)
+            assert main.retry_budget.stats()["spent"] == 4  # all of its retries were paid for
+
+
+# ============================================================
+# Latency-aware domain selection
+# ============================================================
+
+class _FakeDomains:
+    """Stand-in for upstream mirrors: per-host latency and failure, with a call log."""
+
+    def __init__(self, hosts):
+        self.hosts = hosts  # host -> (delay seconds, fails)
+        self.calls = []
+
+    def get_meta_data(self, key, default=None):
+        return default
+
+    def get(self, url, **kwargs):
+        from urllib.parse import urlparse
+        host = urlparse(url).netloc
+        self.calls.append(host)
+        delay, fails = self.hosts[host]
+        time.sleep(delay)
+        if fails:
+            raise ConnectionError(f"{host} unreachable")
+        resp = MagicMock(status_code=200)
+        resp.host = host
+        return resp
+
+
+class TestDomainSelector:
+    """Ranking upstream domains by measured latency and errors."""
+
+    @pytest.fixture
+    def selector_env(self):
+        import jmcomic
+        from main import DomainSelector, RetryBudget, instrument_client
+        selector = DomainSelector()
+        fake = _FakeDomains({"slow.test": (0.03, False), "fast.test": (0.0, False), "down.test": (0.0, True)})
+        with patch("main.domain_selector", selector), \
+                patch("main.retry_budget", RetryBudget(ratio=0, min_per_second=0, max_tokens=1000)):
+            client = jmcomic.JmHtmlClient(
+                postman=jmcomic.JmModuleConfig.new_postman(),
+                domain_list=["down.test", "slow.test", "fast.test"], retry_times=1)
+            client.postman = fake
+            instrument_client(client)
+            yield selector, fake, client
+
+    def test_routes_to_fastest_healthy_domain(self, selector_env):
+        selector, fake, client = selector_env
+        assert client.get("/ping").host == "slow.test"  # down.test fails over to the next in list
+        for domain in ("fast.test", "slow.test"):
+            selector.record(domain, 0.001 if domain == "fast.test" else 0.03)
+        fake.calls.clear()
+        for _ in range(3):
+            assert client.get("/ping").host == "fast.test"
+        assert fake.calls == ["fast.test"] * 3
+        assert [d["domain"] for d in selector.snapshot()] == ["fast.test", "slow.test", "down.test"]
+        assert selector.snapshot()[-1]["healthy"] is False
+
+    def test_failed_domain_is_retried_then_skipped(self, selector_env):
+        selector, fake, client = selector_env
+        client.get("/ping")
+        assert fake.calls[:2] == ["down.test", "down.test"]  # retry_times=1: two attempts per domain
+        assert selector.rank(["down.test", "slow.test"]) == ["slow.test", "down.test"]
+
+    def test_all_domains_failing_raises_retry_exhausted(self, selector_env):
+        import jmcomic
+        selector, fake, client = selector_env
+        for host in fake.hosts:
+            fake.hosts[host] = (0.0, True)
+        with pytest.raises(jmcomic.RequestRetryAllFailException):
+            client.get("/ping")
+        assert len(fake.calls) == 6
+
+    def test_absolute_urls_keep_their_host(self, selector_env):
+        selector, fake, client = selector_env
+        fake.hosts["cdn.test"] = (0.0, False)
+        assert client.get("https://cdn.test/media/1.jpg").host == "cdn.test"
+        assert "cdn.test" not in [d["domain"] for d in selector.snapshot()]
+
+    def test_probe_measures_known_domains(self, selector_env):
+        selector, fake, client = selector_env
+        assert selector.probe(fake) == 3
+        stats = {d["domain"]: d for d in selector.snapshot()}
+        assert stats["fast.test"]["latency_ms"] is not None
+        assert stats["down.test"]["error_rate"] > 0
+
+    def test_domains_endpoint(self, selector_env):
+        selector, fake, client = selector_env
+        selector.record("fast.test", 0.01)
+        response = TestClient(app).get("/v1/domains")
+        assert response.status_code == 200
+        assert response.json()["domains"][0]["domain"] == "fast.test"
+
+
 # ============================================================
 # Health check endpoint (no network needed)
 # ============================================================
@@ -391,3 +2006,538 @@ class TestSerializeComment:
         assert len(result["replies"]) == 1
         assert result["replies"][0]["content"] == "reply"
         assert result["replies"][0]["is_spoiler"] is True
+
+
+# ============================================================
+# ClientPool — checkout/return of upstream clients
+# ============================================================
+
+class TestClientPool:
+    def _pool(self, **kwargs):
+        built = []
+
+        def factory():
+            built.append(MagicMock(name=f"client{len(built)}"))
+            return built[-1]
+
+        return ClientPool(factory, **kwargs), built
+
+    def test_concurrent_checkouts_get_distinct_clients(self):
+        pool, built = self._pool(size=3)
+        with pool.client() as a, pool.client() as b:
+            assert a is not b
+            assert pool.stats()["in_use"] == 2
+        with pool.client() as c:
+            assert c is a  # a was returned last, so it is reused first
+        stats = pool.stats()
+        assert len(built) == 2
+        assert stats["created"] == 2 and stats["idle"] == 2 and stats["checkouts"] == 3
+
+    def test_checkout_waits_for_a_free_client(self):
+        from main import ClientPoolExhausted
+        pool, _ = self._pool(size=1, checkout_timeout=0.05)
+        with pool.client():
+            with pytest.raises(ClientPoolExhausted):
+                with pool.client():
+                    pass
+        released = threading.Event()
+
+        def hold():
+            with pool.client():
+                released.wait(1)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        time.sleep(0.02)
+        pool.checkout_timeout = 1
+        threading.Timer(0.05, released.set).start()
+        with pool.client():
+            pass
+        holder.join()
+        assert pool.stats()["waits"] == 2
+
+    def test_recycles_client_after_consecutive_upstream_errors(self):
+        import jmcomic
+        pool, built = self._pool(size=1, max_errors=2)
+        for _ in range(2):
+            with pytest.raises(jmcomic.JmcomicException):
+                with pool.client():
+                    raise jmcomic.JmcomicException("boom", {})
+        with pool.client() as client:
+            assert client is built[1]
+        assert pool.stats()["recycled"] == 1
+
+    def test_success_and_not_found_do_not_count_as_errors(self):
+        import jmcomic
+        pool, built = self._pool(size=1, max_errors=2)
+        for _ in range(3):
+            with pytest.raises(jmcomic.JmcomicException):
+                with pool.client():
+                    raise jmcomic.JmcomicException("boom", {})
+            with pool.client():
+                pass
+            with pytest.raises(jmcomic.MissingAlbumPhotoException):
+                with pool.client():
+                    raise jmcomic.MissingAlbumPhotoException("gone", {"missing_jm_id": "1"})
+        assert len(built) == 1
+
+    def test_reset_rebuilds_clients_lazily(self):
+        pool, built = self._pool(size=2)
+        with pool.client() as held:
+            with pool.client():
+                pass
+            pool.reset()
+            assert pool.stats()["idle"] == 0
+        assert pool.stats()["created"] == 0  # held client is dropped on return
+        with pool.client() as fresh:
+            assert fresh is not held and fresh is built[2]
+
+    def test_impl_switch_rebuilds_pooled_clients_for_new_impl(self):
+        import main
+
+        def option_for(yaml_text):
+            impl = "html" if "impl: html" in yaml_text else "api"
+            return MagicMock(new_jm_client=lambda: MagicMock(impl=impl))
+
+        manager = main.ImplModeManager(probe_interval=3600, failover_errors=3)
+        pool = ClientPool(lambda: main.instrument_client(main.get_info_option().new_jm_client()), size=2)
+        with patch("main.jm_client_pool", pool), patch("main.impl_manager", manager), \
+                patch("main._info_option_cache", {}), patch("main._cover_client_cache", None), \
+                patch("main.instrument_client", side_effect=lambda c: c), \
+                patch("main.jmcomic.create_option_by_str", side_effect=option_for):
+            with main.jm_client() as client:
+                assert client.impl == "api"
+            assert manager.set_mode("html", "test")
+            with main.jm_client() as client:
+                assert client.impl == "html"
+            assert manager.set_mode("api", "test")
+            with main.jm_client() as client:
+                assert client.impl == "api"
+
+    def test_pool_covers_every_metadata_worker_by_default(self):
+        import main
+        if "JM_CLIENT_POOL_SIZE" not in os.environ:
+            assert main.CLIENT_POOL_SIZE == main.METADATA_WORKERS
+        assert main.jm_client_pool.size == main.CLIENT_POOL_SIZE
+
+    def test_factory_failure_frees_the_slot(self):
+        pool = ClientPool(MagicMock(side_effect=RuntimeError("no network")), size=1)
+        with pytest.raises(RuntimeError):
+            with pool.client():
+                pass
+        assert pool.stats()["created"] == 0
+
+    def test_clients_endpoint(self):
+        response = TestClient(app).get("/v1/clients")
+        assert response.status_code == 200
+        assert response.json()["pool"]["size"] >= 1
+
+
+# ============================================================
+# NamedExecutor — separate pools for metadata, media and downloads
+# ============================================================
+
+class TestNamedExecutor:
+    def test_reports_queue_depth(self):
+        from main import NamedExecutor
+        executor = NamedExecutor("t", max_workers=2)
+        release = threading.Event()
+        futures = [executor.submit(release.wait, 1) for _ in range(5)]
+        time.sleep(0.05)
+        stats = executor.stats()
+        assert stats["active"] == 2 and stats["queued"] == 3 and stats["max_queued"] >= 3
+        release.set()
+        for future in futures:
+            future.result()
+        stats = executor.stats()
+        assert stats["active"] == 0 and stats["queued"] == 0
+        assert stats["submitted"] == stats["completed"] == 5
+        executor.shutdown()
+
+    def test_cancelled_queued_call_leaves_the_queue(self):
+        from main import NamedExecutor
+        executor = NamedExecutor("t", max_workers=1)
+        release = threading.Event()
+        running = executor.submit(release.wait, 1)
+        queued = executor.submit(lambda: None)
+        assert queued.cancel()
+        assert executor.stats()["queued"] == 0
+        release.set()
+        running.result()
+        executor.shutdown()
+
+    def test_run_propagates_context(self):
+        import asyncio
+        import contextvars
+        from main import NamedExecutor
+        var = contextvars.ContextVar("var", default=None)
+        executor = NamedExecutor("t", max_workers=1)
+
+        async def main():
+            var.set("request-1")
+            return await executor.run(var.get)
+
+        assert asyncio.run(main()) == "request-1"
+        executor.shutdown()
+
+    def test_busy_download_pool_does_not_delay_metadata(self):
+        import asyncio
+        import main
+        release = threading.Event()
+        blockers = [main.download_executor.submit(release.wait, 2)
+                    for _ in range(main.download_executor.max_workers * 2)]
+        try:
+            started = time.monotonic()
+            result = asyncio.run(main.upstream_flight.do("k", lambda: "ok"))
+            assert result == "ok"
+            assert time.monotonic() - started < 0.5
+            assert main.download_executor.stats()["queued"] >= main.download_executor.max_workers
+        finally:
+            release.set()
+            for future in blockers:
+                future.result()
+
+    def test_executors_endpoint(self):
+        response = TestClient(app).get("/v1/executors")
+        assert response.status_code == 200
+        assert set(response.json()["executors"]) == {"metadata", "media", "download"}
+
+
+# ============================================================
+# /metrics — Prometheus exposition
+# ============================================================
+
+class TestMetrics:
+    def test_histogram_buckets_are_cumulative(self):
+        from main import Histogram
+        histogram = Histogram("h", "doc", ("op",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(("a",), value)
+        lines = histogram.render()
+        assert 'h_bucket{op="a",le="0.1"} 2' in lines
+        assert 'h_bucket{op="a",le="1"} 3' in lines
+        assert 'h_bucket{op="a",le="+Inf"} 4' in lines
+        assert 'h_count{op="a"} 4' in lines
+        assert 'h_sum{op="a"} 3.65' in lines
+
+    def test_label_values_are_escaped(self):
+        from main import Counter
+        counter = Counter("c_total", "doc", ("k",))
+        counter.inc(('say "hi"\n',))
+        assert 'c_total{k="say \\"hi\\"\\n"} 1' in counter.render()
+
+    def test_routes_are_labelled_by_template(self):
+        import main
+        client = TestClient(app)
+        before = main.http_requests.value(("/v1/jobs/{job_id}", "GET", "404"))
+        client.get("/v1/jobs/abc")
+        client.get("/v1/jobs/def")
+        assert main.http_requests.value(("/v1/jobs/{job_id}", "GET", "404")) == before + 2
+        assert main.http_latency.count(("/v1/jobs/{job_id}", "GET")) >= 2
+
+    def test_breaker_calls_record_upstream_latency_and_errors(self):
+        import jmcomic
+        import main
+        breaker = main.CircuitBreaker("metrics-test", failure_threshold=10, reset_timeout=1)
+        breaker.call(lambda: None)
+        with pytest.raises(jmcomic.JmcomicException):
+            breaker.call(self._fail)
+        assert main.upstream_latency.count(("metrics-test",)) == 2
+        assert main.upstream_errors.value(("metrics-test", "JmcomicException")) == 1
+
+    @staticmethod
+    def _fail():
+        import jmcomic
+        raise jmcomic.JmcomicException("boom", {})
+
+    def test_metrics_endpoint_exposes_all_families(self):
+        client = TestClient(app)
+        client.get("/v1/health")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        for family in ("jm_http_requests_total", "jm_http_request_duration_seconds_bucket",
+                       'jm_cache_hits_total{cache="album_info"}', 'jm_executor_queued{executor="download"}',
+                       "jm_websocket_connections", "jm_pending_tasks", "jm_temp_dir_bytes",
+                       'jm_breaker_state{operation="search"}', 'jm_client_pool_clients{state="idle"}'):
+            assert family in body
+
+    def test_metrics_exposes_prefetch_counters(self):
+        import main
+
+        prefetcher = main.SpeculativePrefetcher(busy_threshold=3, max_queue=1)
+        prefetcher._enqueue(("cover", "1"))
+        prefetcher._enqueue(("cover", "2"))  # queue full
+        prefetcher.issued, prefetcher.hits = 4, 1
+        with patch.object(main, "search_prefetcher", prefetcher):
+            body = main.render_metrics(0)
+        assert "jm_prefetch_enqueued_total 1" in body
+        assert "jm_prefetch_dropped_total 1" in body
+        assert "jm_prefetch_hits_total 1" in body
+        assert "jm_prefetch_hit_ratio 0.25" in body
+
+    def test_metrics_exposes_component_stats(self):
+        import main
+
+        breaker = main.CircuitBreaker("search", failure_threshold=1, reset_timeout=30)
+        breaker._after_call(probe=False, failed=True)
+        budget = main.RetryBudget(ratio=0, min_per_second=0, max_tokens=1)
+        budget.try_spend()
+        budget.try_spend()
+        with patch.dict("main.breakers", {"search": breaker}), patch.object(main, "download_retry_budget", budget):
+            body = main.render_metrics(0)
+        assert 'jm_breaker_opened_total{operation="search"} 1' in body
+        assert 'jm_breaker_consecutive_failures{operation="search"} 1' in body
+        assert 'jm_retry_budget_spent_total{budget="download"} 1' in body
+        assert 'jm_retry_budget_exhausted_total{budget="download"} 1' in body
+        assert 'jm_impl_mode{mode="api"} 1' in body
+        for family in ("jm_impl_switches_total", "jm_deletions_scheduled", "jm_deletions_emergency_total",
+                       "jm_cover_fetched_total", 'jm_singleflight_calls_total{flight="cover"}',
+                       "jm_warmer_refreshed_total", "jm_warmer_busy_waits_total"):
+            assert family in body
+
+    def test_metrics_exposes_singleflight_counters(self):
+        import main
+
+        flight = main.SingleFlight()
+        flight.calls, flight.merged = 5, 3
+        with patch.object(main, "upstream_flight", flight):
+            body = main.render_metrics(0)
+        assert 'jm_singleflight_calls_total{flight="upstream"} 5' in body
+        assert 'jm_singleflight_merged_total{flight="upstream"} 3' in body
+        assert 'jm_singleflight_in_flight{flight="cover_variant"}' in body
+
+
+# ============================================================
+# Server-Timing header and sampling profiler
+# ============================================================
+
+class TestServerTiming:
+    @staticmethod
+    def _phases(response):
+        return dict(part.strip().split(";dur=") for part in response.headers["server-timing"].split(","))
+
+    def test_cache_miss_reports_every_phase(self):
+        jm_client = MagicMock()
+        jm_client.day_ranking.return_value = [("1", "a")]
+        with patch("main.rank_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=1)):
+            client = TestClient(app)
+            miss = client.get("/v1/rank/day")
+            hit = client.get("/v1/rank/day")
+        assert miss.json() == [{"aid": "1", "title": "a"}]
+        assert {"cache", "queue", "upstream", "serialize", "total"} <= set(self._phases(miss))
+        assert "upstream" not in self._phases(hit)
+        assert float(self._phases(miss)["total"]) >= float(self._phases(miss)["upstream"])
+
+    def test_coalesced_waiter_reports_wait(self):
+        import asyncio
+        import main
+
+        async def scenario():
+            flight = SingleFlight()
+            release = threading.Event()
+            leader = asyncio.ensure_future(flight.do("k", release.wait, 1))
+            await asyncio.sleep(0.01)
+            timing = main.RequestTiming()
+            main.request_timing.set(timing)
+            follower = asyncio.ensure_future(flight.do("k", release.wait, 1))
+            await asyncio.sleep(0.02)
+            release.set()
+            await asyncio.gather(leader, follower)
+            return timing
+
+        timing = asyncio.run(scenario())
+        assert timing.phases["coalesced"] >= 0.01
+
+    def test_forced_profile_is_saved(self, tmp_path):
+        with patch("main.PROFILE_DIR", tmp_path), patch("main.PROFILE_TOKEN", b"s3cret"):
+            response = TestClient(app).get("/v1/health", headers={"X-JM-Profile": "s3cret"})
+        assert response.status_code == 200
+        files = list(tmp_path.glob("*GET-v1_health-*.folded"))
+        assert len(files) == 1
+
+    def test_profile_header_needs_the_configured_token(self, tmp_path):
+        client = TestClient(app)
+        with patch("main.PROFILE_DIR", tmp_path), patch("main.profiler") as profiler:
+            with patch("main.PROFILE_TOKEN", b""):
+                client.get("/v1/health", headers={"X-JM-Profile": "1"})
+                client.get("/v1/health", headers={"X-JM-Profile": ""})
+            with patch("main.PROFILE_TOKEN", b"s3cret"):
+                client.get("/v1/health", headers={"X-JM-Profile": "1"})
+        profiler.begin.assert_not_called()
+
+    def test_record_phase_is_safe_across_threads(self):
+        import main
+        timing = main.RequestTiming()
+
+        def add():
+            for _ in range(2000):
+                main.record_phase("upstream", 1.0, timing)
+
+        threads = [threading.Thread(target=add) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert timing.phases["upstream"] == 16000.0
+
+    def test_fast_sampled_requests_are_not_saved(self, tmp_path):
+        with patch("main.PROFILE_DIR", tmp_path), \
+                patch("main.PROFILE_SAMPLE_RATE", 1.0), \
+                patch("main.PROFILE_SLOW_MS", 60_000):
+            TestClient(app).get("/v1/health")
+        assert list(tmp_path.iterdir()) == []
+
+    def test_sampler_follows_executor_threads(self):
+        import contextvars
+        from main import NamedExecutor, StackSampler, request_profile
+        sampler = StackSampler(max_active=1)
+        profile = sampler.begin()
+        assert sampler.begin() is None  # over max_active
+        executor = NamedExecutor("t", max_workers=1)
+        started, release = threading.Event(), threading.Event()
+
+        def blocking_upstream_call():
+            started.set()
+            release.wait(1)
+
+        context = contextvars.copy_context()
+        context.run(request_profile.set, profile)
+        future = context.run(executor.submit, blocking_upstream_call)
+        started.wait(1)
+        sampler.sample_once()
+        release.set()
+        future.result()
+        sampler.end(profile)
+        executor.shutdown()
+        assert any(";test_unit:blocking_upstream_call;" in stack for stack in profile.stacks)
+        assert profile.folded().splitlines()[0].rsplit(" ", 1)[1].isdigit()
+
+
+# ============================================================
+# benchmarks/ — offline harness smoke test
+# ============================================================
+
+class TestBenchmarkHarness:
+    def test_percentile_is_nearest_rank(self):
+        from benchmarks.run import percentile
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([7.0], 95) == 7.0
+        assert percentile([], 50) == 0.0
+
+    def test_runs_every_endpoint_against_fake_upstream(self, tmp_path):
+        import asyncio
+        import json
+        import main
+        from main import ArtifactStore
+        from benchmarks.run import ENDPOINTS, format_table, parse_args, run_benchmark
+        args = parse_args(["-c", "4", "-n", "6", "--downloads", "2", "--keys", "3", "--latency-ms", "1",
+                           "--jitter-ms", "0", "--image-bytes", "1000", "--cover-width", "64"])
+        with patch("main.FILE_PATH", tmp_path), \
+                patch("main.artifact_store", ArtifactStore(tmp_path, tmp_path / "artifacts.json", 10 ** 9)), \
+                patch("main.search_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.album_info_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.rank_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.comment_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch.object(main.manager, "loop", None):  # may hold a closed loop from an earlier test
+            document = asyncio.run(run_benchmark(args, main))
+        assert set(document["results"]) == set(ENDPOINTS)
+        for endpoint, result in document["results"].items():
+            assert result["errors"] == 0, (endpoint, result["statuses"])
+            assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"]
+        assert document["results"]["download"]["requests"] == 2
+        assert (tmp_path / "bench-500000.zip").exists()
+        json.dumps(document)
+        assert "download" in format_table(document, baseline=document)
+
+
+# ============================================================
+# Pre-encoded cached responses
+# ============================================================
+
+class TestPreEncodedResponses:
+    @staticmethod
+    def _comments():
+        reply = {"comment_id": "2", "content": "回复", "replies": []}
+        return {"aid": "1", "page": 1, "comments": [{"comment_id": "1", "content": "评论", "replies": [reply]}]}
+
+    def test_hit_is_served_from_stored_bytes(self):
+        cache = SimpleCache(ttl_seconds=60, max_size=10)
+        cache.set("comments:1:1", self._comments())
+        _, payload, _ = cache.get_encoded_entry("comments:1:1")
+        with patch("main.comment_cache", cache), \
+                patch("main._encode_value", side_effect=AssertionError("re-encoded on a hit")):
+            response = TestClient(app).get("/v1/comments/1")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.content == payload
+        assert response.json() == self._comments()
+
+    def test_miss_response_matches_later_hits(self):
+        jm_client = MagicMock()
+        jm_client.week_ranking.return_value = [("1", "标题")]
+        with patch("main.rank_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main.jm_client_pool", ClientPool(lambda: jm_client, size=1)):
+            client = TestClient(app)
+            miss = client.get("/v1/rank/week")
+            hit = client.get("/v1/rank/week")
+        assert miss.content == hit.content
+        assert hit.json() == [{"aid": "1", "title": "标题"}]
+        assert jm_client.week_ranking.call_count == 1
+
+    def test_miss_is_encoded_once_for_all_merged_requests(self):
+        import asyncio
+        import main
+        release = threading.Event()
+        comments = self._comments()
+
+        def fetch(aid, page):
+            release.wait(5)
+            return comments
+
+        async def run():
+            tasks = [asyncio.create_task(main.get_comments("1", 1)) for _ in range(4)]
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        with patch("main.comment_cache", SimpleCache(ttl_seconds=60, max_size=10)), \
+                patch("main._fetch_comments", side_effect=fetch) as fetch_comments, \
+                patch("main._encode_value", wraps=main._encode_value) as encode:
+            responses = asyncio.run(run())
+        assert fetch_comments.call_count == 1
+        assert encode.call_count == 1  # by cache.set; the four responses reuse its bytes
+        assert {r.body for r in responses} == {main._encode_value(comments)}
+
+    def test_l2_promotion_keeps_encoded_bytes(self, tmp_path):
+        backend = SqliteCacheBackend(tmp_path / "shared.db")
+        writer = SimpleCache(ttl_seconds=60, max_size=10, backend=backend, namespace="ns")
+        reader = SimpleCache(ttl_seconds=60, max_size=10, backend=backend, namespace="ns")
+        writer.set("k", self._comments())
+        assert reader.load_shared("k") == self._comments()
+        value, payload, stale = reader.get_encoded_entry("k")
+        assert value == self._comments() and not stale
+        assert payload == writer.get_encoded_entry("k")[1]
+
+    def test_encoding_without_orjson_is_equivalent(self):
+        import json
+        from main import _decode_value, _encode_value
+        value = {"title": "全彩", "n": [1, 2.5, None, True], "big": 2 ** 70}
+        fast = _encode_value(value)
+        with patch("main.orjson", None):
+            plain = _encode_value(value)
+            assert _decode_value(plain) == value
+        assert json.loads(fast) == json.loads(plain) == value
+        assert b"\\u" not in plain  # non-ASCII kept as UTF-8, like FastAPI's JSONResponse
+
+    def test_unencodable_value_falls_back_to_json_response(self):
+        from main import json_response
+        response = json_response({"ok": True})
+        assert response.body == b'{"ok":true}'
+        cache = SimpleCache(ttl_seconds=60, max_size=10)
+        cache.set("k", {1, 2})  # a set: not JSON, kept in L1 without a payload
+        assert cache.get_encoded_entry("k")[1] is None